@@ -1,5 +1,8 @@
 """Main application for optical line simulation tool"""
 
+import logging
+import threading
+import queue
 import tkinter as tk
 from tkinter import ttk
 import matplotlib.pyplot as plt
@@ -8,11 +11,23 @@ import numpy as np
 
 # Import the GUI component prototypes and init functions
 from GUI_components.GUI_LineGUI import LineGUI # pylint: disable=import-error
+from GUI_components.GUI_StabilityMap import StabilityMap # pylint: disable=import-error
+from GUI_components.GUI_ModeMatch import ModeMatch # pylint: disable=import-error
+from GUI_components import GUI_OptLineProto # pylint: disable=import-error
+from GUI_components.raycalc.decimate import minmaxDecimate # pylint: disable=import-error
+from GUI_components.raycalc import profiling # pylint: disable=import-error
 
 # Import filehandler
 import utils.FileHandler as fh # pylint: disable=import-error
+from utils.logsetup import setupLogging # pylint: disable=import-error
 
-DEBUG = False
+log = logging.getLogger(__name__)
+# Quiet time after the last edit before a replot starts (ms)
+DEBOUNCE = 150
+# Samples of the coarse traces shown while a field slider is dragged
+PREVIEW = 100
+# Beam radii are computed in m and plotted in mm
+WSCALE = 1E3
 
 class App:
     """Main application class for optical line simulation"""
@@ -40,7 +55,8 @@ class App:
         self.add_button.grid(row=0, column=0, padx=5)
         self.add_button = ttk.Button(button_frame, text="Load", command=self.loadstate)
         self.add_button.grid(row=0, column=1, padx=5)
-        self.update_button = ttk.Button(button_frame, text="Replot", command=self.update_plot)
+        self.update_button = ttk.Button(button_frame, text="Replot",
+                                        command=lambda: self.update_plot(store = True))
         self.update_button.grid(row=0, column=2, padx=5)
 
         # Add ver and hor plot tickboxes
@@ -50,6 +66,56 @@ class App:
         self.hor = tk.IntVar(value = 1)
         self.hor_check = ttk.Checkbutton(button_frame, text="Horizontal", variable=self.hor)
         self.hor_check.grid(row = 1, column = 1, padx=5)
+        # Stability map window for the cavities
+        self.PlotMapWindow = None
+        self.map_button = ttk.Button(button_frame, text="Stability map", command=self.stabilitymap)
+        self.map_button.grid(row = 1, column = 2, padx=5)
+        # Replot automatically after edits
+        self.live = tk.IntVar(value = 0)
+        self.live_check = ttk.Checkbutton(button_frame, text="Live update", variable=self.live)
+        self.live_check.grid(row = 2, column = 0, padx=5)
+        self.status = ttk.Label(button_frame, text="")
+        self.status.grid(row = 2, column = 1, columnspan = 2, padx=5)
+        # Per stage timing of the replots, shown in the profile bar below
+        self.profile = tk.IntVar(value = 0)
+        self.profile_check = ttk.Checkbutton(button_frame, text="Profile",
+                                             variable=self.profile, command=self.set_profiling)
+        self.profile_check.grid(row = 3, column = 0, padx=5)
+        self.profilememory = tk.IntVar(value = 0)
+        self.profilememory_check = ttk.Checkbutton(button_frame, text="Track memory",
+                                                   variable=self.profilememory,
+                                                   command=self.set_profiling)
+        self.profilememory_check.grid(row = 3, column = 1, padx=5)
+        self.export_button = ttk.Button(button_frame, text="Export profile",
+                                        command=self.export_profile)
+        self.export_button.grid(row = 3, column = 2, padx=5)
+        # Mode matching window: optimise a line for a cavity, lock a cavity to a line
+        self.ModeMatchWindow = None
+        self.modematch_button = ttk.Button(button_frame, text="Mode matching",
+                                           command=self.modematch)
+        self.modematch_button.grid(row = 4, column = 0, padx=5)
+        self.profilebar = ttk.Label(self.sidebar, text="", justify=tk.LEFT, anchor="w")
+        self.profilebar.pack(side=tk.BOTTOM, fill=tk.X, padx=5, pady=5)
+        self.profilemark = 0 # First profiling record of the current replot
+
+        # Replots run in a worker thread on a snapshot of the models, newer requests
+        # supersede older ones (generation) and results come back through a queue
+        self.generation = 0
+        self.results = queue.Queue()
+        self.worker = None
+        self.pending = None # Debounce timer
+        self.rerun = False # Replot requested while the worker was busy
+        self.store = False # Pending replot writes missing traces to the disk cache
+        GUI_OptLineProto.listeners.append(self.model_changed)
+
+        # Field sliders show coarse previews while dragged: the snapshot taken when the
+        # drag started with its preview data, and previews of the slider positions around
+        # the current value computed in the background, (slider, value) -> plot data
+        self.previewsystem = None
+        self.previewdata = None
+        self.family = {}
+        self.familyid = 0 # Bumped when an edit makes the precomputed previews stale
+        GUI_OptLineProto.sliderlisteners.append(self.slider_changed)
 
         # Scrollable canvas for parameters
         self.paramcanvas = tk.Canvas(self.sidebar, borderwidth=0)
@@ -73,6 +139,14 @@ class App:
         # Create a figure and axis
         self.fig, self.ax = plt.subplots()
         self.lines = []
+        # Persistent plot artists, (optical line index, hor/ver) -> (plot type, artist)
+        self.artists = {}
+        self.legendkey = None
+        # Full resolution data of the artists, (optical line index, hor/ver) -> (x, w)
+        self.fulldata = {}
+        self.redecimating = False
+        # Figure without the (animated) lines, for blitting
+        self.background = None
         # Add X and Y labels
         self.ax.set_xlabel("Distance (m)")
         self.ax.set_ylabel("Beam Waist (mm)")
@@ -80,62 +154,298 @@ class App:
         # Create a canvas and add the figure to it
         self.canvas = FigureCanvasTkAgg(self.fig, master=self.main_frame)
         self.canvas.get_tk_widget().pack(side=tk.TOP, fill=tk.BOTH, expand=1)
+        self.canvas.mpl_connect("draw_event", self.on_draw)
+        # Zoom, pan and resize change what the decimated traces have to resolve
+        self.canvas.mpl_connect("resize_event", self.on_view)
+        self.ax.callbacks.connect("xlim_changed", self.on_view)
 
         # Add the Matplotlib toolbar
         self.toolbar = NavigationToolbar2Tk(self.canvas, self.main_frame)
         self.toolbar.update()
         self.canvas.get_tk_widget().pack(side=tk.TOP, fill=tk.BOTH, expand=1)
 
-    def update_plot(self):
-        """Replot the optical lines"""
-        # Clear the current plot
-        if DEBUG:
-            print(self.lines)
-        for line in self.lines:
-            line.remove()
-        #for line in self.ax.get_lines():
-            #line.remove()
-        # Create/reset an object to hold the lines
-        self.lines = []
-        xydat = self.lineslist.replot()
-        if DEBUG:
-            print(f"xydat keys: {xydat.keys()}")
-            print(f"xydat values: {xydat[0]}")
+    def model_changed(self):
+        """An input was edited, replot after a quiet period in live mode"""
+        if GUI_OptLineProto.dragging is not None:
+            return # Slider edits are previewed by slider_changed
+        self.familyid += 1
+        self.family.clear()
+        if self.live.get():
+            self.update_plot()
+
+    def slider_changed(self, slider, state):
+        """Progressive refinement for the field sliders: coarse traces while dragging,
+        the full computation once the slider rests"""
+        match state:
+            case "open":
+                self.start_family(slider)
+            case "drag":
+                self.preview(slider)
+            case "rest":
+                self.previewsystem = None
+                self.previewdata = None
+                self.update_plot(store = True)
+                self.start_family(slider)
+
+    def preview(self, slider):
+        """Draw coarse traces for the current slider value, precomputed ones if available"""
+        self.generation += 1 # Full computations in flight are stale
+        if self.pending is not None:
+            self.root.after_cancel(self.pending)
+            self.pending = None
+        if self.previewsystem is None:
+            self.previewsystem = self.lineslist.syncmodel().snapshot()
+            self.previewdata = self.previewsystem.preview(n = PREVIEW)
+        system = self.previewsystem
+        if slider.owner.model not in system.origins:
+            return
+        index = system.origins.index(slider.owner.model)
+        value = slider.values[slider.position]
+        system.lines[index] = slider.owner.model.snapshot()
+        if (slider, value) in self.family:
+            # Input q and matrices for the widget readouts, the trace is precomputed
+            system.lines[index].buildMatrixList()
+            system.lines[index].calcqs()
+            self.previewdata[index] = self.family[(slider, value)]
+        else:
+            self.previewdata[index] = system.lines[index].preview(n = PREVIEW)
+        xydat = self.lineslist.show_results(system, self.previewdata)
+        if xydat is not None:
+            self.draw(xydat)
+            self.status["text"] = "Preview"
+
+    def start_family(self, slider):
+        """Precompute previews of the slider positions around the current value"""
+        system = self.lineslist.syncmodel().snapshot()
+        if slider.owner.model not in system.origins:
+            return
+        index = system.origins.index(slider.owner.model)
+        values = [value for value in slider.around() if (slider, value) not in self.family]
+        familyid = self.familyid
+        def work():
+            previews = system.family(index, slider.setter, values, n = PREVIEW,
+                                     cancelled = lambda: familyid != self.familyid)
+            if previews is not None:
+                self.root.after(0, self.take_family, slider, familyid, previews)
+        threading.Thread(target=work, daemon=True).start()
+
+    def take_family(self, slider, familyid, previews):
+        """Store precomputed previews unless the inputs changed meanwhile. Runs on the
+        tkinter thread, like model_changed which clears them, so the check can't go stale"""
+        if familyid == self.familyid:
+            self.family.update({(slider, value): plotdata
+                                for value, plotdata in previews.items()})
+
+    def update_plot(self, store = False):
+        """Request a replot of the optical lines. Requests are debounced, the computation
+        runs in a worker thread and a stale computation is cancelled.
+        store: explicit replots, rested sliders and loaded savestates write missing traces
+        to the disk cache, live replots while editing only read it"""
+        self.store = self.store or store
+        self.generation += 1 # Running computations are stale from now on
+        if self.pending is not None:
+            self.root.after_cancel(self.pending)
+        self.pending = self.root.after(DEBOUNCE, self.start_replot)
+
+    def start_replot(self):
+        """Snapshot the models and hand them to a worker thread"""
+        self.pending = None
+        if self.worker is not None and self.worker.is_alive():
+            # Only one worker touches the trace caches, start again once it stopped
+            self.rerun = True
+            return
+        self.rerun = False
+        store, self.store = self.store, False
+        system = self.lineslist.syncmodel().snapshot()
+        self.profilemark = profiling.mark()
+        self.status["text"] = "Computing..."
+        self.worker = threading.Thread(target=self.work,
+                                       args=(system, self.generation, store),
+                                       daemon=True)
+        self.worker.start()
+        self.root.after(20, self.poll)
+
+    def work(self, system, generation, store = False):
+        """Worker thread: compute the snapshot unless a newer request supersedes it"""
+        try:
+            with profiling.stage("replot", memory = False):
+                plotdata = system.compute(cancelled = lambda: generation != self.generation,
+                                          store = store)
+        except Exception as e: #pylint: disable=broad-except
+            plotdata = e
+        self.results.put((generation, system, plotdata))
+
+    def poll(self):
+        """Pick up finished computations, runs on the tkinter thread"""
+        # Checked before draining, a worker that is done has put its result already
+        alive = self.worker is not None and self.worker.is_alive()
+        try:
+            while True:
+                generation, system, plotdata = self.results.get_nowait()
+                if isinstance(plotdata, Exception):
+                    self.status["text"] = f"Error: {plotdata}"
+                elif plotdata is not None and generation == self.generation:
+                    xydat = self.lineslist.show_results(system, plotdata)
+                    if xydat is None:
+                        self.rerun = True # Lines were added/removed meanwhile
+                    else:
+                        with profiling.stage("draw"):
+                            self.draw(xydat)
+                        self.status["text"] = ""
+                        if profiling.enabled:
+                            self.profilebar["text"] = profiling.summary(
+                                profiling.since(self.profilemark))
+        except queue.Empty:
+            pass
+        if alive:
+            self.root.after(20, self.poll)
+        elif self.rerun and self.pending is None:
+            self.start_replot()
+
+    def draw(self, xydat):
+        """Draw the computed plot data. Artists persist between replots, keyed by
+        (optical line index, hor/ver), and only get new data. If the legend and the axes
+        limits stay the same the lines are blitted over the cached background, otherwise
+        the canvas is redrawn in full"""
+        log.debug("xydat keys: %s", xydat.keys())
         # Decide which ones to plot
         plots = []
         if self.hor.get():
             plots.append("hor")
         if self.ver.get():
             plots.append("ver")
+        wanted = {}
         for optline in xydat:
             # Plot vertical and/or horizontal as provided
             for horver in plots:
                 if horver in xydat[optline]:
-                    # Check if the plot type is scatter or line
-                    match xydat[optline]["plotoptions"]["plottype"]:
-                        case "scatter":
-                            # Scatter plot
-                            scatter = self.ax.scatter(np.array(xydat[optline][horver]["x"]),
-                                                      np.array(xydat[optline][horver]["w"])*1E3,
-                                                      label = xydat[optline]["plotoptions"][horver]["title"],
-                                                      color = xydat[optline]["plotoptions"][horver]["color"])
-                            self.lines.append(scatter)
-                        case "line":
-                            # Line plot
-                            line = self.ax.plot(np.array(xydat[optline][horver]["x"]),
-                                                np.array(xydat[optline][horver]["w"])*1E3,
-                                                label = xydat[optline]["plotoptions"][horver]["title"],
-                                                color = xydat[optline]["plotoptions"][horver]["color"])
-                            self.lines.append(line[0])
-
-        # Add legend to the legend frame
-        self.ax.legend(loc='upper center', bbox_to_anchor=(0.5, 1.13),
-          ncol=3, fancybox=True, shadow=True)
-
-        # Redraw the plot
+                    wanted[(optline, horver)] = (xydat[optline][horver],
+                                                 xydat[optline]["plotoptions"]["plottype"],
+                                                 xydat[optline]["plotoptions"][horver])
+        full = False
+        self.redecimating = True # Autoscaling below is not a zoom
+        # Drop artists of removed lines, or whose plot type changed
+        for key in list(self.artists):
+            if key not in wanted or self.artists[key][0] != wanted[key][1]:
+                self.artists.pop(key)[1].remove()
+                full = True
+        # Kept as computed (often views of shared memory), only the decimated points are
+        # scaled to mm, a scaled copy of millions of samples would stall the tkinter thread
+        self.fulldata = {key: (np.asarray(data["x"]), np.asarray(data["w"]))
+                         for key, (data, plottype, options) in wanted.items()}
+        # Decimate for the view the axes will show: the data range when autoscaling
+        if self.ax.get_autoscalex_on() and self.fulldata:
+            view = (min(np.min(x, initial=np.inf) for x, w in self.fulldata.values()),
+                    max(np.max(x, initial=-np.inf) for x, w in self.fulldata.values()))
+        else:
+            view = self.ax.get_xlim()
+        for key, (data, plottype, options) in wanted.items():
+            x, w = self.fulldata[key]
+            if plottype != "scatter":
+                x, w = minmaxDecimate(x, w, *view, self.ax.bbox.width)
+            w = w*WSCALE
+            if key not in self.artists:
+                # Check if the plot type is scatter or line
+                match plottype:
+                    case "scatter":
+                        artist = self.ax.scatter(x, w, animated = True)
+                    case _:
+                        artist = self.ax.plot(x, w, animated = True)[0]
+                self.artists[key] = (plottype, artist)
+                full = True
+            else:
+                artist = self.artists[key][1]
+                if plottype == "scatter":
+                    artist.set_offsets(np.column_stack((x, w)))
+                else:
+                    artist.set_data(x, w)
+            artist.set_label(options["title"])
+            artist.set_color(options["color"])
+        self.lines = [artist for plottype, artist in self.artists.values()]
+
+        # Legend only changes with the set of lines, their titles or colors
+        legendkey = tuple((key, options["title"], options["color"])
+                          for key, (data, plottype, options) in wanted.items())
+        if legendkey != self.legendkey:
+            self.legendkey = legendkey
+            # Add legend to the legend frame
+            self.ax.legend(loc='upper center', bbox_to_anchor=(0.5, 1.13),
+              ncol=3, fancybox=True, shadow=True)
+            full = True
+
+        limits = (self.ax.get_xlim(), self.ax.get_ylim())
         self.ax.relim()
         self.ax.autoscale_view()
-        self.canvas.draw()
+        self.redecimating = False
+        if full or self.background is None or limits != (self.ax.get_xlim(), self.ax.get_ylim()):
+            if profiling.enabled:
+                self.canvas.draw() # Render now so the draw stage includes it
+            else:
+                self.canvas.draw_idle()
+        else:
+            self.blit()
+
+    def on_view(self, event): # pylint: disable=unused-argument
+        """The visible x range or the axes size changed, decimate again once idle"""
+        if not self.redecimating and self.fulldata:
+            self.redecimating = True
+            self.root.after_idle(self.redecimate)
+
+    def redecimate(self):
+        """Reduce the full resolution traces to the current view"""
+        xmin, xmax = self.ax.get_xlim()
+        for key, (plottype, artist) in self.artists.items():
+            if plottype != "scatter" and key in self.fulldata:
+                x, w = minmaxDecimate(*self.fulldata[key], xmin, xmax, self.ax.bbox.width)
+                artist.set_data(x, w*WSCALE)
+        self.canvas.draw_idle()
+        self.redecimating = False
+
+    def on_draw(self, event): # pylint: disable=unused-argument
+        """After a full redraw: cache the background without the lines, then draw them"""
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        for artist in self.lines:
+            self.fig.draw_artist(artist)
+
+    def blit(self):
+        """Redraw only the lines over the cached background"""
+        self.canvas.restore_region(self.background)
+        for artist in self.lines:
+            self.ax.draw_artist(artist)
+        self.canvas.blit(self.fig.bbox)
+
+    def set_profiling(self):
+        """Apply the profile checkboxes"""
+        profiling.enable(bool(self.profile.get()), memory = bool(self.profilememory.get()))
+        if not profiling.enabled:
+            self.profilebar["text"] = ""
+
+    def export_profile(self):
+        """Save the recorded stages, as a Chrome trace if the file ends with .trace.json
+        (open in chrome://tracing or ui.perfetto.dev), otherwise as plain JSON records"""
+        filepath = fh.SaveFileAs("./profiles")
+        if not filepath:
+            return
+        if filepath.endswith(".trace.json"):
+            fh.WriteJson(filepath, profiling.exportChromeTrace())
+        else:
+            fh.WriteJson(filepath, profiling.exportJSON())
+
+    def stabilitymap(self):
+        """Open the cavity stability map window"""
+        if self.PlotMapWindow is None:
+            self.PlotMapWindow = StabilityMap(parent = self, lineslist = self.lineslist)
+        else:
+            self.PlotMapWindow.refresh_cavities()
+            self.PlotMapWindow.root.lift()
+
+    def modematch(self):
+        """Open the mode matching window"""
+        if self.ModeMatchWindow is None:
+            self.ModeMatchWindow = ModeMatch(parent = self, lineslist = self.lineslist)
+        else:
+            self.ModeMatchWindow.refresh_lines()
+            self.ModeMatchWindow.root.lift()
 
     def on_frame_configure(self, event): # pylint: disable=unused-argument
         """Reset the scroll region to encompass the inner frame"""
@@ -143,6 +453,9 @@ class App:
 
     def on_closing(self):
         """Close the application"""
+        # Let a running worker finish without reporting back
+        self.generation += 1
+        GUI_OptLineProto.listeners.remove(self.model_changed)
         # Properly close the Matplotlib figure
         plt.close(self.fig)
         self.root.destroy()
@@ -152,8 +465,7 @@ class App:
         state = {}
         state["horver"] = (self.hor.get(), self.ver.get())
         state["OptLines"] = self.lineslist.savestate()
-        if DEBUG:
-            print(state)
+        log.debug("Saving state: %s", state)
 
         fh.WriteJson(fh.SaveFileAs("./savestates"), state)
 
@@ -163,10 +475,11 @@ class App:
         self.hor.set(state["horver"][0])
         self.ver.set(state["horver"][1])
         self.lineslist.loadstate(state["OptLines"])
-        self.update_plot()
+        self.update_plot(store = True)
 
 
 if __name__ == "__main__":
+    setupLogging()
     root = tk.Tk()
     app = App(root)
     root.mainloop()
@@ -4,29 +4,54 @@ subclass of the GUI_OptLineProto class, and is used to define the GUI element
 for an optical ribbon cavity"""
 
 import tkinter as tk
-from math import radians
+from tkinter import ttk
+import numpy as np
 
 # Import the GUI component prototypes and init functions
 # format depends on whether this is run as a script or imported as a module
 if __name__ == "__main__":
-    from raycalc.matrices import ringCavity, linCavity                      # pylint: disable=import-error
-    from raycalc.matrixcalc import cavityq, buildMatrixList, compositeABCD  # pylint: disable=import-error
+    from raycalc.cavitysweep import ribbonSweep, linSweep                   # pylint: disable=import-error
+    from raycalc.model import RibbonCavityModel, LinCavityModel             # pylint: disable=import-error
     from GUI_OptLineProto import GUI_OptLineProto                           # pylint: disable=import-error
 else:
-    from .raycalc.matrices import ringCavity, linCavity
-    from .raycalc.matrixcalc import  cavityq, buildMatrixList, compositeABCD
+    from .raycalc.cavitysweep import ribbonSweep, linSweep
+    from .raycalc.model import RibbonCavityModel, LinCavityModel
     from .GUI_OptLineProto import GUI_OptLineProto
 
+def cavitystatus(modes):
+    """Return a short status string for the hor/ver cavity eigenmodes"""
+    stability = ", ".join(f"m_{horver} = {modes[horver]['m']:.3f}" for horver in modes)
+    if all(modes[horver]["stable"] for horver in modes):
+        return f"Stable: {stability}"
+    unstable = "/".join(horver for horver in modes if not modes[horver]["stable"])
+    return f"UNSTABLE ({unstable}): {stability}"
+
 class LinCavity(GUI_OptLineProto):
     """LinCavity, extends GUI_OptLineProto to work for a linear cavity. UNFINISHED"""
-    def __init__(self, parent, parentframe,  compid = 0, location = (0,0), DEBUG = False):
+    modelclass = LinCavityModel
+    # Stability map support: inputs that can be swept and quantities to map (in µm)
+    sweepinputs = ["l_cavity", "R"]
+    sweepquantities = {"Waist": lambda sweep: sweep["hor"]["w0"]["waist"]*1E6,
+                       "Curved mirror spot": lambda sweep: sweep["hor"]["w"]["mirror"]*1E6}
+
+    @staticmethod
+    def runsweep(values, empty = np.empty):
+        """Cavity sweep for a dict of input values (scalars or arrays), no tkinter access"""
+        return linSweep(l_cavity = values["l_cavity"], R = values["R"], lda = values["lam"],
+                        empty = empty)
+
+    def __init__(self, parent, parentframe,  compid = 0, location = (0,0)):
         self.input = {"lam": tk.DoubleVar(value = 972E-9), # Wavelength
                       "l_cavity": tk.DoubleVar(value=75E-3), # Distance from waist
                       "R": tk.DoubleVar(value=15E-2), # Cavity curved mirror radius
                       "x_offset": tk.DoubleVar(value=0)} # Refractive index
-        super().__init__(parent, parentframe, compid, location, inputDict=self.input, DEBUG = DEBUG)
+        super().__init__(parent, parentframe, compid, location, inputDict=self.input)
         self.inputframe["text"] = "Cavity parameters"
         self.add_button.destroy()
+        # Stability readout below the cavity parameters
+        self.status = ttk.Label(self.inputframe, text="")
+        self.status.grid(row=len(self.input)//2+1, column=0, columnspan=4, padx=5)
+        self.modes = None
 
         # Extra variables for the linear cavity
         self.matrices = None
@@ -40,29 +65,51 @@ class LinCavity(GUI_OptLineProto):
         else:
             self.inputframe.grid()
 
-    def calcqs(self):
-        # Override default q calculation, based on the cavityq function
-        whor = cavityq(self.horABCD)
-        wver = cavityq(self.verABCD)
-
-        self.qhor = whor*1j
-        self.qver = wver*1j
-
-    def buildMatrixList(self):
-        # Override default Matrixlist building to handle the ringCavity format
-
+    def show_result(self, model, plotdata, adaptive = False, tol = 1E-3):
+        """Show the eigenmode stability of the computed cavity next to the plot data"""
+        self.modes = model.modes
+        self.matrices = model.matrices
+        self.horABCD = model.horABCD
+        self.verABCD = model.verABCD
+        self.status["text"] = cavitystatus(self.modes)
+        return super().show_result(model, plotdata, adaptive, tol)
 
-        self.matrices = linCavity(l_cavity = self.input["l_cavity"].get(),
-                                  R = self.input["R"].get())
-        self.matrices_hor = buildMatrixList(self.matrices["hor"])
-        self.matrices_ver = buildMatrixList(self.matrices["ver"])
-        self.horABCD = compositeABCD(self.matrices_hor)
-        self.verABCD = compositeABCD(self.matrices_ver)
+    def update_options(self):
+        """Mark unstable cavities in the plot legend"""
+        super().update_options()
+        for horver in ("hor", "ver"):
+            if self.modes is not None and not self.modes[horver]["stable"]:
+                self.plotoptions[horver]["title"] += " (unstable)"
 
 
 class RibbonCavity(GUI_OptLineProto):
     """RibbonCavity, extends GUI_OptLineProto to work for a ribbon cavity"""
-    def __init__(self, parent, parentframe,  compid = 0, location = (0,0), DEBUG = False):
+    modelclass = RibbonCavityModel
+    # Stability map support: inputs that can be swept and quantities to map (in µm)
+    sweepinputs = ["l_focus", "l_free", "l_crystal", "R_foc", "n_SHG", "θ (deg)"]
+    sweepquantities = {
+        "Focus waist hor": lambda sweep: sweep["hor"]["w0"]["focus"]*1E6,
+        "Focus waist ver": lambda sweep: sweep["ver"]["w0"]["focus"]*1E6,
+        "Free arm waist hor": lambda sweep: sweep["hor"]["w0"]["free"]*1E6,
+        "Free arm waist ver": lambda sweep: sweep["ver"]["w0"]["free"]*1E6,
+        "Focus hor-ver mismatch": lambda sweep: (sweep["hor"]["w0"]["focus"]
+                                                 -sweep["ver"]["w0"]["focus"])*1E6,
+        "Free arm hor-ver mismatch": lambda sweep: (sweep["hor"]["w0"]["free"]
+                                                    -sweep["ver"]["w0"]["free"])*1E6}
+
+    @staticmethod
+    def runsweep(values, empty = np.empty):
+        """Cavity sweep for a dict of input values (scalars or arrays), no tkinter access"""
+        return ribbonSweep(l_focus = values["l_focus"],
+                           l_free = values["l_free"],
+                           l_crystal = values["l_crystal"],
+                           R = values["R_foc"],
+                           n_crystal = values["n_SHG"],
+                           theta = np.radians(values["θ (deg)"]),
+                           lda = values["lam"],
+                           empty = empty)
+
+    def __init__(self, parent, parentframe,  compid = 0, location = (0,0)):
         self.input = {"lam": tk.DoubleVar(value = 972E-9), # Wavelength
                       "l_focus": tk.DoubleVar(value=61.6E-3), # Distance from waist
                       "l_free": tk.DoubleVar(value=69.3E-3), # Distance from waist
@@ -71,9 +118,13 @@ class RibbonCavity(GUI_OptLineProto):
                       "n_SHG": tk.DoubleVar(value=1.567), # Refractive index of SHG crystal
                       "θ (deg)": tk.DoubleVar(value=10), # R mirror Incidence angle
                       "x_offset": tk.DoubleVar(value=0)} # Refractive index
-        super().__init__(parent, parentframe, compid, location, inputDict=self.input, DEBUG = DEBUG)
+        super().__init__(parent, parentframe, compid, location, inputDict=self.input)
         self.inputframe["text"] = "Cavity parameters"
         self.add_button.destroy()
+        # Stability readout below the cavity parameters
+        self.status = ttk.Label(self.inputframe, text="")
+        self.status.grid(row=len(self.input)//2+1, column=0, columnspan=4, padx=5)
+        self.modes = None
 
         # Extra variables for the ribbon cavity
         self.matrices = None
@@ -87,33 +138,21 @@ class RibbonCavity(GUI_OptLineProto):
         else:
             self.inputframe.grid()
 
-    def calcqs(self):
-        """Override default q calculation, based on the cavityq function"""
-        whor = cavityq(self.horABCD)
-        wver = cavityq(self.verABCD)
-
-        self.qhor = whor*1j
-        self.qver = wver*1j
-
-    def buildMatrixList(self):
-        """Override default Matrixlist building to handle the ringCavity format"""
-        self.matrices = ringCavity(l_focus = self.input["l_focus"].get(),
-                                   # Distance between curved focus mirrors
-                                   l_free = self.input["l_free"].get(),
-                                   # Free arm length (l_cav-l_focus)
-                                   l_crystal = self.input["l_crystal"].get(),
-                                   # SHG crystal length
-                                   R = self.input["R_foc"].get(),
-                                   # Curvature radius of curved mirrors
-                                   n_crystal = self.input["n_SHG"].get(),
-                                   # Refractive index of SHG crystal
-                                   theta = radians(self.input["θ (deg)"].get())
-                                   # Angle of incidence on curved mirrors
-                                  )
-        self.matrices_hor = buildMatrixList(self.matrices["hor"])
-        self.matrices_ver = buildMatrixList(self.matrices["ver"])
-        self.horABCD = compositeABCD(self.matrices_hor)
-        self.verABCD = compositeABCD(self.matrices_ver)
+    def show_result(self, model, plotdata, adaptive = False, tol = 1E-3):
+        """Show the eigenmode stability of the computed cavity next to the plot data"""
+        self.modes = model.modes
+        self.matrices = model.matrices
+        self.horABCD = model.horABCD
+        self.verABCD = model.verABCD
+        self.status["text"] = cavitystatus(self.modes)
+        return super().show_result(model, plotdata, adaptive, tol)
+
+    def update_options(self):
+        """Mark unstable cavities in the plot legend"""
+        super().update_options()
+        for horver in ("hor", "ver"):
+            if self.modes is not None and not self.modes[horver]["stable"]:
+                self.plotoptions[horver]["title"] += " (unstable)"
 
 def test():
     """Test function to run the RibbonCavity class"""
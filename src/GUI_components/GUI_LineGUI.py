@@ -2,22 +2,31 @@
 define the GUI elements for holding an optical line and a collection of optical 
 lines, respectively. Optical line types to be used are imported into GUI_elems."""
 
+import logging
 import tkinter as tk
 from tkinter import ttk
 
 # format depends on whether this is run as a script or imported as a module
 if __name__ == "__main__":
     from raycalc.matrices import matrixdicts    # pylint: disable=import-error
+    from raycalc.model import SystemModel       # pylint: disable=import-error
+    from raycalc import parallel                # pylint: disable=import-error
+    from raycalc.tracecache import TraceCache   # pylint: disable=import-error
+    from GUI_OptLineProto import bindvar        # pylint: disable=import-error
     from GUI_OpticalLine import OpticalLine     # pylint: disable=import-error
     from GUI_Cavities import RibbonCavity, LinCavity       # pylint: disable=import-error
     from GUI_ScatterPlot import ScatterPlot     # pylint: disable=import-error
 else:
     from .raycalc.matrices import matrixdicts
+    from .raycalc.model import SystemModel
+    from .raycalc import parallel
+    from .raycalc.tracecache import TraceCache
+    from .GUI_OptLineProto import bindvar
     from .GUI_OpticalLine import OpticalLine
     from .GUI_Cavities import RibbonCavity, LinCavity
     from .GUI_ScatterPlot import ScatterPlot 
 
-debug = False
+log = logging.getLogger(__name__)
 
 GUI_elems = {"Optical Line": OpticalLine, "Ring Cavity": RibbonCavity, "Linear Cavity": LinCavity, "Scatter": ScatterPlot}
 
@@ -84,13 +93,14 @@ class LineItem:
 
     def remove_fields(self):
         """Wipe old UI elements to replace with new"""
+        # The worker caches and shared sample buffers of the old line go with it
+        parallel.release(self.item.model.key)
         self.item.frame.destroy()
         del self.item
 
     def update_fields(self):
         """Update the fields for the optical line to a new configuration"""
-        if debug:
-            print("Updating fields")
+        log.debug("Updating fields")
         self.remove_fields()
         self.init_fields()
 
@@ -104,8 +114,7 @@ class LineItem:
 
     def remove(self):
         """Remove the line item from the parent"""
-        if debug:
-            print(f"Removing {self.compid}")
+        log.debug("Removing %s", self.compid)
         self.parent.destroyLineParam(self.compid)
 
 
@@ -116,20 +125,19 @@ class LineItem:
     def get_ABCD(self):# pylint: disable=invalid-name
         """Return the ABCD matrix for the current optical line"""
         self.func = matrixdicts[self.get_function()]["func"]
-        if debug:
-            print(self.func)
+        log.debug("Function: %s", self.func)
         matrixparams = {key: self.fields[f"val{i}"].get()
                         for i, key in enumerate(matrixdicts[self.get_function()]["params"])}
         matrixparams["func"] = self.func
         ABCD = matrixparams #pylint: disable=invalid-name
-        if debug:
-            print(ABCD)
+        log.debug("Matrix parameters: %s", ABCD)
         return ABCD
 
-    def replot(self, n = 1000):
+    def replot(self, n = 1000, adaptive = False, tol = 1E-3, cache = None, store = False):
         """Replot the optical line"""
         # Implemented in child classes
-        return self.item.replot(n)
+        return self.item.replot(n, adaptive = adaptive, tol = tol, cache = cache,
+                                store = store)
 
     def savestate(self):
         """Save current state in dict for loading"""
@@ -188,7 +196,8 @@ class LineGUI:
         self.showhide_button.grid(row=0, column=2, padx=5)
 
         # Replot button
-        self.replot_button = ttk.Button(self.button_frame, text="Replot", command=self.replot)
+        self.replot_button = ttk.Button(self.button_frame, text="Replot",
+                                        command=self.request_replot)
         self.replot_button.grid(row=1, column=2, padx=5)
         ### END BUTTON FRAME ###
 
@@ -198,15 +207,47 @@ class LineGUI:
         self.inputframe.columnconfigure(0, weight=1)
         self.inputframe.rowconfigure(0, weight=1)
 
+        # Headless state of all lines and the sampling settings
+        self.model = SystemModel()
+
         self.samples = tk.IntVar(value=1000)
+        bindvar(self.samples, lambda value: setattr(self.model, "samples", value))
         self.samples_label = ttk.Label(self.inputframe, text="Samples per interval")
         self.samples_label.grid(row=0, column=0, padx=5)
         self.samples_entry = ttk.Entry(self.inputframe, textvariable=self.samples)
         self.samples_entry.grid(row=0, column=1, padx=5)
+        # Adaptive sampling, samples per interval then sets the average point budget
+        self.adaptive = tk.IntVar(value=0)
+        self.adaptive_check = ttk.Checkbutton(self.inputframe,
+                                              text="Adaptive sampling",
+                                              variable=self.adaptive)
+        bindvar(self.adaptive, lambda value: setattr(self.model, "adaptive", bool(value)))
+        self.adaptive_check.grid(row=1, column=0, padx=5)
+        # Compute the lines in parallel worker processes
+        self.parallel = tk.IntVar(value=0)
+        self.parallel_check = ttk.Checkbutton(self.inputframe,
+                                              text="Parallel lines",
+                                              variable=self.parallel)
+        bindvar(self.parallel, lambda value: setattr(self.model, "parallel", bool(value)))
+        self.parallel_check.grid(row=1, column=1, padx=5)
+        self.tolerance = tk.DoubleVar(value=1E-3)
+        bindvar(self.tolerance, lambda value: setattr(self.model, "tolerance", value))
+        self.tolerance_label = ttk.Label(self.inputframe, text="Adaptive tolerance (rel.)")
+        self.tolerance_label.grid(row=2, column=0, padx=5)
+        self.tolerance_entry = ttk.Entry(self.inputframe, textvariable=self.tolerance)
+        self.tolerance_entry.grid(row=2, column=1, padx=5)
+        # Keep the computed traces in an on-disk cache, reopened designs are memory-mapped
+        self.diskcache = tk.IntVar(value=0)
+        self.diskcache_check = ttk.Checkbutton(self.inputframe,
+                                               text="Disk cache",
+                                               variable=self.diskcache)
+        bindvar(self.diskcache,
+                lambda value: setattr(self.model, "cache", TraceCache() if value else None))
+        self.diskcache_check.grid(row=3, column=0, padx=5)
         # (Z = 0, ZR = 0, lam = 0, W = 0, n = 1)
         self.input = {} # List of inputs, example: "Samples": tk.IntVar(value=1000)
         self.input_widgets = {}
-        i = 1
+        i = 4
         for key in self.input: # pylint: disable=consider-using-dict-items
             self.input_widgets[key] = ttk.Label(self.inputframe, text=key)
             self.input_widgets[key].grid(row=i, column=0, padx=5)
@@ -243,6 +284,7 @@ class LineGUI:
     def destroyLineParam(self, compid):
         """Destroy the optical line component with the given id"""
         line = self.opticalLines.pop(compid)
+        line.remove_fields()
         line.frame.destroy()
         del line
         # Renumber and reposition the parameters
@@ -271,24 +313,56 @@ class LineGUI:
                 self.colorid = 0
         return color
 
+    def syncmodel(self):
+        """Point the system model to the models of the current optical lines"""
+        self.model.lines = [optLine.item.model for optLine in self.opticalLines]
+        return self.model
+
+    def request_replot(self):
+        """Replot button: the App computes a snapshot in its worker thread. Computing the
+        live models here would race with that worker, both share the BeamTrace caches"""
+        if hasattr(self.parent, "update_plot"):
+            self.parent.update_plot(store = True)
+        else:
+            self.replot()
+
     def replot(self):
-        """Replot the optical lines"""
+        """Replot the optical lines, an explicit replot: missing traces go to the disk cache"""
+        self.syncmodel()
+        if self.model.parallel:
+            # Worker processes compute a snapshot, the results go to the line widgets
+            system = self.model.snapshot()
+            return self.show_results(system, system.compute(store = True))
         plotdata = {}
         i = 0
         for optLine in self.opticalLines:
-            plotdata[i] = optLine.replot(n = self.samples.get())
+            plotdata[i] = optLine.replot(n = self.model.samples,
+                                         adaptive = self.model.adaptive,
+                                         tol = self.model.tolerance,
+                                         cache = self.model.cache,
+                                         store = True)
             i+=1
-        if debug:
-            print(f"Replot done in LineGUI, keys: {plotdata.keys()}")
-        if debug:
-            print(f"Replot done in LineGUI, values: {plotdata[0].keys()}")
+        log.debug("Replot done in LineGUI, keys: %s", plotdata.keys())
         return plotdata
 
+    def show_results(self, system, plotdata):
+        """Hand the results of a computed snapshot of self.model to the line widgets.
+           Returns the plot data like replot, None if the lines changed in the meantime"""
+        items = [optLine.item for optLine in self.opticalLines]
+        if [item.model for item in items] != system.origins:
+            return None
+        return {i: item.show_result(line, plotdata[i], system.adaptive, system.tolerance)
+                for i, (item, line) in enumerate(zip(items, system.lines))}
+
     def savestate(self):
         """Save the current state of the GUI in a dict"""
         state = {}
         state["input"] = {}
         state["Samples"] = self.samples.get()
+        state["Adaptive"] = self.adaptive.get()
+        state["Tolerance"] = self.tolerance.get()
+        state["Parallel"] = self.parallel.get()
+        state["DiskCache"] = self.diskcache.get()
         for key in self.input: # pylint: disable=consider-using-dict-items
             state["input"][key] = self.input[key].get()
         state["opticalLines"] = [optLine.savestate() for optLine in self.opticalLines]
@@ -302,6 +376,14 @@ class LineGUI:
                 self.destroyLineParam(0)
         # Set samples and input parameters
         self.samples.set(state["Samples"])
+        # Older savestates predate adaptive sampling
+        if "Adaptive" in state:
+            self.adaptive.set(state["Adaptive"])
+            self.tolerance.set(state["Tolerance"])
+        if "Parallel" in state:
+            self.parallel.set(state["Parallel"])
+        if "DiskCache" in state:
+            self.diskcache.set(state["DiskCache"])
         for key in state["input"]:
             self.input[key].set(state["input"][key])
         # Load optical lines
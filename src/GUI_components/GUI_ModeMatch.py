@@ -0,0 +1,260 @@
+#pylint: disable=invalid-name
+"""Implements the ModeMatch class, a window coupling an optical line into a cavity mode.
+"Optimize" tunes the chosen component parameters of the line within bounds so its
+output beam matches the cavity mode (raycalc.modematch.optimizeLine), "Apply" writes a
+found design into the line. "Lock cavity" moves the cavity (its x offset) to the
+position on the line where its mode couples best (bestCavityPosition).
+The searches run off the tkinter thread on snapshots of the models."""
+
+import threading
+import queue
+import tkinter as tk
+from tkinter import ttk
+import numpy as np
+
+# Import format depends on whether this is run as a script or imported as a module
+if __name__ == "__main__":
+    from raycalc.matrices import matrixdicts                                # pylint: disable=import-error
+    from raycalc.matrixcalc import BeamTrace                                # pylint: disable=import-error
+    from raycalc.model import LineModel, CavityModel                        # pylint: disable=import-error
+    from raycalc.modematch import optimizeLine, bestCavityPosition          # pylint: disable=import-error
+else:
+    from .raycalc.matrices import matrixdicts
+    from .raycalc.matrixcalc import BeamTrace
+    from .raycalc.model import LineModel, CavityModel
+    from .raycalc.modematch import optimizeLine, bestCavityPosition
+
+# Number of designs listed after an optimisation
+DESIGNS = 5
+
+def cavitymode(cavity):
+    """{"hor": q, "ver": q} of the eigenmode of a cavity model at its reference plane"""
+    cavity = cavity.snapshot()
+    cavity.buildMatrixList()
+    cavity.calcqs()
+    return {"hor": cavity.qhor, "ver": cavity.qver}
+
+def linetraces(line):
+    """Unsampled hor/ver BeamTraces of a line model, the segment tables answer q_at"""
+    line = line.snapshot()
+    line.buildMatrixList()
+    line.calcqs()
+    return {"hor": BeamTrace(line.matrices_hor, line.qhor, lda = line.inputs["lam"]),
+            "ver": BeamTrace(line.matrices_ver, line.qver, lda = line.inputs["lam"])}
+
+class ModeMatch:
+    """Mode matching window for the optical lines and cavities in a LineGUI"""
+    def __init__(self, parent, lineslist):
+        """parent: the App, needs update_plot and ModeMatchWindow
+        lineslist: the LineGUI holding the optical lines"""
+        self.parent = parent
+        self.lineslist = lineslist
+        self.root = tk.Toplevel()
+        self.root.title("Mode matching")
+        self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
+
+        # Results from the worker thread, tagged with the request generation
+        self.results = queue.Queue()
+        self.generation = 0
+        self.worker = None
+        self.line = None
+        self.cavity = None
+        # Found designs of the listed results and the line they belong to
+        self.designs = []
+        self.designline = None
+
+        self.linenames = {}
+        self.linesel = ttk.Combobox(self.root)
+        self.linesel.bind("<<ComboboxSelected>>", lambda event: self.select_line())
+        ttk.Label(self.root, text="Optical line").grid(row=0, column=0, padx=5)
+        self.linesel.grid(row=0, column=1, columnspan=3, padx=5, sticky="ew")
+
+        self.cavitynames = {}
+        self.cavitysel = ttk.Combobox(self.root)
+        ttk.Label(self.root, text="Cavity").grid(row=1, column=0, padx=5)
+        self.cavitysel.grid(row=1, column=1, columnspan=3, padx=5, sticky="ew")
+
+        # Free parameters: tick, lower and upper bound per component parameter
+        self.paramframe = ttk.LabelFrame(self.root, text="Free parameters (min, max)")
+        self.paramframe.grid(row=2, column=0, columnspan=4, padx=5, pady=5, sticky="news")
+        self.params = {}
+
+        self.optimize_button = ttk.Button(self.root, text="Optimize", command=self.optimize)
+        self.optimize_button.grid(row=3, column=0, padx=5, pady=5)
+        self.apply_button = ttk.Button(self.root, text="Apply", command=self.apply)
+        self.apply_button.grid(row=3, column=1, padx=5, pady=5)
+        self.lock_button = ttk.Button(self.root, text="Lock cavity", command=self.lock)
+        self.lock_button.grid(row=3, column=2, padx=5, pady=5)
+
+        self.designlist = tk.Listbox(self.root, height=DESIGNS, width=60)
+        self.designlist.grid(row=4, column=0, columnspan=4, padx=5, pady=5, sticky="news")
+        self.status = ttk.Label(self.root, text="Optimize: the cavity mode plane sits at the "
+                                                "end of the line")
+        self.status.grid(row=5, column=0, columnspan=4, padx=5)
+
+        self.refresh_lines()
+
+    def refresh_lines(self):
+        """Fill the selectors with the optical lines and the cavities of the LineGUI"""
+        self.linenames = {}
+        self.cavitynames = {}
+        for i, optLine in enumerate(self.lineslist.opticalLines):
+            item = optLine.item
+            if isinstance(item.model, CavityModel):
+                self.cavitynames[f"{i}: {item.name.get()}"] = item
+            elif type(item.model) is LineModel: # pylint: disable=unidiomatic-typecheck
+                self.linenames[f"{i}: {item.name.get()}"] = item
+        self.linesel["values"] = list(self.linenames)
+        self.cavitysel["values"] = list(self.cavitynames)
+        if self.cavitynames:
+            self.cavitysel.current(0)
+        if self.linenames:
+            self.linesel.current(0)
+            self.select_line()
+        if not self.linenames or not self.cavitynames:
+            self.status["text"] = "Needs an optical line and a cavity"
+
+    def select_line(self):
+        """List the component parameters of the selected line as free parameter choices"""
+        self.line = self.linenames[self.linesel.get()]
+        for widget in self.paramframe.winfo_children():
+            widget.destroy()
+        self.params = {}
+        for index, param in enumerate(self.line.parameters):
+            func = param.get_function()
+            for i, name in enumerate(matrixdicts[func]["params"]):
+                value = param.fields[i]["val"].get()
+                # Free space lengths may go down to zero, other parameters keep their sign
+                lower, upper = (0, 2*value) if func == "free" else (0.5*value, 1.5*value)
+                entry = {"free": tk.IntVar(value=0),
+                         "min": tk.DoubleVar(value=round(min(lower, upper), 6)),
+                         "max": tk.DoubleVar(value=round(max(lower, upper), 6))}
+                row = len(self.params)
+                ttk.Checkbutton(self.paramframe, text=f"{index}: {func} {name}",
+                                variable=entry["free"]).grid(row=row, column=0, padx=5,
+                                                              sticky="w")
+                ttk.Entry(self.paramframe, width=10,
+                          textvariable=entry["min"]).grid(row=row, column=1, padx=5)
+                ttk.Entry(self.paramframe, width=10,
+                          textvariable=entry["max"]).grid(row=row, column=2, padx=5)
+                self.params[(index, name)] = entry
+
+    def start(self, work, *args):
+        """Run work(*args, generation) in a worker thread, a newer request supersedes it"""
+        if not self.linenames or not self.cavitynames:
+            return
+        self.generation += 1
+        self.status["text"] = "Computing..."
+        self.worker = threading.Thread(target=work, args=args + (self.generation,),
+                                       daemon=True)
+        self.worker.start()
+        self.root.after(50, self.poll)
+
+    def optimize(self):
+        """Search designs of the selected line for the selected cavity"""
+        self.cavity = self.cavitynames.get(self.cavitysel.get())
+        if self.line is None or self.cavity is None:
+            return
+        freeparams = [(index, name, entry["min"].get(), entry["max"].get())
+                      for (index, name), entry in self.params.items() if entry["free"].get()]
+        if not freeparams:
+            self.status["text"] = "Tick the parameters to tune"
+            return
+        # Read from tkinter here, the worker only sees plain data and model snapshots
+        self.start(self.work_optimize, self.line, self.line.linedescription(),
+                   self.cavity.model.snapshot(), freeparams)
+
+    def work_optimize(self, line, description, cavity, freeparams, generation):
+        """Worker thread: run the optimiser"""
+        try:
+            cavityq = cavitymode(cavity)
+            if not np.all(np.isfinite([cavityq["hor"], cavityq["ver"]])):
+                raise ValueError("the cavity is not stable")
+            designs = optimizeLine(description["components"], freeparams,
+                                   description["qin"], cavityq, keep = DESIGNS)
+        except Exception as e: #pylint: disable=broad-except
+            designs = e
+        self.results.put((generation, "designs", line, designs))
+
+    def lock(self):
+        """Place the selected cavity where its mode couples best into the selected line"""
+        self.cavity = self.cavitynames.get(self.cavitysel.get())
+        if self.line is None or self.cavity is None:
+            return
+        self.start(self.work_lock, self.cavity, self.line.model.snapshot(),
+                   self.cavity.model.snapshot())
+
+    def work_lock(self, cavitywidget, line, cavity, generation):
+        """Worker thread: best cavity position on the line, in plot coordinates"""
+        try:
+            cavityq = cavitymode(cavity)
+            if not np.all(np.isfinite([cavityq["hor"], cavityq["ver"]])):
+                raise ValueError("the cavity is not stable")
+            traces = linetraces(line)
+            length = float(np.sum(traces["hor"].seg_length))
+            z, eta = bestCavityPosition(traces, cavityq, 0, length)
+            result = (cavitywidget, z + line.inputs.get("x_offset", 0), eta)
+        except Exception as e: #pylint: disable=broad-except
+            result = e
+        self.results.put((generation, "lock", line, result))
+
+    def poll(self):
+        """Pick up finished searches, runs on the tkinter thread"""
+        # Checked before draining, a worker that is done has put its result already
+        alive = self.worker is not None and self.worker.is_alive()
+        try:
+            while True:
+                generation, kind, line, result = self.results.get_nowait()
+                if generation != self.generation:
+                    continue
+                if isinstance(result, Exception):
+                    self.status["text"] = f"Error: {result}"
+                elif kind == "designs":
+                    self.show_designs(line, result)
+                else:
+                    cavitywidget, z, eta = result
+                    cavitywidget.input["x_offset"].set(round(z, 9))
+                    self.status["text"] = f"Cavity locked at {z*1E3:.3f} mm, " \
+                                          f"coupling {eta*100:.2f} %"
+                    self.replot()
+        except queue.Empty:
+            pass
+        if alive:
+            self.root.after(50, self.poll)
+
+    def show_designs(self, line, designs):
+        """List the found designs, best first"""
+        self.designs = designs
+        self.designline = line
+        self.designlist.delete(0, tk.END)
+        for design in designs:
+            values = ", ".join(f"{index}: {name} = {value:.6g}"
+                               for (index, name), value in design["params"].items())
+            self.designlist.insert(tk.END, f"{design['coupling']*100:.2f} %   {values}")
+        if designs:
+            self.designlist.selection_set(0)
+        self.status["text"] = f"{len(designs)} designs found"
+
+    def apply(self):
+        """Write the selected design into the components of its line"""
+        selection = self.designlist.curselection()
+        if not selection or self.designline not in [optLine.item for optLine
+                                                    in self.lineslist.opticalLines]:
+            return
+        for (index, name), value in self.designs[selection[0]]["params"].items():
+            param = self.designline.parameters[index]
+            field = matrixdicts[param.get_function()]["params"].index(name)
+            param.fields[field]["val"].set(round(float(value), 9))
+        self.replot()
+
+    def replot(self):
+        """Show the changed line or cavity in the main plot"""
+        if hasattr(self.parent, "update_plot"):
+            self.parent.update_plot(store = True)
+
+    def on_closing(self):
+        """Close the window and drop the reference in the parent"""
+        self.generation += 1 # Let a running worker finish without reporting back
+        if hasattr(self.parent, "ModeMatchWindow"):
+            self.parent.ModeMatchWindow = None
+        self.root.destroy()
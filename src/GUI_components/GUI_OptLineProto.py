@@ -2,36 +2,134 @@
 Define the class prototype for Optical line implements in the GUI.
 """
 
+import logging
 import tkinter as tk
 from tkinter import ttk
 
+log = logging.getLogger(__name__)
+
 # Import the GUI component prototypes and init functions
 # format depends on whether this is run as a script for testing or imported as a module
 if __name__ == "__main__":
-    from raycalc.matrices import matrixdicts, GUI_matrix # pylint: disable=import-error
-    from raycalc.matrixcalc import BeamTrace, calcq      # pylint: disable=import-error
-    from GUI_PlotOptions import PlotOptions              # pylint: disable=import-error
+    from raycalc.matrices import matrixdicts                 # pylint: disable=import-error
+    from raycalc.model import ComponentModel, LineModel      # pylint: disable=import-error
+    from GUI_PlotOptions import PlotOptions                  # pylint: disable=import-error
 else:
     try:
-        from .raycalc.matrices import matrixdicts, GUI_matrix
-        from .raycalc.matrixcalc import BeamTrace, calcq
+        from .raycalc.matrices import matrixdicts
+        from .raycalc.model import ComponentModel, LineModel
         from .GUI_PlotOptions import PlotOptions
     except ImportError:
-        print("ImportError, retrying without relative import")
-        from raycalc.matrices import matrixdicts, GUI_matrix
-        from raycalc.matrixcalc import BeamTrace, calcq
+        log.info("ImportError, retrying without relative import")
+        from raycalc.matrices import matrixdicts
+        from raycalc.model import ComponentModel, LineModel
         from GUI_PlotOptions import PlotOptions
-        print("Import successful")
+        log.info("Import successful")
+
+# Called without arguments after every edit pushed into a model, e.g. the App's live replot
+listeners = []
+
+def bindvar(var, setter):
+    """Push the value of a tkinter variable into the model through setter, now and on
+       every edit. Incomplete entries (e.g. an empty field while typing) are skipped,
+       the model keeps the last valid value"""
+    def push(*args): # pylint: disable=unused-argument
+        try:
+            value = var.get()
+        except (tk.TclError, ValueError):
+            return
+        setter(value)
+        for listener in listeners:
+            listener()
+    var.trace_add("write", push)
+    push()
+
+# Slider held with a mouse button, edits made meanwhile are previews and not full replots.
+# Set on press and cleared on release, focus loss or close, keyboard steps never set it
+dragging = None
+# Called as listener(slider, state) with state "open", "drag" or "rest" (released)
+sliderlisteners = []
+
+class FieldSlider:
+    """Popup slider for a numeric input field, opened by right clicking the field.
+    The slider snaps to steps+1 values within +-span of the value it was opened at,
+    so previews of the positions can be computed in advance.
+    owner: the optical line widget whose model holds the value
+    setter: setter(line model, value) applies a value to a copy of the owner's model"""
+    def __init__(self, entry, var, owner, setter, title = "Slider", steps = 100, span = 0.5):
+        self.var = var
+        self.owner = owner
+        self.setter = setter
+        center = var.get()
+        low, high = sorted((center*(1-span), center*(1+span))) if center != 0 else (-1, 1)
+        self.values = [low + (high-low)*i/steps for i in range(steps+1)]
+        self.position = steps//2
+        self.values[self.position] = center
+
+        self.window = tk.Toplevel(entry)
+        self.window.title(title)
+        self.window.geometry(f"+{entry.winfo_rootx()}+{entry.winfo_rooty()+entry.winfo_height()}")
+        self.window.protocol("WM_DELETE_WINDOW", self.close)
+        self.scale = ttk.Scale(self.window, from_=0, to=steps, orient=tk.HORIZONTAL,
+                               length=300, command=self.moved)
+        self.scale.set(self.position)
+        self.scale.grid(row=0, column=0, columnspan=2, padx=5, pady=5)
+        self.scale.bind("<ButtonPress>", self.pressed)
+        self.scale.bind("<ButtonRelease>", self.released)
+        self.scale.bind("<FocusOut>", self.released)
+        ttk.Label(self.window, text=f"{low:.4g}").grid(row=1, column=0, sticky="w", padx=5)
+        ttk.Label(self.window, text=f"{high:.4g}").grid(row=1, column=1, sticky="e", padx=5)
+        for listener in sliderlisteners:
+            listener(self, "open")
+
+    def around(self, width = 10):
+        """Slider values within width steps of the current position"""
+        return self.values[max(self.position-width, 0):self.position+width+1]
+
+    def pressed(self, event): # pylint: disable=unused-argument
+        """Mouse button down on the slider, moves from now on are previews"""
+        global dragging # pylint: disable=global-statement
+        dragging = self
+
+    def moved(self, position):
+        """Slider moved: write the snapped value. Listeners show a preview while the
+        slider is dragged, a keyboard step is a finished edit"""
+        position = int(round(float(position)))
+        if position == self.position:
+            return
+        self.position = position
+        self.var.set(self.values[position])
+        state = "drag" if dragging is self else "rest"
+        for listener in sliderlisteners:
+            listener(self, state)
+
+    def released(self, event = None): # pylint: disable=unused-argument
+        """Slider resting: listeners compute the full resolution trace"""
+        global dragging # pylint: disable=global-statement
+        if dragging is not self:
+            return
+        dragging = None
+        for listener in sliderlisteners:
+            listener(self, "rest")
+
+    def close(self):
+        """Close the slider window, a drag in progress ends here"""
+        self.released()
+        self.window.destroy()
 
 class LineParameter:
     """tkinter widget for a single optical beamline parameter"""
-    def __init__(self, parent, parentframe: ttk.Frame, compid = 0, DEBUG = False):
+    def __init__(self, parent, parentframe: ttk.Frame, compid = 0):
         self.parent = parent
         self.compid = compid
-        self.DEBUG = DEBUG
+
+        # Headless state of the component, the widgets push their edits into it
+        self.model = ComponentModel()
 
         self.hor = tk.IntVar(value=1)
         self.ver = tk.IntVar(value=1)
+        bindvar(self.hor, lambda value: setattr(self.model, "hor", value))
+        bindvar(self.ver, lambda value: setattr(self.model, "ver", value))
 
         self.frame = ttk.LabelFrame(parentframe, text=f"Component {self.compid}", relief=tk.RIDGE)
         self.frame.grid(row=self.compid, column=0, pady=5, sticky="news")
@@ -61,14 +159,26 @@ class LineParameter:
 
     def init_fields(self):
         """Initialise the default input fields for the component"""
+        self.model.func = self.get_function()
+        self.model.params = {}
         i = 0
         for param in matrixdicts[self.get_function()]["params"]:
             self.fields[i] = {}
             self.fields[i]["label"] = ttk.Label(self.frame, text=param)
             self.fields[i]["label"].grid(row=i+1, column=0, padx=5)
             self.fields[i]["val"] = tk.DoubleVar(value=1)
+            bindvar(self.fields[i]["val"],
+                    lambda value, param=param: self.model.params.__setitem__(param, value))
             self.fields[i]["elem"] = ttk.Entry(self.frame, textvariable=self.fields[i]["val"])
             self.fields[i]["elem"].grid(row=i+1, column=1, padx=5)
+            # Right click opens a slider for tuning the value
+            self.fields[i]["elem"].bind("<Button-3>",
+                lambda event, i=i, param=param: FieldSlider(
+                    self.fields[i]["elem"], self.fields[i]["val"], self.parent,
+                    lambda line, value, param=param:
+                        line.components[self.parent.parameters.index(self)].params.__setitem__(
+                            param, value),
+                    title = param))
             i += 1
 
         horver = matrixdicts[self.get_function()]["horver"]
@@ -88,28 +198,23 @@ class LineParameter:
     def remove_fields(self):
         """Remove the input fields for the component"""
         # Wipe old UI elements to replace with new
-        if self.DEBUG:
-            print("Removing fields")
+        log.debug("Removing fields")
         for i in list(self.fields):
             for key in list(self.fields[i]):
                 if type(self.fields[i][key]) in [ttk.Label, ttk.Entry, ttk.Checkbutton]:
-                    if self.DEBUG:
-                        print(f"Destroying {key}")
+                    log.debug("Destroying %s", key)
                     self.fields[i][key].destroy()
                 del self.fields[i][key]
-        if self.DEBUG:
-            print("Removing horverchecks")
+        log.debug("Removing horverchecks")
         for key in list(self.horverchecks):
             if type(self.horverchecks[key]) in [ttk.Checkbutton]:
-                if self.DEBUG:
-                    print(f"Destroying {key}")
+                log.debug("Destroying %s", key)
                 self.horverchecks[key].destroy()
             del self.horverchecks[key]
 
     def update_fields(self):
         """Update the input fields for the component upon selection of a new component type"""
-        if self.DEBUG:
-            print("Updating fields")
+        log.debug("Updating fields")
         self.remove_fields()
         self.init_fields()
 
@@ -123,34 +228,27 @@ class LineParameter:
         """Get the current function selected in the combobox"""
         return self.component.get()
 
+    def get_params(self):
+        """Return the component parameters in the GUI_matrix format"""
+        return self.model.get_params()
+
     def calc_ABCD(self): # pylint: disable=invalid-name
         """Calculate the ABCD matrices for the component"""
         self.func = matrixdicts[self.get_function()]["func"]
 
-        matrixparams = {}
-        matrixparams["func"] = self.component.get()
-        for key in self.fields: # pylint: disable=consider-using-dict-items
-            param = self.fields[key]["label"]["text"]
-            matrixparams[param] = self.fields[key]["val"].get()
-
-        matrixparams["hor"] = self.hor.get()
-        matrixparams["ver"] = self.ver.get()
-
         # A bit dirty, should be redone when the matrixcalc functions are rewritten.
         try:
-            ABCD = GUI_matrix(matrixparams) # pylint: disable=invalid-name
+            ABCD = self.model.matrices() # pylint: disable=invalid-name
             self.ABCDhor = ABCD["hor"]
             self.ABCDver = ABCD["ver"]
 
         except Exception as e: #pylint: disable=broad-except
-            print("Error in calc_ABCD:",e)
+            log.error("Error in calc_ABCD: %s", e)
             self.ABCDhor = None
             self.ABCDver = None
 
-        if self.DEBUG:
-            print(f"Matrices in component {self.compid}:\n\
-                    ABCDhor: {self.ABCDhor}\n\
-                    ABCDver: {self.ABCDver}")
+        log.debug("Matrices in component %s:\nABCDhor: %s\nABCDver: %s",
+                  self.compid, self.ABCDhor, self.ABCDver)
 
         return (self.ABCDhor, self.ABCDver)
 
@@ -166,9 +264,7 @@ class LineParameter:
                 state["fields"][key] = self.fields[key]["val"].get()
             return state
         except Exception as e: #pylint: disable=broad-except
-            print("Error in savestate:",e)
-            print("State:",state)
-            print("Fields:",self.fields)
+            log.error("Error in savestate: %s\nState: %s\nFields: %s", e, state, self.fields)
 
     def loadstate(self, state):
         """Load a component state from a dictionary"""
@@ -176,25 +272,23 @@ class LineParameter:
         self.update_fields()
         self.hor.set(state["hor"])
         self.ver.set(state["ver"])
-        if self.DEBUG:
-            print(f"Loading state: {state}")
-            print(f"Fields: {self.fields}")
+        log.debug("Loading state: %s\nFields: %s", state, self.fields)
         for key in self.fields: #pylint: disable=consider-using-dict-items
-            if self.DEBUG:
-                print(f"Setting field {key} to {state['fields'][str(key)]}")
-                print(f"Field: {self.fields[key]['val']}")
+            log.debug("Setting field %s to %s", key, state["fields"][str(key)])
             self.fields[key]["val"].set(state["fields"][str(key)])
-            print(self.fields[key]["val"].get())
 
 class GUI_OptLineProto: # pylint: disable=invalid-name
-    """tkinter widget prototype for Optical Line style elements"""
+    """tkinter widget prototype for Optical Line style elements.
+    The calculations live in a headless raycalc.model object, the widget pushes edits into it"""
+    # Model class holding the state and calculations of this kind of line
+    modelclass = LineModel
+
     def __init__(self,
                  parent,
                  parentframe,
                  compid = 0,
                  location = (0,0),
-                 inputDict = None,
-                 DEBUG = False):
+                 inputDict = None):
         """Initialise the Optical Line widget
         parent: parent widget
         parentframe: parent frame to place the widget in
@@ -206,7 +300,6 @@ class GUI_OptLineProto: # pylint: disable=invalid-name
 
         self.parent = parent
         self.compid = compid
-        self.DEBUG = DEBUG
         self.frame = ttk.LabelFrame(parentframe, text = "Controls")
         self.frame.grid(row=location[0], column=location[1], pady=5, sticky="news")
         self.frame.columnconfigure(0, weight=1)
@@ -243,7 +336,10 @@ class GUI_OptLineProto: # pylint: disable=invalid-name
         self.button_frame.rowconfigure(0, weight=1)
         self.button_frame.rowconfigure(1, weight=1)
 
+        self.model = self.modelclass()
+
         self.name = tk.StringVar(value = "New Optical Line")
+        bindvar(self.name, lambda value: setattr(self.model, "name", value))
         self.namefield = ttk.Entry(self.button_frame, textvariable=self.name)
         self.namefield.grid(row=0, column=0, padx=5)
 
@@ -271,6 +367,8 @@ class GUI_OptLineProto: # pylint: disable=invalid-name
         # Set up references to hor and ver for convenience
         self.hor = self.plotoptions["hor"]["plot"]
         self.ver = self.plotoptions["ver"]["plot"]
+        bindvar(self.hor, lambda value: self.model.plot.__setitem__("hor", bool(value)))
+        bindvar(self.ver, lambda value: self.model.plot.__setitem__("ver", bool(value)))
 
         # Plot config button
         self.replot_button = ttk.Button(self.button_frame,
@@ -299,6 +397,9 @@ class GUI_OptLineProto: # pylint: disable=invalid-name
         else:
             self.input = inputDict
         self.input_widgets = {}
+        for key in self.input:
+            bindvar(self.input[key],
+                    lambda value, key=key: self.model.inputs.__setitem__(key, value))
         i = 0
         for key in self.input:
             self.input_widgets[key] = ttk.Label(self.inputframe, text=key)
@@ -306,6 +407,12 @@ class GUI_OptLineProto: # pylint: disable=invalid-name
             self.input_widgets[f"{key}_entry"] = ttk.Entry(self.inputframe,
                                                            textvariable=self.input[key])
             self.input_widgets[f"{key}_entry"].grid(row=int(i/2), column=2*(i%2)+1, padx=5)
+            # Right click opens a slider for tuning the value
+            self.input_widgets[f"{key}_entry"].bind("<Button-3>",
+                lambda event, key=key: FieldSlider(
+                    self.input_widgets[f"{key}_entry"], self.input[key], self,
+                    lambda line, value: line.inputs.__setitem__(key, value),
+                    title = key))
             i += 1
 
         ### END INPUT BEAM FRAME ###
@@ -319,12 +426,16 @@ class GUI_OptLineProto: # pylint: disable=invalid-name
         ### END COMPONENT FRAME ###
 
         ### Matrix calc variables ###
+        # Results of the last model computation, kept for inspection
         # Starting q values
         self.qhor = 0
         self.qver = 0
         # ABCD matrices for the optical line
         self.matrices_hor = []
         self.matrices_ver = []
+        # Sampling mode for the BeamTrace, set on replot
+        self.adaptive = False
+        self.tolerance = 1E-3
         # BeamTrace objects for the optical line
         # Will be initialized on first replot
         self.horline = None
@@ -338,14 +449,15 @@ class GUI_OptLineProto: # pylint: disable=invalid-name
         newcompid = len(self.parameters)
         new_parameter = LineParameter(parent = self,
                                       parentframe = self.componentframe,
-                                      compid = newcompid,
-                                      DEBUG = self.DEBUG)
+                                      compid = newcompid)
         self.parameters.append(new_parameter)
+        self.model.components.append(new_parameter.model)
         self.componentframe.rowconfigure(self.compid, weight=1)
 
     def destroyLineParam(self, compid):
         """Destroy a component in the optical line"""
         param = self.parameters.pop(compid)
+        self.model.components.pop(compid)
         param.frame.destroy()
         del param
         # Renumber the parameters
@@ -361,93 +473,54 @@ class GUI_OptLineProto: # pylint: disable=invalid-name
 
     def calcqs(self):
         """Calculate the q parameters for the optical line"""
-        self.qhor = calcq(Z = self.input["Zhor"].get(),
-                          ZR = self.input["ZRhor"].get(),
-                          lam = self.input["lam"].get(),
-                          W = self.input["Whor"].get(),
-                          n = self.input["n"].get())
-        self.qver = calcq(Z = self.input["Zver"].get(),
-                          ZR = self.input["ZRver"].get(),
-                          lam = self.input["lam"].get(),
-                          W = self.input["Wver"].get(),
-                          n = self.input["n"].get())
-        print(f"qhor: {self.qhor}, qver: {self.qver}")
-
-    def calculate_beamshape(self):
-        """Calculate the beam shape of the optical line"""
-        if self.DEBUG:
-            print(f"Calculating beam shape with {self.samples.get()} samples")
-
-        # Calculate qhor and qver
-        self.calcqs()
-
-        if self.plotoptions["hor"]["plot"].get():
-            if self.DEBUG:
-                print("Constructing Horizontal")
-            # Calculate the fundamental mode waists:
-            self.horline = BeamTrace(self.matrices_hor,
-                                     self.qhor,
-                                     n_points = self.samples.get(),
-                                     lda = self.input["lam"].get())
-            self.horline.constructRey()
-        if self.plotoptions["ver"]["plot"].get():
-            if self.DEBUG:
-                print("Constructing Vertical")
-            self.verline = BeamTrace(self.matrices_ver,
-                                        self.qver,
-                                        n_points = self.samples.get(),
-                                        lda = self.input["lam"].get())
-            self.verline.constructRey()
-        if self.DEBUG:
-            print("Beam shape calculated")
+        self.model.calcqs()
+        self.qhor = self.model.qhor
+        self.qver = self.model.qver
 
     def buildMatrixList(self):
-        """Fetch the ABCD matrices from the components and build the matrix list"""
-        self.matrices_hor = []
-        self.matrices_ver = []
-        for param in self.parameters:
-            hor, ver = param.calc_ABCD()
-            self.matrices_hor.append(hor)
-            self.matrices_ver.append(ver)
-        if self.DEBUG:
-            print(self.matrices_hor)
-            print(self.matrices_ver)
+        """Build the matrix lists of the optical line in the model"""
+        self.model.buildMatrixList()
+        self.matrices_hor = self.model.matrices_hor
+        self.matrices_ver = self.model.matrices_ver
+
+    def linedescription(self):
+        """Snapshot of the line for raycalc.modematch: component parameters and input q,
+           taken from a copy of the model, see GUI_ModeMatch"""
+        return self.model.snapshot().description()
 
     def update_options(self):
         """Update the plotoptions to current values before replotting"""
         self.plotoptions["hor"]["title"] = f"{self.name.get()} hor"
         self.plotoptions["ver"]["title"] = f"{self.name.get()} ver"
 
-    def replot(self, n = 1000):
-        """Replot the optical line"""
+    def replot(self, n = 1000, adaptive = False, tol = 1E-3, cache = None, store = False):
+        """Replot the optical line, adaptive and tol select the BeamTrace sampling mode,
+           cache is an optional tracecache.TraceCache, store writes missing traces to it"""
         self.samples.set(n)
-        self.buildMatrixList()
-        self.calculate_beamshape()
+        plotdata = self.model.compute(n = n, adaptive = adaptive, tol = tol, cache = cache,
+                                      store = store)
+        return self.show_result(self.model, plotdata, adaptive, tol)
+
+    def show_result(self, model, plotdata, adaptive = False, tol = 1E-3):
+        """Take over the results of a computed model (this line's model or a snapshot
+           of it) into the widget, returns the plot data with the plot options attached"""
+        self.adaptive = adaptive
+        self.tolerance = tol
+        self.qhor = model.qhor
+        self.qver = model.qver
+        self.matrices_hor = model.matrices_hor
+        self.matrices_ver = model.matrices_ver
+        self.horline = model.traces["hor"]
+        self.verline = model.traces["ver"]
         self.update_options()
-        self.plotdata = {}
-        if "x_offset" in self.input:
-            offset = self.input["x_offset"].get()
-        else:
-            offset = 0
-        if self.hor.get():
-            self.plotdata["hor"] = {}
-            # Check whether the x_offset parameter exists in current input
-            self.plotdata["hor"]["x"] = self.horline.xs + offset
-            self.plotdata["hor"]["w"] = self.horline.ws
-        if self.ver.get():
-            self.plotdata["ver"] = {}
-            self.plotdata["ver"]["x"] = self.verline.xs + offset
-            self.plotdata["ver"]["w"] = self.verline.ws
+        self.plotdata = dict(plotdata)
         self.plotdata["plotoptions"] = self.plotoptions
-        if self.DEBUG:
-            print(f"plotdata keys: {self.plotdata.keys()}")
-        if self.DEBUG:
-            print(f"plotdata: {self.plotdata}")
+        log.debug("plotdata: %s", self.plotdata)
         return self.plotdata
 
     def plotconfig(self):
         """Open the plot configuration window"""
-        print(self.PlotOptWindow)
+        log.debug("Plot options window: %s", self.PlotOptWindow)
         if self.PlotOptWindow is None:
             self.PlotOptWindow = PlotOptions(parent = self, plotoptions = self.plotoptions)
         else:
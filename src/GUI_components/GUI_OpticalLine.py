@@ -2,8 +2,11 @@
 """Implements the basic OpticalLine class, a class to handle the optical line GUI components.
 ATM a bit redundant as it is also the default of GUI_OptLineProto"""
 
+import logging
 import tkinter as tk
 
+log = logging.getLogger(__name__)
+
 # Import the GUI component prototypes and init functions
 # format depends on whether this is run as a script or imported as a module
 if __name__ == "__main__":
@@ -12,11 +15,9 @@ else:
     try:
         from .GUI_OptLineProto import GUI_OptLineProto
     except ImportError:
-        print("ImportError, retrying without relative import")
+        log.info("ImportError, retrying without relative import")
         from GUI_components.GUI_OptLineProto import GUI_OptLineProto
-        print("Import successful")
-
-debug = False
+        log.info("Import successful")
 
 class OpticalLine(GUI_OptLineProto):
     """Default optical beamline implementation"""
@@ -1,11 +1,14 @@
 """Implements the PlotOptions class, a class to handle 
 the plot options window for optical line plotting"""
 
+import logging
 import tkinter as tk
 from tkinter import ttk
 
 from tkinter import colorchooser
 
+log = logging.getLogger(__name__)
+
 class PlotOptions:
     """PlotOptions, a class to handle the plot options window. UNFINISHED"""
     # Init either in given parentframe or if not given, new top level window
@@ -81,7 +84,7 @@ class PlotOptions:
         """Close the window and set the plotoptions in the parent window"""
         if hasattr(self.parent, "setplotoptions"):
             self.parent.setplotoptions(self.plotoptions)
-        print(self.parent)
+        log.debug("Closing plot options of %s", self.parent)
         # Remove reference to the window in the parent when closing.
         if self.parent is not None:
             self.parent.PlotOptWindow = None
@@ -2,26 +2,29 @@
 """Implements the Scatterplot class, a class to handle test points for an optical line,
 e.g. manual waist measurement points for fitting."""
 
+import logging
 import tkinter as tk
 from tkinter import ttk
-import numpy as np
 
 # Import the GUI component prototypes and init functions
 # format depends on whether this is run as a script or imported as a module
 if __name__ == "__main__":
-    from GUI_OptLineProto import GUI_OptLineProto # pylint: disable=import-error
+    from GUI_OptLineProto import GUI_OptLineProto, bindvar # pylint: disable=import-error
+    from raycalc.model import ScatterModel                 # pylint: disable=import-error
 else:
-    from .GUI_OptLineProto import GUI_OptLineProto
+    from .GUI_OptLineProto import GUI_OptLineProto, bindvar
+    from .raycalc.model import ScatterModel
 
-debug = False
+log = logging.getLogger(__name__)
 
 class ScatterPoint:
     """A class to build the UI element to represent a single point on a scatter plot, offshoot of
     LineParameter from OptLineProto"""
-    def __init__(self, parent, parentframe: ttk.Frame, compid = 0, DEBUG = False):
+    def __init__(self, parent, parentframe: ttk.Frame, compid = 0):
         self.parent = parent
         self.compid = compid
-        self.DEBUG = DEBUG
+        # Headless state of the point, {"x": position, "hor": radius, "ver": radius}
+        self.model = {}
 
         self.hor = tk.IntVar(value=1)
         self.ver = tk.IntVar(value=1)
@@ -49,7 +52,7 @@ class ScatterPoint:
         self.init_fields()
 
         def dummy():
-            print("Dummy function")
+            log.debug("Dummy function")
         self.func = dummy
         self.ABCDhor = None
         self.ABCDver = None
@@ -62,6 +65,8 @@ class ScatterPoint:
             self.fields[i]["label"] = ttk.Label(self.frame, text=param)
             self.fields[i]["label"].grid(row=i+1, column=0, padx=5)
             self.fields[i]["val"] = tk.DoubleVar(value=1)
+            bindvar(self.fields[i]["val"],
+                    lambda value, param=param: self.model.__setitem__(param, value))
             self.fields[i]["elem"] = ttk.Entry(self.frame, textvariable=self.fields[i]["val"])
             self.fields[i]["elem"].grid(row=i+1, column=1, padx=5)
             i += 1
@@ -83,28 +88,23 @@ class ScatterPoint:
     def remove_fields(self):
         """Remove the input fields for the component"""
         # Wipe old UI elements to replace with new
-        if self.DEBUG:
-            print("Removing fields")
+        log.debug("Removing fields")
         for i in list(self.fields):
             for key in list(self.fields[i]):
                 if type(self.fields[i][key]) in [ttk.Label, ttk.Entry, ttk.Checkbutton]:
-                    if self.DEBUG:
-                        print(f"Destroying {key}")
+                    log.debug("Destroying %s", key)
                     self.fields[i][key].destroy()
                 del self.fields[i][key]
-        if self.DEBUG:
-            print("Removing horverchecks")
+        log.debug("Removing horverchecks")
         for key in list(self.horverchecks):
             if type(self.horverchecks[key]) in [ttk.Checkbutton]:
-                if self.DEBUG:
-                    print(f"Destroying {key}")
+                log.debug("Destroying %s", key)
                 self.horverchecks[key].destroy()
             del self.horverchecks[key]
 
     def update_fields(self):
         """Update the input fields for the component upon selection of a new component type"""
-        if self.DEBUG:
-            print("Updating fields")
+        log.debug("Updating fields")
         self.remove_fields()
         self.init_fields()
 
@@ -124,17 +124,7 @@ class ScatterPoint:
     
     def get_vals(self):
         """Get the current values of the component"""
-        vals = {}
-        vals["x"] = self.fields[0]["val"].get()
-        if self.hor:
-            vals["hor"] = self.fields[1]["val"].get()
-        else:
-            vals["hor"] = None
-        if self.ver:
-            vals["ver"] = self.fields[2]["val"].get()
-        else:
-            vals["ver"] = None
-        return vals
+        return dict(self.model)
 
     def savestate(self):
         """Save current component state in a dictionary"""
@@ -148,9 +138,7 @@ class ScatterPoint:
                 state["fields"][key] = self.fields[key]["val"].get()
             return state
         except Exception as e: #pylint: disable=broad-except
-            print("Error in savestate:",e)
-            print("State:",state)
-            print("Fields:",self.fields)
+            log.error("Error in savestate: %s\nState: %s\nFields: %s", e, state, self.fields)
 
     def loadstate(self, state):
         """Load a component state from a dictionary"""
@@ -158,20 +146,17 @@ class ScatterPoint:
         self.update_fields()
         self.hor.set(state["hor"])
         self.ver.set(state["ver"])
-        if self.DEBUG:
-            print(f"Loading state: {state}")
-            print(f"Fields: {self.fields}")
+        log.debug("Loading state: %s\nFields: %s", state, self.fields)
         for key in self.fields: #pylint: disable=consider-using-dict-items
-            if self.DEBUG:
-                print(f"Setting field {key} to {state['fields'][str(key)]}")
-                print(f"Field: {self.fields[key]['val']}")
+            log.debug("Setting field %s to %s", key, state["fields"][str(key)])
             self.fields[key]["val"].set(state["fields"][str(key)])
 
 class ScatterPlot(GUI_OptLineProto):
     """Default optical beamline implementation"""
-    def __init__(self, parent, parentframe,  compid = 0, location = (0,0), DEBUG = 0): # pylint: disable=useless-super-delegation
+    modelclass = ScatterModel
+    def __init__(self, parent, parentframe,  compid = 0, location = (0,0)): # pylint: disable=useless-super-delegation
         self.input = {}
-        super().__init__(parent, parentframe, compid, location, inputDict=self.input, DEBUG = DEBUG)
+        super().__init__(parent, parentframe, compid, location, inputDict=self.input)
         self.plotoptions["plottype"] = "scatter"
     
     def add_parameter(self):
@@ -179,56 +164,11 @@ class ScatterPlot(GUI_OptLineProto):
         newcompid = len(self.parameters)
         new_parameter = ScatterPoint(parent = self,
                                       parentframe = self.componentframe,
-                                      compid = newcompid,
-                                      DEBUG = self.DEBUG)
+                                      compid = newcompid)
         self.parameters.append(new_parameter)
+        self.model.components.append(new_parameter.model)
         self.componentframe.rowconfigure(self.compid, weight=1)
 
-    def replot(self, n = 1000):
-        """Overwrite the replot function to plot the scatter points"""
-        self.samples.set(n)
-        self.update_options()
-        points = []
-        for point in self.parameters:
-            points.append(point.get_vals())
-        self.plotdata = {}
-        if "x_offset" in self.input:
-            offset = self.input["x_offset"].get()
-        else:
-            offset = 0
-        if self.hor.get():
-            self.plotdata["hor"] = {}
-            xs = []
-            ws = []
-            for point in points:
-                print(point)
-                if point["hor"] is not None:
-                    xs.append(point["x"] + offset)
-                    ws.append(point["hor"])
-            xs = np.array(xs)
-            ws = np.array(ws)
-            # Check whether the x_offset parameter exists in current input
-            self.plotdata["hor"]["x"] = xs + offset
-            self.plotdata["hor"]["w"] = ws
-        if self.ver.get():
-            self.plotdata["ver"] = {}
-            xs = []
-            ws = []
-            for point in points:
-                if point["ver"] is not None:
-                    xs.append(point["x"] + offset)
-                    ws.append(point["ver"])
-            xs = np.array(xs)
-            ws = np.array(ws)
-            self.plotdata["ver"]["x"] = xs + offset
-            self.plotdata["ver"]["w"] = ws
-        self.plotdata["plotoptions"] = self.plotoptions
-        if self.DEBUG:
-            print(f"plotdata keys: {self.plotdata.keys()}")
-        if self.DEBUG:
-            print(f"plotdata: {self.plotdata}")
-        return self.plotdata
-
 def test():
     """Test function for OpticalLine"""
     root = tk.Tk()
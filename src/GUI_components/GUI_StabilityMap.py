@@ -0,0 +1,287 @@
+#pylint: disable=invalid-name
+"""Implements the StabilityMap class, a window showing a heatmap of a cavity quantity
+(waists, hor/ver mismatch) over two cavity inputs with the unstable region masked.
+The grid is computed off the tkinter thread, refined progressively and cached.
+Optionally the sweeps run in a worker process and come back through shared memory."""
+
+import threading
+import queue
+from collections import OrderedDict
+import tkinter as tk
+from tkinter import ttk
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
+
+# Import format depends on whether this is run as a script or imported as a module
+if __name__ == "__main__":
+    from raycalc import parallel    # pylint: disable=import-error
+else:
+    from .raycalc import parallel
+
+# Grid resolutions, coarse first
+REFINEMENT = [25, 75, 200]
+# Computed grids kept in the cache, least recently used are dropped
+CACHEGRIDS = 12
+COLORMAPS = ["viridis", "plasma", "inferno", "magma", "cividis", "coolwarm", "RdBu"]
+
+class StabilityMap:
+    """Stability/waist heatmap window for the cavities in a LineGUI"""
+    def __init__(self, parent, lineslist):
+        """parent: the App, needs update_plot and PlotMapWindow
+        lineslist: the LineGUI holding the optical lines"""
+        self.parent = parent
+        self.lineslist = lineslist
+        self.root = tk.Toplevel()
+        self.root.title("Stability map")
+        self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
+
+        # Cache of computed sweeps, key: cavity type, fixed inputs, axes and resolution.
+        # Bounded, grids from the worker process also hold shared memory mappings
+        self.cache = OrderedDict()
+        # Results from the worker thread, tagged with the request generation
+        self.results = queue.Queue()
+        self.generation = 0
+        self.worker = None
+        self.request = None
+        self.cavity = None
+
+        ### CONTROLS ###
+        self.controls = ttk.Frame(self.root)
+        self.controls.pack(side=tk.RIGHT, fill=tk.Y)
+
+        self.cavitynames = {}
+        self.cavitysel = ttk.Combobox(self.controls)
+        self.cavitysel.bind("<<ComboboxSelected>>", lambda event: self.select_cavity())
+        ttk.Label(self.controls, text="Cavity").grid(row=0, column=0, padx=5)
+        self.cavitysel.grid(row=0, column=1, columnspan=2, padx=5)
+
+        self.axes = {}
+        for row, axis in enumerate(("x", "y")):
+            self.axes[axis] = {"param": ttk.Combobox(self.controls, width=10),
+                               "min": tk.DoubleVar(value=0),
+                               "max": tk.DoubleVar(value=1)}
+            self.axes[axis]["param"].bind("<<ComboboxSelected>>",
+                                          lambda event, axis=axis: self.default_range(axis))
+            ttk.Label(self.controls, text=f"{axis} axis").grid(row=2*row+1, column=0, padx=5)
+            self.axes[axis]["param"].grid(row=2*row+1, column=1, columnspan=2, padx=5)
+            ttk.Entry(self.controls, width=10,
+                      textvariable=self.axes[axis]["min"]).grid(row=2*row+2, column=1, padx=5)
+            ttk.Entry(self.controls, width=10,
+                      textvariable=self.axes[axis]["max"]).grid(row=2*row+2, column=2, padx=5)
+
+        self.quantity = ttk.Combobox(self.controls)
+        self.quantity.bind("<<ComboboxSelected>>", lambda event: self.redraw())
+        ttk.Label(self.controls, text="Quantity").grid(row=5, column=0, padx=5)
+        self.quantity.grid(row=5, column=1, columnspan=2, padx=5)
+
+        self.cmap = ttk.Combobox(self.controls, values=COLORMAPS)
+        self.cmap.current(0)
+        self.cmap.bind("<<ComboboxSelected>>", lambda event: self.set_cmap())
+        ttk.Label(self.controls, text="Colormap").grid(row=6, column=0, padx=5)
+        self.cmap.grid(row=6, column=1, columnspan=2, padx=5)
+
+        self.compute_button = ttk.Button(self.controls, text="Compute", command=self.compute)
+        self.compute_button.grid(row=7, column=1, padx=5, pady=5)
+        # Sweep in a worker process, keeps the GIL free for the GUI on fine grids
+        self.useprocess = tk.BooleanVar(value=False)
+        ttk.Checkbutton(self.controls, text="Process",
+                        variable=self.useprocess).grid(row=7, column=2, padx=5)
+        self.status = ttk.Label(self.controls, text="")
+        self.status.grid(row=8, column=0, columnspan=3, padx=5)
+        ### END CONTROLS ###
+
+        ### PLOT ###
+        self.fig = Figure()
+        self.ax = self.fig.add_subplot()
+        self.image = None
+        self.colorbar = None
+        self.marker = None
+        self.sweep = None
+        self.grid = None
+        self.canvas = FigureCanvasTkAgg(self.fig, master=self.root)
+        self.canvas.get_tk_widget().pack(side=tk.TOP, fill=tk.BOTH, expand=1)
+        self.toolbar = NavigationToolbar2Tk(self.canvas, self.root)
+        self.toolbar.update()
+        self.canvas.mpl_connect("button_press_event", self.on_click)
+
+        self.refresh_cavities()
+
+    def refresh_cavities(self):
+        """Fill the cavity selector with the optical lines that support sweeps"""
+        self.cavitynames = {}
+        for i, optLine in enumerate(self.lineslist.opticalLines):
+            if hasattr(optLine.item, "runsweep"):
+                self.cavitynames[f"{i}: {optLine.item.name.get()}"] = optLine.item
+        self.cavitysel["values"] = list(self.cavitynames)
+        if self.cavitynames:
+            self.cavitysel.current(0)
+            self.select_cavity()
+        else:
+            self.status["text"] = "No cavities to map"
+
+    def select_cavity(self):
+        """Set up the axis and quantity choices for the selected cavity"""
+        self.cavity = self.cavitynames[self.cavitysel.get()]
+        for i, axis in enumerate(("x", "y")):
+            self.axes[axis]["param"]["values"] = self.cavity.sweepinputs
+            self.axes[axis]["param"].current(i)
+            self.default_range(axis)
+        self.quantity["values"] = list(self.cavity.sweepquantities)
+        self.quantity.current(0)
+
+    def default_range(self, axis):
+        """Default sweep range of an axis: 0.5x...1.5x of the current input value"""
+        value = self.cavity.input[self.axes[axis]["param"].get()].get()
+        self.axes[axis]["min"].set(round(0.5*value, 6))
+        self.axes[axis]["max"].set(round(1.5*value, 6))
+
+    def snapshot(self):
+        """Read everything the worker needs from tkinter, returns the request dict"""
+        inputs = {key: var.get() for key, var in self.cavity.input.items()}
+        axes = {axis: (self.axes[axis]["param"].get(),
+                       self.axes[axis]["min"].get(),
+                       self.axes[axis]["max"].get()) for axis in ("x", "y")}
+        # Inputs on the map axes and the plot offset do not change the cached grid
+        fixed = tuple(sorted((key, val) for key, val in inputs.items()
+                             if key not in (axes["x"][0], axes["y"][0], "x_offset")))
+        # "widget" is the cavity the grid belongs to, the selection may change meanwhile
+        return {"cavity": type(self.cavity), "widget": self.cavity,
+                "inputs": inputs, "axes": axes,
+                "process": self.useprocess.get(),
+                "key": (type(self.cavity).__name__, fixed, axes["x"], axes["y"])}
+
+    def compute(self):
+        """Start a progressive computation of the map in a worker thread"""
+        if self.cavity is None:
+            return
+        self.request = self.snapshot()
+        if self.request["axes"]["x"][0] == self.request["axes"]["y"][0]:
+            self.status["text"] = "Choose two different inputs"
+            return
+        self.generation += 1
+        cached = [res for res in REFINEMENT if (self.request["key"], res) in self.cache]
+        if cached:
+            # Show the finest cached grid right away
+            self.cache.move_to_end((self.request["key"], cached[-1]))
+            self.show(self.request, cached[-1], self.cache[(self.request["key"], cached[-1])])
+        todo = [res for res in REFINEMENT if res > max(cached, default=0)]
+        if not todo:
+            return
+        self.status["text"] = "Computing..."
+        self.worker = threading.Thread(target=self.work,
+                                       args=(self.request, todo, self.generation),
+                                       daemon=True)
+        self.worker.start()
+        self.root.after(50, self.poll)
+
+    def work(self, request, resolutions, generation):
+        """Worker thread: compute the grid for each resolution, coarse first"""
+        (xkey, xmin, xmax), (ykey, ymin, ymax) = request["axes"]["x"], request["axes"]["y"]
+        for res in resolutions:
+            if generation != self.generation:
+                return # Superseded by a newer request
+            values = dict(request["inputs"])
+            values[xkey] = np.linspace(xmin, xmax, res)[None,:]
+            values[ykey] = np.linspace(ymin, ymax, res)[:,None]
+            try:
+                if request["process"]:
+                    # Grids mapped from the worker's shared memory, no copies
+                    sweep = parallel.runSweep(request["cavity"].runsweep, values)
+                else:
+                    sweep = request["cavity"].runsweep(values)
+            except Exception as e: #pylint: disable=broad-except
+                self.results.put((generation, request, res, e))
+                return
+            self.results.put((generation, request, res, sweep))
+
+    def poll(self):
+        """Move finished grids from the worker to the plot, runs on the tkinter thread"""
+        # Checked before draining, a worker that is done has put all its results already
+        alive = self.worker is not None and self.worker.is_alive()
+        try:
+            while True:
+                generation, request, res, sweep = self.results.get_nowait()
+                if isinstance(sweep, Exception):
+                    self.status["text"] = f"Error: {sweep}"
+                    continue
+                self.cache[(request["key"], res)] = sweep
+                while len(self.cache) > CACHEGRIDS:
+                    self.cache.popitem(last=False)
+                if generation == self.generation:
+                    self.show(request, res, sweep)
+        except queue.Empty:
+            pass
+        if alive:
+            self.root.after(50, self.poll)
+
+    def show(self, request, res, sweep):
+        """Display a computed grid"""
+        self.sweep = sweep
+        self.grid = (request, res)
+        self.status["text"] = f"{res}x{res} grid, {np.mean(sweep['stable'])*100:.0f} % stable"
+        self.redraw()
+
+    def redraw(self):
+        """Redraw the current grid with the chosen quantity, no recomputation"""
+        if self.sweep is None:
+            return
+        request, res = self.grid
+        (xkey, xmin, xmax), (ykey, ymin, ymax) = request["axes"]["x"], request["axes"]["y"]
+        # Quantities of the cavity the grid was computed for
+        quantities = request["widget"].sweepquantities
+        quantity = self.quantity.get()
+        if quantity not in quantities:
+            quantity = next(iter(quantities))
+        values = quantities[quantity](self.sweep)
+        values = np.ma.masked_where(~self.sweep["stable"] | ~np.isfinite(values), values)
+        # Grid values sit at the pixel centres
+        dx = (xmax-xmin)/(res-1)/2
+        dy = (ymax-ymin)/(res-1)/2
+        extent = (xmin-dx, xmax+dx, ymin-dy, ymax+dy)
+        if self.image is None:
+            self.image = self.ax.imshow(values, origin="lower", aspect="auto",
+                                        extent=extent, cmap=self.cmap.get())
+            self.colorbar = self.fig.colorbar(self.image, ax=self.ax)
+        else:
+            self.image.set_data(values)
+            self.image.set_extent(extent)
+            self.image.autoscale()
+        self.colorbar.set_label(f"{quantity} (µm)")
+        self.ax.set_xlabel(xkey)
+        self.ax.set_ylabel(ykey)
+        self.ax.set_title("Unstable region masked")
+        self.canvas.draw_idle()
+
+    def set_cmap(self):
+        """Change the colormap of the current map"""
+        if self.image is not None:
+            self.image.set_cmap(self.cmap.get())
+            self.canvas.draw_idle()
+
+    def on_click(self, event):
+        """Load the clicked parameters into the cavity inputs"""
+        if event.inaxes is not self.ax or self.grid is None or self.toolbar.mode:
+            return
+        request, res = self.grid
+        # Snap to the centre of the clicked pixel
+        point = {}
+        for axis, clicked in (("x", event.xdata), ("y", event.ydata)):
+            key, vmin, vmax = request["axes"][axis]
+            values = np.linspace(vmin, vmax, res)
+            point[axis] = float(values[np.argmin(np.abs(values-clicked))])
+            request["widget"].input[key].set(point[axis])
+        if self.marker is None:
+            self.marker, = self.ax.plot([point["x"]], [point["y"]], "w+", markersize=12)
+        else:
+            self.marker.set_data([point["x"]], [point["y"]])
+        self.canvas.draw_idle()
+        if hasattr(self.parent, "update_plot"):
+            self.parent.update_plot(store = True) # A picked design, worth caching
+
+    def on_closing(self):
+        """Close the window and drop the reference in the parent"""
+        self.generation += 1 # Let a running worker finish without reporting back
+        if hasattr(self.parent, "PlotMapWindow"):
+            self.parent.PlotMapWindow = None
+        self.root.destroy()
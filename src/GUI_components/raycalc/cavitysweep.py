@@ -0,0 +1,94 @@
+"""Vectorised parameter sweeps over cavity designs.
+Any cavity parameter can be given as an array, all parameters are broadcast against
+each other, e.g. l_focus[:,None,None], l_free[None,:,None], theta[None,None,:]
+gives a 3D grid. The whole grid is evaluated chunkwise with batched matrices."""
+
+from math import pi, radians
+import numpy as np
+
+from .matrices import ringCavity, linCavity
+from .matrixcalc import buildMatrixList, stackABCD, composeABCD, cavityeigenmode, transformq
+
+# Planes to evaluate the cavity mode at, index of the matrix the beam enters
+RIBBON_PROBES = {"focus": 0, "free": 4} # crystal centre and free arm centre
+LIN_PROBES = {"waist": 0, "mirror": 1}  # flat mirror and curved mirror
+
+def cavitySweep(cavity, probes, lda = 972E-9, chunk = 2**16, empty = np.empty, **params):
+    """Sweep a cavity builder over broadcast parameter arrays.
+       cavity: cavity builder from matrices, e.g. ringCavity or linCavity
+       probes: dict name -> index of the cavity element at whose input the mode is evaluated
+       lda: wavelength [m]
+       chunk: number of grid points evaluated per batch, bounds the memory use
+       empty: allocator of the result arrays with the signature of np.empty, e.g.
+       transport.SharedWriter.empty to write the grids straight into shared memory
+       params: keyword parameters of the cavity builder, scalars or broadcastable arrays
+       Returns a dict of arrays with the broadcast grid shape:
+       "stable": both axes stable
+       "hor"/"ver": {"m": stability parameter (A+D)/2, "q": {probe: q},
+                     "w": {probe: beam radius}, "w0": {probe: waist radius of that arm}}
+       "astigmatism": {probe: hor/ver waist radius ratio}"""
+    names = list(params)
+    grids = np.broadcast_arrays(*[np.asarray(params[name], dtype=float) for name in names])
+    shape = grids[0].shape if grids else ()
+    flat = [grid.reshape(-1) for grid in grids]
+    size = int(np.prod(shape))
+
+    result = {"stable": empty(size, dtype=bool)}
+    for horver in ("hor", "ver"):
+        result[horver] = {"m": empty(size),
+                          "q": {probe: empty(size, dtype=complex) for probe in probes},
+                          "w": {probe: empty(size) for probe in probes},
+                          "w0": {probe: empty(size) for probe in probes}}
+
+    for start in range(0, size, chunk):
+        part = slice(start, min(start+chunk, size))
+        matrices = cavity(**{name: grid[part] for name, grid in zip(names, flat)})
+        stable = np.ones(part.stop-part.start, dtype=bool)
+        for horver in ("hor", "ver"):
+            stack = stackABCD(buildMatrixList(matrices[horver]))
+            stack = np.broadcast_to(stack, (part.stop-part.start,) + stack.shape[-3:])
+            mode = cavityeigenmode(composeABCD(stack), lda)
+            stable &= mode["stable"]
+            out = result[horver]
+            out["m"][part] = mode["m"]
+            for probe, index in probes.items():
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    # Only the prefix up to each probe is needed, not the full scan
+                    q = transformq(composeABCD(stack[:,:index]), mode["q"])
+                    out["q"][probe][part] = q
+                    out["w"][probe][part] = np.sqrt(-lda/(pi*np.imag(1/q)))
+                    out["w0"][probe][part] = np.sqrt(lda*np.imag(q)/pi)
+        result["stable"][part] = stable
+
+    result["stable"] = result["stable"].reshape(shape)
+    for horver in ("hor", "ver"):
+        out = result[horver]
+        out["m"] = out["m"].reshape(shape)
+        for key in ("q", "w", "w0"):
+            out[key] = {probe: val.reshape(shape) for probe, val in out[key].items()}
+    with np.errstate(invalid="ignore", divide="ignore"):
+        result["astigmatism"] = {probe: np.divide(result["hor"]["w0"][probe],
+                                                  result["ver"]["w0"][probe], out=empty(shape))
+                                 for probe in probes}
+    return result
+
+def ribbonSweep(l_focus = 61.6E-3,
+                l_free = 69.3E-3,
+                l_crystal = 15E-3,
+                R = 50E-3,
+                n_crystal = 1.567,
+                theta = radians(18.2),
+                lda = 972E-9,
+                chunk = 2**16,
+                empty = np.empty):
+    """Sweep a ribbon cavity, parameters as in matrices.ringCavity (theta in radians).
+       Mode is evaluated at the crystal focus ("focus") and the free arm centre ("free")"""
+    return cavitySweep(ringCavity, RIBBON_PROBES, lda = lda, chunk = chunk, empty = empty,
+                       l_focus = l_focus, l_free = l_free, l_crystal = l_crystal,
+                       R = R, n_crystal = n_crystal, theta = theta)
+
+def linSweep(l_cavity = 75E-3, R = 50E-3, lda = 972E-9, chunk = 2**16, empty = np.empty):
+    """Sweep a linear cavity, parameters as in matrices.linCavity.
+       Mode is evaluated at the flat mirror waist ("waist") and the curved mirror ("mirror")"""
+    return cavitySweep(linCavity, LIN_PROBES, lda = lda, chunk = chunk, empty = empty,
+                       l_cavity = l_cavity, R = R)
@@ -0,0 +1,41 @@
+"""Gaussian mode overlap (power coupling efficiency) between beams and cavity modes.
+Beams are described by their hor/ver q parameters at a common plane, the axes of
+astigmatic/elliptical beams are assumed to be aligned (hor/ver). Both beams are
+assumed to have the same wavelength. All functions broadcast over array inputs."""
+
+import numpy as np
+
+from .matrixcalc import stackABCD, composeABCD, transformq
+
+def overlap1D(q1, q2):
+    """Power overlap of two 1D Gaussian beams with q parameters q1 and q2 at the same plane,
+       |<u1|u2>|^2 = 2*sqrt(Im(q1)*Im(q2))/|q1-conj(q2)|, 1 for identical beams"""
+    q1 = np.asarray(q1)
+    q2 = np.asarray(q2)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (2*np.sqrt(np.imag(q1)*np.imag(q2))/np.abs(q1-np.conj(q2)))[()]
+
+def modeoverlap(q1hor, q1ver, q2hor, q2ver):
+    """Power coupling of two astigmatic Gaussian beams, product of the hor and ver overlaps"""
+    return overlap1D(q1hor, q2hor)*overlap1D(q1ver, q2ver)
+
+def traceCoupling(linetraces, cavityq, z):
+    """Coupling of an optical line into a cavity eigenmode.
+       linetraces: {"hor": BeamTrace, "ver": BeamTrace} of the optical line
+       cavityq: {"hor": q, "ver": q} of the cavity mode at the plane z
+       (e.g. the "q" of matrixcalc.cavityeigenmode with the reference plane placed at z)
+       z: position(s) on the line, scalar or array
+       Returns the coupling fraction for every z"""
+    return modeoverlap(linetraces["hor"].q_at(z), linetraces["ver"].q_at(z),
+                       cavityq["hor"], cavityq["ver"])
+
+def systemCoupling(horsystem, versystem, qin, cavityq):
+    """Score many optical line configurations against a cavity mode in one call.
+       horsystem, versystem: (...,M,2,2) batches of the hor/ver matrix stacks (or lists of
+       matrices, parameter sweep stacks are broadcast), the cavity mode plane is at the end
+       qin: {"hor": q, "ver": q} of the input beam
+       cavityq: {"hor": q, "ver": q} of the cavity mode
+       Returns the coupling fraction with the batch shape"""
+    qhor = transformq(composeABCD(stackABCD(horsystem)), qin["hor"])
+    qver = transformq(composeABCD(stackABCD(versystem)), qin["ver"])
+    return modeoverlap(qhor, qver, cavityq["hor"], cavityq["ver"])
@@ -0,0 +1,41 @@
+"""Reduction of long beam traces to what the plot can show.
+A trace sampled with hundreds of thousands of points is reduced to the minimum and the
+maximum of every pixel column of the view, so narrow waists and peaks survive while the
+drawn path stays at about 2 points per horizontal pixel."""
+
+import numpy as np
+
+def minmaxDecimate(x, y, xmin, xmax, buckets):
+    """Min/max decimation of a trace for the view [xmin, xmax].
+       x must be sorted (non-decreasing), the intervals are found by binary search and
+       reduced as contiguous slices.
+       buckets: number of x intervals in the view, typically the axes width in pixels.
+       Keeps the minimum and the maximum of every interval and the two ends of the view,
+       the latter being the points just outside it, so the line runs to the edges.
+       Returns (x, y), unchanged if there is nothing to reduce"""
+    x = np.asarray(x)
+    y = np.asarray(y)
+    buckets = int(buckets)
+    if buckets < 1 or len(x) <= 2*buckets or not xmax > xmin:
+        return x, y
+    # Points in the view plus one on either side
+    start = max(np.searchsorted(x, xmin, side="left") - 1, 0)
+    stop = min(np.searchsorted(x, xmax, side="right") + 1, len(x))
+    xv = x[start:stop]
+    yv = y[start:stop]
+    if len(xv) <= 2*buckets:
+        return xv, yv
+    # Trace is sorted, so the intervals are contiguous slices, empty ones are dropped
+    edges = np.searchsorted(xv, np.linspace(xmin, xmax, buckets + 1)[1:-1])
+    starts = np.unique(np.concatenate(([0], edges)))
+    starts = starts[starts < len(xv)]
+    counts = np.diff(np.append(starts, len(xv)))
+    group = np.repeat(np.arange(len(starts)), counts)
+    keep = [np.array([0, len(xv) - 1])]
+    for reduce in (np.fmin, np.fmax):
+        extreme = np.repeat(reduce.reduceat(yv, starts), counts)
+        hits = np.flatnonzero(yv == extreme)
+        # First hit of every interval
+        keep.append(hits[np.unique(group[hits], return_index=True)[1]])
+    keep = np.unique(np.concatenate(keep))
+    return xv[keep], yv[keep]
@@ -1,42 +1,53 @@
-"""Implements matrices for ray calculations"""
-
-from math import radians, cos, sin
-from numpy import inf,array
+"""Implements matrices for ray calculations.
+All component factories broadcast over array parameters and return a (...,2,2) stack"""
+
+import logging
+from math import radians
+from functools import lru_cache
+import numpy as np
+from numpy import inf
+
+from .matrixcalc import OpticalSystem
+
+log = logging.getLogger(__name__)
+
+def ABCDstack(A, B, C, D):
+    """Build a (...,2,2) stack of ABCD matrices from broadcastable elements"""
+    A, B, C, D = np.broadcast_arrays(A, B, C, D)
+    mat = np.empty(A.shape + (2,2), dtype=np.result_type(A, B, C, D, float))
+    mat[...,0,0] = A
+    mat[...,0,1] = B
+    mat[...,1,0] = C
+    mat[...,1,1] = D
+    return mat
 
-def identity():
-    """Identity matrix"""
-    return array([[1,0],
-                  [0,1]])
+def identity(shape = ()):
+    """Identity matrix, shape gives the batch shape of the returned stack"""
+    return ABCDstack(np.ones(shape), 0, 0, 1)
 
 def free(l = 0):
     """Free space matrix, l - optical path [meters] = d*n, n-reflactive index, d-real distance"""
-    return array([[1,l],
-                  [0,1]])
+    return ABCDstack(1, l, 0, 1)
 
 def thinlens(f = inf):
     """Thin lens matrix, f - rear focal distance [meters]"""
-    return array([[1,0],
-                  [-1/f,1]])
+    return ABCDstack(1, 0, -1/np.asarray(f), 1)
 
 def curvedmirrorhor(R = inf, theta = radians(8)):
     """Horizontal curved mirror matrix¨, R - Radius of curvature, theta - incoming beam angle"""
-    return array([[1,0],
-                  [-2/(R*cos(theta)),1]])
+    return ABCDstack(1, 0, -2/(np.asarray(R)*np.cos(theta)), 1)
 
 def curvedmirrorver(R = inf, theta = radians(8)):
     """Horizontal curved mirror matrix¨, R - Radius of curvature, theta - incoming beam angle"""
-    return array([[1,0],
-                  [-2*cos(theta)/(R),1]])
+    return ABCDstack(1, 0, -2*np.cos(theta)/np.asarray(R), 1)
 
 def thicklens():
     """Not implemented yet"""
-    return array([[1,0],
-                  [0,1]])
+    return identity()
 
 def flatrefraction(n1 = 1, n2 = 1):
     """Refraction at flat surface, n1 and n2 refractive indices of initial and final medium"""
-    return array([[1,0],
-                  [0,n1/n2]])
+    return ABCDstack(1, 0, 0, np.asarray(n1)/n2)
 
 def ringCavity(l_focus = 61.6E-3,
                l_free = 69.3E-3,
@@ -44,41 +55,36 @@ def ringCavity(l_focus = 61.6E-3,
                R = 50E-3,
                n_crystal = 1.567,
                theta = radians(18.2)):
-    """Returns the dict for a ringCavity"""
-    l_diagonal=(l_focus+l_free)/(2*cos(2*theta))
-    print(f"Cavity height: {sin(theta)*l_diagonal}")
-
-    cavityhor = [
-        {"ABCD": free(l = l_crystal/(2*n_crystal)), "label": None},
-        {"ABCD": free(l = (l_focus-l_crystal)/2), "label": None},
-        {"ABCD": curvedmirrorhor(R = R, theta = theta), "label": f"R = {R*1E3} mm"},
-        {"ABCD": free(l = (2*l_diagonal+l_free)/2), "label": None},
-        {"ABCD": free(l = (2*l_diagonal+l_free)/2), "label": None},
-        {"ABCD": curvedmirrorhor(R = R, theta = theta), "label": f"R = {R*1E3} mm"},
-        {"ABCD": free(l = (l_focus-l_crystal)/2), "label": None},
-        {"ABCD": free(l = l_crystal/(2*n_crystal)), "label": None}
-        ]
-
-    cavityver = [
-        {"ABCD": free(l = l_crystal/(2*n_crystal)), "label": None},
-        {"ABCD": free(l = (l_focus-l_crystal)/2), "label": None},
-        {"ABCD": curvedmirrorver(R = R, theta = theta), "label": f"R = {R*1E3} mm"},
-        {"ABCD": free(l = (2*l_diagonal+l_free)/2), "label": None},
-        {"ABCD": free(l = (2*l_diagonal+l_free)/2), "label": None},
-        {"ABCD": curvedmirrorver(R = R, theta = theta), "label": f"R = {R*1E3} mm"},
-        {"ABCD": free(l = (l_focus-l_crystal)/2), "label": None},
-        {"ABCD": free(l = l_crystal/(2*n_crystal)), "label": None}
-        ]
-
-    return {"hor": cavityhor, "ver": cavityver}
+    """Returns the hor/ver OpticalSystems of a ringCavity, parameters may be arrays for sweeps"""
+    l_diagonal=(l_focus+l_free)/(2*np.cos(2*theta))
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("Cavity height: %s", np.sin(theta)*l_diagonal)
+    mirror = f"R = {R*1E3} mm" if np.ndim(R) == 0 else "R"
+    labels = [None, None, mirror, None, None, mirror, None, None]
+
+    cavity = {}
+    for horver, curvedmirror in (("hor", curvedmirrorhor), ("ver", curvedmirrorver)):
+        cavity[horver] = OpticalSystem([
+            free(l = l_crystal/(2*n_crystal)),
+            free(l = (l_focus-l_crystal)/2),
+            curvedmirror(R = R, theta = theta),
+            free(l = (2*l_diagonal+l_free)/2),
+            free(l = (2*l_diagonal+l_free)/2),
+            curvedmirror(R = R, theta = theta),
+            free(l = (l_focus-l_crystal)/2),
+            free(l = l_crystal/(2*n_crystal))
+            ], labels)
+
+    return cavity
 
 def linCavity(l_cavity = 75E-3, R = 50E-3):
-    """Returns the dict for a linCavity (curved plus flat mirror)"""
-    cavityhor = [
-        {"ABCD": free(l = l_cavity), "label": None},
-        {"ABCD": curvedmirrorhor(R = R, theta = 0), "label": f"R = {R*1E3} mm"},
-        {"ABCD": free(l = l_cavity), "label": None}
-        ]
+    """Returns the hor/ver OpticalSystems of a linCavity (curved plus flat mirror),
+       parameters may be arrays. Both axes share one system, it cannot be modified"""
+    cavityhor = OpticalSystem([
+        free(l = l_cavity),
+        curvedmirrorhor(R = R, theta = 0),
+        free(l = l_cavity)
+        ], [None, f"R = {R*1E3} mm" if np.ndim(R) == 0 else "R", None])
 
     cavityver = cavityhor
 
@@ -94,31 +100,31 @@ df = 2000E-3
 # Working two lens: 40mm + 40 mm, distance 81.225mm
 
 if lenses == 1:
-    testTelescope = [
-    {"ABCD": free(l = d1), "label": None},
-    {"ABCD": thinlens(f = 500E-3), "label": "f3 = 250 mm"},
-    {"ABCD": free(l = df), "label": None}
-    ]
+    testTelescope = OpticalSystem([
+    free(l = d1),
+    thinlens(f = 500E-3),
+    free(l = df)
+    ], [None, "f3 = 250 mm", None])
     d4 = d1
 if lenses == 2:
-    testTelescope = [
-    {"ABCD": free(l = d1), "label": None},
-    {"ABCD": thinlens(f = 150E-3), "label": "f1 = 40 mm"},
-    {"ABCD": free(l = d2), "label": None},
-    {"ABCD": thinlens(f = 50E-3), "label": "f3 = 250 mm"},
-    {"ABCD": free(l = df), "label": None}
-    ]
+    testTelescope = OpticalSystem([
+    free(l = d1),
+    thinlens(f = 150E-3),
+    free(l = d2),
+    thinlens(f = 50E-3),
+    free(l = df)
+    ], [None, "f1 = 40 mm", None, "f3 = 250 mm", None])
     d4 = d1+d2
 if lenses == 3:
-    testTelescope = [
-    {"ABCD": free(l = d1), "label": None},
-    {"ABCD": thinlens(f = 100E-3), "label": "f1 = 40 mm"},
-    {"ABCD": free(l = d2), "label": None},
-    {"ABCD": thinlens(f = 40E-3), "label": "f2 = 40 mm"},
-    {"ABCD": free(l = d3), "label": None},
-    {"ABCD": thinlens(f = 40E-3), "label": "f3 = 250 mm"},
-    {"ABCD": free(l = df), "label": None}
-    ]
+    testTelescope = OpticalSystem([
+    free(l = d1),
+    thinlens(f = 100E-3),
+    free(l = d2),
+    thinlens(f = 40E-3),
+    free(l = d3),
+    thinlens(f = 40E-3),
+    free(l = df)
+    ], [None, "f1 = 40 mm", None, "f2 = 40 mm", None, "f3 = 250 mm", None])
     d4 = d1+d2+d3
 testCavity = None
 
@@ -153,41 +159,36 @@ matrixdicts = {
 
 
 def GUI_matrix(params: dict):
-    """Return the hor/ver matrices for the GUI element"""
+    """Return the hor/ver matrices for the GUI element. Parameters may be arrays,
+       the matrices are then broadcast (...,2,2) stacks, e.g. for parameter sweeps"""
     func = params["func"]
-    match func:
-        case "free":
-            mat = {"hor": free(l = params["l"]), "ver": free(l = params["l"])}
-            if not params["hor"]:
-                mat["hor"] = identity()
-            if not params["ver"]:
-                mat["ver"] = identity()
-        case "thinlens":
-            mat = {"hor": thinlens(f = params["f"]), "ver": thinlens(f = params["f"])}
-            if not params["hor"]:
-                mat["hor"] = identity()
-            if not params["ver"]:
-                mat["ver"] = identity()
-        case "curvedmirror":
-            mat = {"hor": curvedmirrorhor(R = params["R"], theta = params["θ"]),
-                   "ver": curvedmirrorver(R = params["R"], theta = params["θ"])}
-            if not params["hor"]:
-                mat["hor"] = identity()
-            if not params["ver"]:
-                mat["ver"] = identity()
-        case "thicklens":
-            mat = {"hor": thicklens(), "ver": thicklens()}
-            if not params["hor"]:
-                mat["hor"] = identity()
-            if not params["ver"]:
-                mat["ver"] = identity()
-        case "flatrefraction":
-            mat = {"hor": flatrefraction(n1 = params["n1"], n2 = params["n2"]),
-                   "ver": flatrefraction(n1 = params["n1"], n2 = params["n2"])}
-            if not params["hor"]:
-                mat["hor"] = identity()
-            if not params["ver"]:
-                mat["ver"] = identity()
-        case _:
-            mat = {"hor": identity(), "ver": identity()}
+    if func not in matrixdicts:
+        return {"hor": identity(), "ver": identity()}
+    funcs = matrixdicts[func]["func"]
+    if not isinstance(funcs, dict):
+        funcs = {"hor": funcs, "ver": funcs}
+    # Parameters are passed in the order listed in matrixdicts
+    args = [params[param] for param in matrixdicts[func]["params"]]
+    mat = {horver: funcs[horver](*args) for horver in ("hor", "ver")}
+    for horver in ("hor", "ver"):
+        if not params[horver]:
+            mat[horver] = identity(mat[horver].shape[:-2])
     return mat
+
+@lru_cache(maxsize=4096)
+def _frozenMatrix(key):
+    """GUI_matrix of a hashable parameter tuple, the matrices are made read only
+       since the same arrays are handed out on every cache hit"""
+    mat = GUI_matrix(dict(key))
+    for ABCD in mat.values():
+        ABCD.setflags(write=False)
+    return mat
+
+def cachedMatrix(params: dict):
+    """GUI_matrix memoised on the parameter values, components that did not change
+       between replots are not rebuilt. Array (sweep) parameters bypass the cache.
+       Every hit gets its own dict, so assigning a key does not change the cache"""
+    try:
+        return dict(_frozenMatrix(tuple(sorted(params.items()))))
+    except TypeError: # unhashable parameters
+        return GUI_matrix(params)
@@ -1,28 +1,157 @@
 """Module for ray transfer matrix calculations"""
 
 from math import * #pylint: disable=wildcard-import, redefined-builtin, unused-wildcard-import
+import sys
+import logging
 import numpy as np
-from scipy.optimize import root
 
-debug = False
+log = logging.getLogger(__name__)
+
+# Samples written between two checks of the cancellation callback of constructRey
+CANCELCHUNK = 1 << 20
 
 def buildMatrixList(systemDicts):
-    """Build list of matrices from input list"""
+    """Build list of matrices from input list, an OpticalSystem gives its matrix block"""
+    if isinstance(systemDicts, OpticalSystem):
+        return systemDicts.matrices
     MatrixList = []
     for M in systemDicts:
         MatrixList.append(M["ABCD"])
     return MatrixList
 
+class OpticalSystem:
+    """Immutable optical system: one contiguous read only (...,M,2,2) block of ABCD
+       matrices in beam order and an interned label table. Calc functions take it in
+       place of matrix lists, nothing is copied or modified on the way"""
+    __slots__ = ("matrices", "labeltable", "labelindex")
+
+    def __init__(self, matrices, labels = None):
+        """matrices: list of (...,2,2) matrices (broadcast against each other) or a stack
+           labels: label (str or None) of each matrix"""
+        matrices = np.array(stackABCD(matrices), order="C") # own copy
+        matrices.setflags(write=False)
+        if labels is None:
+            labels = [None]*matrices.shape[-3]
+        if len(labels) != matrices.shape[-3]:
+            raise ValueError(f"Got {len(labels)} labels for {matrices.shape[-3]} matrices")
+        table = tuple(dict.fromkeys(sys.intern(label) for label in labels if label is not None))
+        index = np.array([-1 if label is None else table.index(label) for label in labels],
+                         dtype=np.int16)
+        index.setflags(write=False)
+        object.__setattr__(self, "matrices", matrices)
+        object.__setattr__(self, "labeltable", table)
+        object.__setattr__(self, "labelindex", index)
+
+    @classmethod
+    def fromDicts(cls, systemDicts):
+        """Build from the old [{"ABCD": matrix, "label": str or None}, ...] format"""
+        return cls([M["ABCD"] for M in systemDicts], [M["label"] for M in systemDicts])
+
+    def __setattr__(self, name, value):
+        raise AttributeError("OpticalSystem is immutable")
+
+    def __reduce__(self):
+        # Pickling (e.g. to worker processes) rebuilds through __init__, slots can't be set
+        return (OpticalSystem, (self.matrices, [self.label(i) for i in range(len(self))]))
+
+    def __copy__(self):
+        # Immutable, a copy can be the system itself
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __len__(self):
+        return self.matrices.shape[-3]
+
+    def __repr__(self):
+        return f"OpticalSystem({len(self)} components, batch {self.matrices.shape[:-3]})"
+
+    @property
+    def lengths(self):
+        """Free space length (B element) of each component, 0 for the other components"""
+        return self.matrices[...,0,1]
+
+    def label(self, i):
+        """Label of component i, None if it has none"""
+        k = self.labelindex[i]
+        return None if k < 0 else self.labeltable[k]
+
+    @property
+    def nbytes(self):
+        """Memory held by the arrays of the system"""
+        return self.matrices.nbytes + self.labelindex.nbytes
+
+def stackABCD(matrixList):
+    """Stack an ordered list of 2x2 matrices into a (M,2,2) float array.
+       Entries may also be (...,2,2) parameter sweep stacks, they are broadcast
+       against each other into a (...,M,2,2) batch.
+       String labels in the list are skipped, the list itself is not modified.
+       An OpticalSystem gives its (read only) matrix block without copying"""
+    if isinstance(matrixList, OpticalSystem):
+        return matrixList.matrices
+    if isinstance(matrixList, np.ndarray):
+        return matrixList
+    matrices = [np.asarray(M) for M in matrixList if not isinstance(M, str)]
+    if not matrices:
+        return np.empty((0,2,2))
+    dtype = np.result_type(*matrices, float)
+    return np.stack(np.broadcast_arrays(*matrices), axis=-3).astype(dtype, copy=False)
+
+def mul2x2(X, Y):
+    """Batched 2x2 matrix product X @ Y written out elementwise,
+       for tiny matrices this is several times faster than np.matmul"""
+    out = np.empty(np.broadcast_shapes(X.shape, Y.shape), dtype=np.result_type(X, Y))
+    out[...,0,0] = X[...,0,0]*Y[...,0,0] + X[...,0,1]*Y[...,1,0]
+    out[...,0,1] = X[...,0,0]*Y[...,0,1] + X[...,0,1]*Y[...,1,1]
+    out[...,1,0] = X[...,1,0]*Y[...,0,0] + X[...,1,1]*Y[...,1,0]
+    out[...,1,1] = X[...,1,0]*Y[...,0,1] + X[...,1,1]*Y[...,1,1]
+    return out
+
+def composeABCD(matrices, prefix = False):
+    """Vectorised composition of stacked ABCD matrices.
+       matrices: array of shape (M,2,2) or a batch (...,M,2,2), ordered along the beam
+       prefix: also return the prefix products
+       Returns the composite M_(M-1) @ ... @ M_0 with shape (...,2,2). With prefix = True
+       returns (composite, prefixes), where prefixes has shape (...,M+1,2,2) and
+       prefixes[...,k,:,:] is the product of the first k matrices (k = 0 is identity).
+       The input array is never modified."""
+    matrices = np.asarray(matrices)
+    if matrices.ndim < 3 or matrices.shape[-2:] != (2,2):
+        raise ValueError(f"Expected a (...,M,2,2) matrix stack, got shape {matrices.shape}")
+    dtype = np.result_type(matrices.dtype, float)
+    batch = matrices.shape[:-3]
+    n = matrices.shape[-3]
+    eye = np.broadcast_to(np.eye(2, dtype=dtype), batch + (1,2,2))
+
+    if prefix:
+        # Hillis-Steele scan, log2(M) batched matmuls instead of M python level ones
+        scan = matrices.astype(dtype, copy=True)
+        shift = 1
+        while shift < n:
+            step = scan.copy()
+            step[...,shift:,:,:] = mul2x2(scan[...,shift:,:,:], scan[...,:-shift,:,:])
+            scan = step
+            shift *= 2
+        prefixes = np.concatenate((eye, scan), axis=-3)
+        return prefixes[...,-1,:,:].copy(), prefixes
+
+    # Pairwise tree reduction, neighbours are multiplied in beam order
+    result = matrices.astype(dtype, copy=False)
+    while result.shape[-3] > 1:
+        even = result.shape[-3]//2*2
+        paired = mul2x2(result[...,1:even:2,:,:], result[...,0:even:2,:,:])
+        if even != result.shape[-3]:
+            paired = np.concatenate((paired, result[...,-1:,:,:]), axis=-3)
+        result = paired
+    if n == 0:
+        return eye[...,0,:,:].copy()
+    return result[...,0,:,:].copy()
+
 def compositeABCD(matrixList = []): #pylint: disable=dangerous-default-value
     """Takes as input an ordered list of numpy matrices, 
-       returns their product"""
-    # Reverse list for correct multiplication order
-    matrixList.reverse()
-    result = np.array([[1,0],
-                    [0,1]])
-    for M in matrixList:
-        result = np.matmul(M,result)
-    return result
+       returns their product. The input list is left untouched"""
+    return composeABCD(stackABCD(matrixList))
 
 def calcq(Z = 0, ZR = 0, lam = 0, W = 0, n = 1):
     """Calculate Q parameter, Z = Distance from waist, ZR = Rayleigh length, 
@@ -36,17 +165,52 @@ def calcq(Z = 0, ZR = 0, lam = 0, W = 0, n = 1):
     return Z+1j*ZR
 
 def transformq(ABCD, q1):
-    """Calculate changes to q parameter via ABCD matrix"""
-    q2 = (ABCD[0,0]*q1+ABCD[0,1])/(ABCD[1,0]*q1+ABCD[1,1])
+    """Calculate changes to q parameter via ABCD matrix, works on (...,2,2) batches too"""
+    q2 = (ABCD[...,0,0]*q1+ABCD[...,0,1])/(ABCD[...,1,0]*q1+ABCD[...,1,1])
     return q2
 
 
 ### REPLACE EVERYTHING UNDER ###
 
+def cavityeigenmode(ABCD, lda = None):
+    """Closed form self-consistent q parameter of a cavity, solves q = (Aq+B)/(Cq+D).
+       ABCD: round trip matrix (2,2) or a batch of them (...,2,2)
+       lda: wavelength [m], only needed for the beam radii
+       Returns a dict of arrays (scalars for a single matrix):
+       "q": eigenmode q at the reference plane, nan where not stable
+       "w": beam radius at the reference plane [m], nan without lda
+       "w0": waist radius of the mode [m], nan without lda
+       "m": stability parameter (A+D)/2, the cavity is stable for |m| < 1
+       "stable": stability flag, False also for the degenerate C = 0 and |m| = 1 cases"""
+    ABCD = np.asarray(ABCD, dtype=float)
+    shape = ABCD.shape[:-2]
+    # Work on a flat 1-d batch so scalar input does not fall back to python complex maths
+    flat = ABCD.reshape(-1,2,2)
+    A = flat[:,0,0]
+    B = flat[:,0,1]
+    C = flat[:,1,0]
+    D = flat[:,1,1]
+    m = (A+D)/2
+    # Discriminant of C q^2 + (D-A) q - B = 0, negative for a confined (complex) mode
+    disc = (A-D)**2 + 4*B*C
+    stable = (disc < 0) & (C != 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        q = np.where(stable,
+                     (A-D)/(2*C) + 1j*np.sqrt(np.abs(disc))/(2*np.abs(C)),
+                     complex(np.nan, np.nan))
+        if lda is None:
+            w = np.full(m.shape, np.nan)
+            w0 = np.full(m.shape, np.nan)
+        else:
+            w = np.sqrt(-lda/(pi*np.imag(1/q)))
+            w0 = np.sqrt(lda*np.imag(q)/pi)
+    return {key: val.reshape(shape)[()] for key, val in
+            {"q": q, "w": w, "w0": w0, "m": m, "stable": stable}.items()}
+
 def cavityq(ABCD):
-    """Returns the waist value of cavity fundamental"""
-    W = root(lambda x: abs(transformq(ABCD,1j*x)-1j*x),35e-6)
-    return W.x[0]
+    """Returns the Rayleigh length of the cavity fundamental (nan if unstable).
+       Kept for compatibility, cavityeigenmode gives the full q parameter"""
+    return np.imag(cavityeigenmode(ABCD)["q"])
 
 def z_r(w0,lda):
     """Calculates rayleigh range [m], w0 - waist [m], lda - wavelength [m]"""
@@ -61,9 +225,7 @@ def w_z(z,lda,zr=None,w0=None,z0=0):
     try:
         return (lda / pi * zr)**(1/2)*(1 + (z-z0)**2/zr**2)**(1/2)
     except Exception as ex: #pylint: disable=broad-except, unused-variable
-        print(f"lda:{lda}\nzr: {zr}\nz: {z}")
-        print(zr)
-        print(lda)
+        log.warning("w_z failed for lda: %s, zr: %s, z: %s", lda, zr, z)
         return 0
 
 class BeamTrace:
@@ -72,74 +234,269 @@ class BeamTrace:
         self.n_points = n_points
         self.z0 = z0 #distance from q_in point to 0, needed only for convinience
         self.matrexes = matrexes # array of matrixes to calculate q-parameter for
-        self.composite = compositeABCD(matrexes) # composite matrix
+        self.stack = stackABCD(matrexes) # (M,2,2) stack of the matrices, labels removed
+        # composite matrix and the products of the first k matrices
+        self.composite, self.prefixes = composeABCD(self.stack, prefix = True)
         self.xs = [] # x coordinates
         self.ws = [] # beam waists vs. xs
-        self.qz_to_print = [] # future array of (label,q) for labels in matrexes
         self.q_in = q_in # initial q-parameter of the beam
         self.zr = 0 # Save rayleigh length
         self.lda = lda
         self.focii = [] # Save focii of the beamline
         self.qs_to_print = [] # Save q-parameters for labels
+        # Labels are stored as (label, index of the next matrix in the stack)
+        self.labels = []
+        self.findLabels()
+        # Leading segments unchanged since the last constructRey, their samples are reused
+        self.clean = 0
+        self.traceSegments()
 
-    def constructRey(self,lda = 972E-9):
-        """Function that construct waists vs x posision"""
-        self.xs = []
-        self.ws = []
-        self.qs_to_print = []
-        q_in = self.q_in
-        if debug:
-            print(f"q_in: {q_in}")
-        direction = 1 # direction of the beam (if mirror comes it changes the direction)
-        self.matrexes.reverse()
+    def findLabels(self):
+        """Store the labels of matrexes as (label, index of the next matrix in the stack)"""
+        self.labels = []
+        if isinstance(self.matrexes, OpticalSystem):
+            self.labels = [(self.matrexes.label(i), i) for i in range(len(self.matrexes))
+                           if self.matrexes.labelindex[i] >= 0]
+            return
+        i = 0
+        for M in self.matrexes:
+            if isinstance(M,str):
+                self.labels.append((M,i))
+            else:
+                i += 1
 
-        if debug:
-            print(f"matrices: {self.matrexes}")
+    def update(self, matrexes, q_in = None, lda = None, n_points = None):
+        """Swap in an edited matrix list. Prefix products and q values upstream of the
+           first changed matrix are kept, only the downstream part is recomposed.
+           q_in, lda, n_points: new beam parameters, None keeps the current ones.
+           Returns the stack index of the first changed matrix"""
+        stack = stackABCD(matrexes)
+        n = min(len(stack), len(self.stack))
+        changed = np.flatnonzero(np.any(stack[:n] != self.stack[:n], axis=(1,2)))
+        k = int(changed[0]) if len(changed) else n
+        if stack.dtype != self.stack.dtype:
+            k = 0
+        if k < len(stack) or len(stack) != len(self.stack):
+            # Products of the first k+j matrices = (M_(k+j-1) @ ... @ M_k) @ prefix k
+            tail = composeABCD(stack[k:], prefix = True)[1]
+            prefixes = np.empty((len(stack)+1,2,2), dtype=np.result_type(tail, self.prefixes))
+            prefixes[:k+1] = self.prefixes[:k+1]
+            prefixes[k:] = mul2x2(tail, self.prefixes[k])
+            self.prefixes = prefixes
+            self.composite = prefixes[-1].copy()
+        self.matrexes = matrexes
+        self.stack = stack
+        self.findLabels()
+        if q_in is not None and q_in != self.q_in:
+            self.q_in = q_in
+            k = 0
+        if lda is not None and lda != self.lda:
+            self.lda = lda
+            self.clean = 0
+        if n_points is not None:
+            self.n_points = n_points
+        self.traceSegments(min(k, len(self.qs)))
+        return k
 
-        for M in self.matrexes:
-            if debug:
-                print(f"M: {M}")
-                print(f"q_in: {q_in}")
-
-            if isinstance(M,str): # it is a label to save current beam parameter
-                if debug:
-                    print("label")
-                self.qs_to_print.append((M,w_z(q_in,lda),q_in))
-                print(self.qs_to_print[-1])
-                continue
-
-            if M[0][1] != 0: # it is free space matrix
-                if debug:
-                    print("free space")
-                xs = np.linspace(0,M[0][1],self.n_points)
-                ws = w_z(xs+np.real(q_in),lda=lda,zr=np.imag(q_in)) # calculates waists
-                #print(ws)
-
-                if self.xs != []: # point where if stoped in previous matrix
-                    extr = self.xs[-1]
-                else :
-                    extr = self.z0
-
-                self.xs.extend(direction*xs+extr)
-                #print(f"wsl: {self.ws}")
-                #print(f"ws: {ws}")
-                self.ws.extend(ws)
-
-            elif M[0][1] == 0 and M[1][0] == 0: # ones matrix means a mirror
-                if debug:
-                    print("mirror")
-                direction *= 1
-                continue
-            q_in = transformq(M,q_in) #calculate new q-parameter for the next matrix
-        try:
+    def traceSegments(self, start = 0):
+        """Analytic beam parameters of every free space segment, no sampling needed.
+           Every matrix with B != 0 is a free space segment of length B. All other
+           matrices transform q as well, a flat refraction (D = n1/n2) scales it by n2/n1
+           (the original tracer skipped every B = C = 0 matrix as a mirror).
+           start: first matrix whose incoming q changed, the q values before it are kept"""
+        P = self.prefixes[start:-1]
+        # q entering each matrix of the stack
+        with np.errstate(divide="ignore", invalid="ignore"):
+            qs = ((P[:,0,0]*self.q_in+P[:,0,1])
+                  /(P[:,1,0]*self.q_in+P[:,1,1]))
+        self.qs = np.concatenate((self.qs[:start], qs)) if start > 0 else qs
+        free = self.stack[:,0,1] != 0
+        self.seg_index = np.flatnonzero(free) # stack index of each segment
+        self.seg_length = self.stack[free,0,1].astype(float)
+        self.seg_q = self.qs[free] # q at the start of each segment
+        # Segments follow each other, mirrors do not flip the direction (yet)
+        self.seg_start = self.z0 + np.concatenate(([0], np.cumsum(self.seg_length)[:-1]))
+        self.seg_end = self.seg_start + self.seg_length
+
+        # Waist of each segment lies at z = -Re(q) from the segment start
+        self.waist_zr = np.imag(self.seg_q)
+        with np.errstate(invalid="ignore"):
+            self.waist_w = np.sqrt(self.lda*self.waist_zr/pi)
+        self.waist_z = self.seg_start - np.real(self.seg_q)
+        # Tolerance keeps waists sitting exactly on a segment start from being lost to rounding
+        tol = 1E-12*np.max(self.seg_length, initial=0)
+        rel = -np.real(self.seg_q)
+        self.waist_inside = (rel >= -tol) & (rel < self.seg_length-tol)
+        self.focii = list(zip(self.waist_z[self.waist_inside], self.waist_w[self.waist_inside]))
+        self.clean = min(self.clean, int(np.searchsorted(self.seg_index, start)))
+
+    def waists(self):
+        """Returns the waists of all free space segments as a dict of arrays,
+           "z": waist position, "w": waist radius, "zr": Rayleigh range,
+           "inside": whether the waist lies within its segment"""
+        return {"z": self.waist_z,
+                "w": self.waist_w,
+                "zr": self.waist_zr,
+                "inside": self.waist_inside}
+
+    def segmentAt(self, z):
+        """Index of the free space segment containing each z, points outside the
+           line are assigned to the first/last segment"""
+        k = np.searchsorted(self.seg_start, z, side="right") - 1
+        return np.clip(k, 0, max(len(self.seg_start)-1, 0))
+
+    def q_at(self, z):
+        """q parameter at arbitrary positions z (scalar or array), evaluated analytically
+           from the segment table. Outside the line the first/last segment is extended"""
+        z = np.asarray(z, dtype=float)
+        if len(self.seg_start) == 0:
+            return np.full(z.shape, complex(np.nan, np.nan))[()]
+        k = self.segmentAt(z)
+        return (self.seg_q[k] + (z - self.seg_start[k]))[()]
+
+    def w_at(self, z):
+        """Beam radius [m] at arbitrary positions z (scalar or array)"""
+        q = self.q_at(z)
+        return w_z(np.real(q), self.lda, zr=np.imag(q))
+
+    def samplePlan(self, adaptive = False, tol = 1E-3, max_points = None):
+        """Number of samples for each free space segment.
+           Uniform mode spends n_points on every segment. Adaptive mode samples
+           uniformly in u = asinh((z-z_waist)/zr), which keeps the linear interpolation
+           error of w(z) below tol*w0 for the waist w0 of each segment. If the total
+           exceeds max_points (default n_points per segment) the spacing is widened
+           evenly so the budget holds, at least 2 points are kept per segment"""
+        nseg = len(self.seg_length)
+        if not adaptive:
+            return np.full(nseg, self.n_points, dtype=int)
+        if max_points is None:
+            max_points = self.n_points*nseg
+        zr = self.waist_zr
+        zw = -np.real(self.seg_q)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            span = np.arcsinh((self.seg_length-zw)/zr) - np.arcsinh(-zw/zr)
+        span = np.where(np.isfinite(span) & (zr > 0), span, 0)
+        # Error of linear interpolation ~ du^2*w0/8 at the waist, lower elsewhere
+        intervals = span/np.sqrt(8*tol)
+        spare = max_points - 2*nseg
+        total = np.sum(intervals)
+        if total > spare:
+            intervals = intervals*max(spare, 0)/total
+        return 2 + np.floor(intervals).astype(int)
+
+    def constructRey(self,lda = None, adaptive = False, tol = 1E-3, max_points = None,
+                     dtype = np.float64, empty = np.empty, cancelled = None):
+        """Function that construct waists vs x posision.
+           adaptive: place the samples by the local curvature of w(z), see samplePlan
+           tol: allowed interpolation error relative to the segment waist (adaptive only)
+           max_points: total sample budget for the adaptive mode
+           dtype: float type of the output arrays (float64 or float32)
+           empty: allocator of the output arrays with the signature of np.empty, e.g.
+           transport.SharedWriter.empty to write them straight into shared memory
+           cancelled: optional callable checked every CANCELCHUNK samples, once it is True
+           the sampling stops and False is returned, the previous samples stay in place
+           The output size is counted first and every segment is written in place into
+           preallocated xs/ws arrays, self.nbytes reports the memory used on the way.
+           Returns True once the samples are complete"""
+        if lda is not None and lda != self.lda:
+            self.lda = lda
+            self.traceSegments()
+        lda = self.lda
+        # Checked once, the loop below logs per segment
+        verbose = log.isEnabledFor(logging.DEBUG)
+        if verbose:
+            log.debug("q_in: %s", self.q_in)
+        self.labelqs()
+
+        counts = self.samplePlan(adaptive, tol, max_points)
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        # Samples of the unchanged leading segments are copied from the previous run
+        previous = getattr(self, "sampled", None)
+        reuse = 0
+        if previous is not None and previous["mode"] == (adaptive, tol, np.dtype(dtype)):
+            same = counts[:self.clean] == previous["counts"][:self.clean]
+            reuse = int(np.argmin(same)) if not np.all(same) else len(same)
+        # Taken over once complete, a cancelled run leaves the previous samples alone
+        allxs = empty(offsets[-1], dtype=dtype)
+        allws = empty(offsets[-1], dtype=dtype)
+        if reuse:
+            allxs[:offsets[reuse]] = previous["xs"][:offsets[reuse]]
+            allws[:offsets[reuse]] = previous["ws"][:offsets[reuse]]
+        # Shared index ramp, the only scratch memory next to the outputs
+        ramp = np.arange(np.max(counts[reuse:], initial=0), dtype=dtype)
+
+        for k in range(reuse, len(counts)):
+            L, q_in, start = self.seg_length[k], self.seg_q[k], self.seg_start[k]
+            n = counts[k]
+            if verbose:
+                log.debug("free space: %s, q_in: %s, samples: %s", L, q_in, n)
+            zr = np.imag(q_in)
+            zw = -np.real(q_in)
+            if adaptive and zr > 0:
+                u0 = np.arcsinh(-zw/zr)
+                u1 = np.arcsinh((L-zw)/zr)
+            # Long segments are written in chunks, a stale trace stops within one of them
+            for a in range(0, n, CANCELCHUNK):
+                if cancelled is not None and cancelled():
+                    return False
+                b = min(a + CANCELCHUNK, n)
+                xs = allxs[offsets[k]+a:offsets[k]+b]
+                ws = allws[offsets[k]+a:offsets[k]+b]
+                if adaptive and zr > 0:
+                    np.multiply(ramp[a:b], (u1-u0)/max(n-1, 1), out=xs)
+                    xs += u0
+                    np.sinh(xs, out=xs)
+                    xs *= zr
+                    xs += zw
+                    if a == 0:
+                        xs[0] = 0
+                    if b == n:
+                        xs[-1] = L
+                else:
+                    np.multiply(ramp[a:b], L/max(n-1, 1), out=xs)
+                # w(z) = w0*sqrt(1+(z/zr)^2) evaluated in place, z measured from the waist
+                np.add(xs, -zw, out=ws)
+                ws /= zr
+                np.square(ws, out=ws)
+                ws += 1
+                np.sqrt(ws, out=ws)
+                ws *= (lda/pi*zr)**(1/2)
+                xs += start
+
+        self.xs = allxs
+        self.ws = allws
+
+        self.nbytes = {"output": self.xs.nbytes + self.ws.nbytes,
+                       "scratch": ramp.nbytes}
+        self.nbytes["peak"] = self.nbytes["output"] + self.nbytes["scratch"]
+        if reuse:
+            self.nbytes["peak"] += previous["xs"].nbytes + previous["ws"].nbytes
+        self.sampled = {"mode": (adaptive, tol, np.dtype(dtype)), "counts": counts,
+                        "xs": self.xs, "ws": self.ws}
+        self.clean = len(counts)
+        if len(self.ws) > 0:
             self.zr = z_r(self.ws[0], lda)
-        except Exception as ex: #pylint: disable=broad-except
-            print(f"Error in zr calculation: {ex}")
-            print(f"ws: {self.ws}\nlda: {lda}")
+        else:
             self.zr = 0
-        for i in range(1,len(self.ws)-1):
-            if self.ws[i] < self.ws[i-1] and self.ws[i] < self.ws[i+1]:
-                self.focii.append((self.xs[i],self.ws[i]))
+        return True
+
+    def labelqs(self):
+        """Beam radius and q at the labels into qs_to_print"""
+        self.qs_to_print = []
+        for label, i in self.labels:
+            q = self.qs[i] if i < len(self.qs) else transformq(self.composite, self.q_in)
+            self.qs_to_print.append((label,w_z(0,self.lda,zr=np.imag(q),z0=-np.real(q)),q))
+            log.info("%s: w = %s, q = %s", *self.qs_to_print[-1])
 
-        self.xs = np.array(self.xs)
-        self.ws = np.array(self.ws)
+    def restoreSamples(self, xs, ws, counts, adaptive = False, tol = 1E-3):
+        """Take over samples computed earlier for this beam (e.g. memory-mapped from
+           tracecache) instead of running constructRey. counts: samples per segment"""
+        self.labelqs()
+        self.xs = xs
+        self.ws = ws
+        self.nbytes = {"output": xs.nbytes + ws.nbytes, "scratch": 0,
+                       "peak": xs.nbytes + ws.nbytes}
+        self.sampled = {"mode": (adaptive, tol, xs.dtype), "counts": counts,
+                        "xs": xs, "ws": ws}
+        self.clean = len(counts)
+        self.zr = z_r(ws[0], self.lda) if len(ws) > 0 else 0
@@ -0,0 +1,384 @@
+"""Headless model of the optical lines: plain python state plus the compute path.
+The tkinter classes in GUI_components are thin views that push their edits into these
+objects, nothing here touches tkinter. Lines can be built and computed from scripts,
+worker threads and processes, e.g.
+
+    line = LineModel(inputs = {"Whor": 1E-3, "Wver": 1E-3})
+    line.components.append(ComponentModel("free", {"l": 0.1}))
+    plotdata = line.compute(n = 1000)
+"""
+
+import copy
+import logging
+import itertools
+from math import radians
+import numpy as np
+
+from .matrices import cachedMatrix, matrixdicts, ringCavity, linCavity
+from .profiling import stage
+from .parallel import computeLines
+from .tracecache import TraceCache
+from .matrixcalc import (BeamTrace, OpticalSystem, buildMatrixList, calcq,
+                         cavityeigenmode, composeABCD)
+
+log = logging.getLogger(__name__)
+
+# Source of LineModel.key
+_linekeys = itertools.count()
+
+class ComponentModel:
+    """A single optical component in the GUI_matrix parameter format"""
+    def __init__(self, func = "free", params = None, hor = 1, ver = 1):
+        self.func = func
+        self.params = dict(params) if params is not None else {}
+        self.hor = hor
+        self.ver = ver
+
+    def get_params(self):
+        """Return the component parameters in the GUI_matrix format"""
+        return {"func": self.func, **self.params, "hor": self.hor, "ver": self.ver}
+
+    def matrices(self):
+        """hor/ver ABCD matrices of the component (memoised)"""
+        return cachedMatrix(self.get_params())
+
+    def state(self):
+        """Canonical dict of the component, see LineModel.state"""
+        return self.get_params()
+
+class LineModel:
+    """Open optical beamline: input beam, components and sampling of the beam trace"""
+    defaults = {"Zhor": 0,       # Distance from waist
+                "Zver": 0,       # Distance from waist
+                "ZRhor": 0,      # Rayleigh length
+                "ZRver": 0,      # Rayleigh length
+                "Whor": 1E-3,    # Beam waist
+                "Wver": 1E-3,    # Beam waist
+                "lam": 972E-9,   # Wavelength
+                "n": 1,          # Refractive index
+                "x_offset": 0}   # Offset in x
+
+    def __init__(self, inputs = None, components = None, name = "New Optical Line"):
+        # Unique for the life of the program and kept by snapshots, names the caches
+        # of this line in worker processes
+        self.key = next(_linekeys)
+        self.name = name
+        self.inputs = dict(self.defaults)
+        if inputs is not None:
+            self.inputs.update(inputs)
+        self.components = list(components) if components is not None else []
+        # Which axes to compute
+        self.plot = {"hor": True, "ver": True}
+        self.qhor = 0
+        self.qver = 0
+        self.matrices_hor = None
+        self.matrices_ver = None
+        # BeamTrace objects kept between computations for incremental updates,
+        # shared with snapshots so a worker can continue where the last run stopped
+        self.traces = {"hor": None, "ver": None}
+
+    def snapshot(self):
+        """Copy of the line state for computing elsewhere (e.g. a worker thread) while
+           the original keeps receiving edits. The BeamTrace cache is shared"""
+        snap = copy.copy(self)
+        snap.inputs = dict(self.inputs)
+        snap.plot = dict(self.plot)
+        snap.components = [copy.copy(comp) for comp in self.components]
+        for comp in snap.components:
+            if hasattr(comp, "params"):
+                comp.params = dict(comp.params)
+        return snap
+
+    def state(self):
+        """Canonical dict of everything the traces depend on, the physical content of the
+           line's savestate: model type, inputs and components. The name, the plot options
+           and the x offset (applied after sampling) are left out. Keys tracecache"""
+        return {"model": type(self).__name__,
+                "inputs": {key: val for key, val in self.inputs.items() if key != "x_offset"},
+                "components": [comp.state() for comp in self.components]}
+
+    def calcqs(self):
+        """Calculate the input q parameters of the line"""
+        self.qhor = calcq(Z = self.inputs["Zhor"],
+                          ZR = self.inputs["ZRhor"],
+                          lam = self.inputs["lam"],
+                          W = self.inputs["Whor"],
+                          n = self.inputs["n"])
+        self.qver = calcq(Z = self.inputs["Zver"],
+                          ZR = self.inputs["ZRver"],
+                          lam = self.inputs["lam"],
+                          W = self.inputs["Wver"],
+                          n = self.inputs["n"])
+        log.debug("qhor: %s, qver: %s", self.qhor, self.qver)
+
+    def buildMatrixList(self):
+        """Build the hor/ver OpticalSystems from the components"""
+        matrices = [comp.matrices() for comp in self.components]
+        self.matrices_hor = OpticalSystem([mat["hor"] for mat in matrices])
+        self.matrices_ver = OpticalSystem([mat["ver"] for mat in matrices])
+
+    def trace(self, horver, matrices, q, n, adaptive, tol, empty = np.empty, cache = None,
+              store = False, cancelled = None):
+        """Update (or create) the BeamTrace of one axis and sample it, or map the samples
+           from the tracecache.TraceCache cache if it has them. store: write a miss to it.
+           Returns None if cancelled() turned True while sampling"""
+        line = self.traces[horver]
+        if line is None:
+            line = BeamTrace(matrices, q, n_points = n, lda = self.inputs["lam"])
+        else:
+            line.update(matrices, q, lda = self.inputs["lam"], n_points = n)
+        key = cache.key(self.state(), horver, n, adaptive, tol) if cache is not None else None
+        entry = cache.load(key) if key is not None else None
+        if entry is not None:
+            line.restoreSamples(entry["xs"], entry["ws"], entry["counts"], adaptive, tol)
+        else:
+            if not line.constructRey(adaptive = adaptive, tol = tol, empty = empty,
+                                     cancelled = cancelled):
+                # Kept for the next run, the segment table and the previous samples still agree
+                self.traces[horver] = line
+                return None
+            if key is not None and store:
+                cache.store(key, line)
+        self.traces[horver] = line
+        return line
+
+    def compute(self, n = 1000, adaptive = False, tol = 1E-3, empty = np.empty, cache = None,
+                store = False, cancelled = None):
+        """Compute the beam trace, returns the plot data
+           {"hor": {"x": positions, "w": beam radii}, "ver": {...}} for the enabled axes.
+           empty: allocator of the sample arrays, see BeamTrace.constructRey. The plot data
+           are views of the BeamTrace samples, only an x offset needs a new array.
+           cache: optional tracecache.TraceCache, hits are memory-mapped read only arrays.
+           store: write the traces missing from the cache to it, for settled designs only
+           (explicit replots, loaded savestates), live edits would fill it with drafts.
+           cancelled: optional callable checked while sampling, returns None once it is True"""
+        with stage("buildMatrixList", self.name):
+            self.buildMatrixList()
+        with stage("calcqs", self.name):
+            self.calcqs()
+        plotdata = {}
+        offset = self.inputs.get("x_offset", 0)
+        for horver, matrices, q in (("hor", self.matrices_hor, self.qhor),
+                                    ("ver", self.matrices_ver, self.qver)):
+            if self.plot[horver]:
+                with stage("constructRey", self.name):
+                    line = self.trace(horver, matrices, q, n, adaptive, tol, empty, cache,
+                                      store, cancelled)
+                if line is None:
+                    return None
+                x = line.xs
+                if offset:
+                    x = np.add(x, offset, out = empty(x.shape, dtype = x.dtype))
+                plotdata[horver] = {"x": x, "w": line.ws}
+        return plotdata
+
+    def preview(self, n = 100):
+        """Coarse plot data for interactive tuning: the beam radius at n positions plus
+           the segment ends and the waists, evaluated analytically from the segment table.
+           The trace cache is left alone, previews can run next to a full computation"""
+        self.buildMatrixList()
+        self.calcqs()
+        plotdata = {}
+        offset = self.inputs.get("x_offset", 0)
+        for horver, matrices, q in (("hor", self.matrices_hor, self.qhor),
+                                    ("ver", self.matrices_ver, self.qver)):
+            if self.plot[horver]:
+                line = BeamTrace(matrices, q, n_points = n, lda = self.inputs["lam"])
+                xs = np.unique(np.concatenate((
+                    np.linspace(line.z0, line.z0 + np.sum(line.seg_length), n),
+                    line.seg_start, line.seg_end, line.waist_z[line.waist_inside])))
+                plotdata[horver] = {"x": xs + offset, "w": line.w_at(xs)}
+        return plotdata
+
+    def description(self):
+        """Snapshot of the line for raycalc.modematch: component parameters and input q"""
+        self.calcqs()
+        return {"components": [comp.get_params() for comp in self.components],
+                "qin": {"hor": self.qhor, "ver": self.qver}}
+
+class CavityModel(LineModel):
+    """Base for cavities: the input beam is the cavity eigenmode"""
+    defaults = {}
+
+    def __init__(self, inputs = None, name = "New Optical Line"):
+        super().__init__(inputs = inputs, name = name)
+        self.matrices = None
+        self.horABCD = None # pylint: disable=invalid-name
+        self.verABCD = None # pylint: disable=invalid-name
+        self.modes = None
+
+    def cavity(self):
+        """hor/ver OpticalSystems of the cavity, implemented in child classes"""
+        raise NotImplementedError
+
+    def buildMatrixList(self):
+        self.matrices = self.cavity()
+        self.matrices_hor = buildMatrixList(self.matrices["hor"])
+        self.matrices_ver = buildMatrixList(self.matrices["ver"])
+        self.horABCD = composeABCD(self.matrices_hor)
+        self.verABCD = composeABCD(self.matrices_ver)
+
+    def calcqs(self):
+        """Input q from the closed form cavity eigenmode"""
+        self.modes = {"hor": cavityeigenmode(self.horABCD, self.inputs["lam"]),
+                      "ver": cavityeigenmode(self.verABCD, self.inputs["lam"])}
+        self.qhor = self.modes["hor"]["q"]
+        self.qver = self.modes["ver"]["q"]
+
+class LinCavityModel(CavityModel):
+    """Linear cavity, curved plus flat mirror"""
+    defaults = {"lam": 972E-9,      # Wavelength
+                "l_cavity": 75E-3,  # Distance from waist
+                "R": 15E-2,         # Cavity curved mirror radius
+                "x_offset": 0}
+
+    def cavity(self):
+        return linCavity(l_cavity = self.inputs["l_cavity"], R = self.inputs["R"])
+
+class RibbonCavityModel(CavityModel):
+    """Ribbon (bow tie) cavity with an SHG crystal in the focus arm"""
+    defaults = {"lam": 972E-9,      # Wavelength
+                "l_focus": 61.6E-3, # Distance between curved focus mirrors
+                "l_free": 69.3E-3,  # Free arm length (l_cav-l_focus)
+                "l_crystal": 15E-3, # SHG crystal length
+                "R_foc": 50E-3,     # Curvature radius of curved mirrors
+                "n_SHG": 1.567,     # Refractive index of SHG crystal
+                "θ (deg)": 10,      # Angle of incidence on curved mirrors
+                "x_offset": 0}
+
+    def cavity(self):
+        return ringCavity(l_focus = self.inputs["l_focus"],
+                          l_free = self.inputs["l_free"],
+                          l_crystal = self.inputs["l_crystal"],
+                          R = self.inputs["R_foc"],
+                          n_crystal = self.inputs["n_SHG"],
+                          theta = radians(self.inputs["θ (deg)"]))
+
+class ScatterModel(LineModel):
+    """Measured points, e.g. manual waist measurements, no beam calculation.
+       components: list of {"x": position, "hor": radius or None, "ver": radius or None}"""
+    defaults = {}
+
+    def snapshot(self):
+        snap = super().snapshot()
+        snap.components = [dict(point) for point in self.components]
+        return snap
+
+    def state(self):
+        return {"model": type(self).__name__, "inputs": {},
+                "components": [dict(point) for point in self.components]}
+
+    def compute(self, n = 1000, adaptive = False, tol = 1E-3, empty = np.empty, cache = None,
+                store = False, cancelled = None):
+        plotdata = {}
+        offset = self.inputs.get("x_offset", 0)
+        for horver in ("hor", "ver"):
+            if self.plot[horver]:
+                points = [point for point in self.components if point[horver] is not None]
+                plotdata[horver] = {"x": np.array([point["x"] for point in points]) + offset,
+                                    "w": np.array([point[horver] for point in points])}
+        return plotdata
+
+    def preview(self, n = 100):
+        return self.compute()
+
+# Model classes by the line type names of the GUI and the savestates
+linemodels = {"Optical Line": LineModel,
+              "Ring Cavity": RibbonCavityModel,
+              "Linear Cavity": LinCavityModel,
+              "Scatter": ScatterModel}
+
+class SystemModel:
+    """All optical lines of the application together with the sampling settings"""
+    def __init__(self, lines = None, samples = 1000, adaptive = False, tolerance = 1E-3,
+                 parallel = False, cache = None):
+        self.lines = list(lines) if lines is not None else []
+        self.samples = samples
+        self.adaptive = adaptive
+        self.tolerance = tolerance
+        # Compute the lines in a process pool, see raycalc.parallel
+        self.parallel = parallel
+        # On-disk cache of the computed traces (tracecache.TraceCache) or None
+        self.cache = cache
+
+    @classmethod
+    def fromState(cls, state):
+        """Build the system from a LineGUI savestate (the "OptLines" entry of a save file),
+           without tkinter"""
+        lines = []
+        for optline in state["opticalLines"]:
+            item = optline["item"]
+            line = linemodels[optline["function"]](inputs = item["input"], name = item["name"])
+            line.plot = {"hor": bool(item["hor"]), "ver": bool(item["ver"])}
+            for param in item["parameters"]:
+                fields = param["fields"]
+                if optline["function"] == "Scatter":
+                    line.components.append({"x": fields["0"], "hor": fields["1"],
+                                            "ver": fields["2"]})
+                else:
+                    names = matrixdicts[param["function"]]["params"]
+                    line.components.append(ComponentModel(
+                        param["function"],
+                        {name: fields[str(i)] for i, name in enumerate(names)},
+                        param["hor"], param["ver"]))
+            lines.append(line)
+        return cls(lines,
+                   samples = state["Samples"],
+                   adaptive = bool(state.get("Adaptive", False)),
+                   tolerance = state.get("Tolerance", 1E-3),
+                   parallel = bool(state.get("Parallel", False)),
+                   cache = TraceCache() if state.get("DiskCache", False) else None)
+
+    def snapshot(self):
+        """Copy of the whole system for computing elsewhere, see LineModel.snapshot.
+           snap.origins holds the line models the snapshot was taken from"""
+        snap = copy.copy(self)
+        snap.lines = [line.snapshot() for line in self.lines]
+        snap.origins = list(self.lines)
+        return snap
+
+    def compute(self, cancelled = None, store = False):
+        """Compute every line, returns {line index: plot data}.
+           cancelled: optional callable checked between the lines and while sampling them,
+           returns None once it is True
+           store: write missing traces to the trace cache, see LineModel.compute
+           With parallel set the lines are computed in worker processes and self.lines is
+           replaced by the computed copies, so compute a snapshot, not the live models"""
+        if self.parallel and len(self.lines) > 1:
+            result = computeLines(self, cancelled, store = store)
+            if result is None:
+                return None
+            self.lines, plotdata = result
+            return plotdata
+        plotdata = {}
+        for i, line in enumerate(self.lines):
+            if cancelled is not None and cancelled():
+                return None
+            plotdata[i] = line.compute(n = self.samples, adaptive = self.adaptive,
+                                       tol = self.tolerance, cache = self.cache,
+                                       store = store, cancelled = cancelled)
+            if plotdata[i] is None:
+                return None
+        return plotdata
+
+    def preview(self, n = 100, cancelled = None):
+        """Coarse plot data of every line, see LineModel.preview"""
+        plotdata = {}
+        for i, line in enumerate(self.lines):
+            if cancelled is not None and cancelled():
+                return None
+            plotdata[i] = line.preview(n = n)
+        return plotdata
+
+    def family(self, index, setter, values, n = 100, cancelled = None):
+        """Previews of line index for a range of values of one input, e.g. the positions
+           of a slider. setter(line model, value) applies a value to a copy of the line.
+           Returns {value: plot data}, None once cancelled() is True"""
+        previews = {}
+        for value in values:
+            if cancelled is not None and cancelled():
+                return None
+            line = self.lines[index].snapshot()
+            setter(line, value)
+            previews[value] = line.preview(n = n)
+        return previews
@@ -0,0 +1,159 @@
+"""Mode matching of an optical line to a cavity mode.
+The optical line is given as a list of component parameter dicts in the GUI_matrix
+format, e.g. {"func": "free", "l": 0.1, "hor": 1, "ver": 1}, plus the input beam q.
+Chosen component parameters are tuned within bounds to maximise the mode overlap
+with the cavity mode at the end of the line. Gradients are analytic: component
+matrix derivatives by complex step, chained through the ABCD products."""
+
+import numpy as np
+from scipy.optimize import minimize, minimize_scalar
+
+from .matrices import GUI_matrix
+from .matrixcalc import stackABCD, composeABCD, transformq
+from .coupling import overlap1D, traceCoupling
+from .parallel import getPool
+
+STEP = 1E-30 # Complex step, no subtractive cancellation so it can be tiny
+# Up to this many free parameters the local optimisations take milliseconds each and run
+# inline, handing them to worker processes would cost more than it saves
+INLINEPARAMS = 6
+
+def lineq(components, freeparams, values, qin, gradient = False):
+    """Output q of the line for a batch of free parameter values.
+       components: list of GUI_matrix parameter dicts
+       freeparams: list of (component index, parameter name) pairs
+       values: (..., P) array of the free parameter values
+       qin: {"hor": q, "ver": q} of the input beam
+       Returns {"hor": q, "ver": q} with the batch shape, with gradient = True also
+       {"hor": dq, "ver": dq} with shape (..., P)"""
+    values = np.asarray(values, dtype=float)
+    params = [dict(comp) for comp in components]
+    for p, (index, name) in enumerate(freeparams):
+        params[index][name] = values[...,p]
+    matrices = [GUI_matrix(param) for param in params]
+
+    qout = {}
+    dqout = {}
+    for horver in ("hor", "ver"):
+        stack = stackABCD([mat[horver] for mat in matrices])
+        stack = np.broadcast_to(stack, values.shape[:-1] + stack.shape[-3:])
+        total = composeABCD(stack)
+        qout[horver] = transformq(total, qin[horver])
+        if not gradient:
+            continue
+        dq = np.empty(values.shape, dtype=complex)
+        for p, (index, name) in enumerate(freeparams):
+            # dM/dp of the component by complex step
+            stepped = dict(params[index])
+            stepped[name] = values[...,p] + 1j*STEP
+            dM = np.imag(GUI_matrix(stepped)[horver])/STEP
+            # d(total)/dp = after @ dM/dp @ before
+            before = composeABCD(stack[...,:index,:,:])
+            after = composeABCD(stack[...,index+1:,:,:])
+            dT = np.matmul(after, np.matmul(dM, before))
+            q0 = qin[horver]
+            q = qout[horver]
+            dq[...,p] = ((dT[...,0,0]*q0 + dT[...,0,1] - q*(dT[...,1,0]*q0 + dT[...,1,1]))
+                         /(total[...,1,0]*q0 + total[...,1,1]))
+        dqout[horver] = dq
+    if gradient:
+        return qout, dqout
+    return qout
+
+def _overlapgradient(q, dq, target):
+    """Overlap of q with target and its gradient for dq = dq/dp, shape (..., P)"""
+    eta = overlap1D(q, target)
+    x, y = np.real(q), np.imag(q)
+    xt, yt = np.real(target), np.imag(target)
+    D2 = (x-xt)**2 + (y+yt)**2
+    with np.errstate(invalid="ignore", divide="ignore"):
+        detadx = -eta*(x-xt)/D2
+        detady = eta*(1/(2*y) - (y+yt)/D2)
+    grad = detadx[...,None]*np.real(dq) + detady[...,None]*np.imag(dq)
+    return eta, grad
+
+def coupling(components, freeparams, values, qin, cavityq, gradient = False):
+    """Coupling of the line into the cavity mode for a batch of free parameter values,
+       with gradient = True returns (coupling, gradient). Unphysical results count as 0"""
+    if not gradient:
+        q = lineq(components, freeparams, values, qin)
+        eta = overlap1D(q["hor"], cavityq["hor"])*overlap1D(q["ver"], cavityq["ver"])
+        return np.nan_to_num(eta)
+    q, dq = lineq(components, freeparams, values, qin, gradient = True)
+    etah, gradh = _overlapgradient(q["hor"], dq["hor"], cavityq["hor"])
+    etav, gradv = _overlapgradient(q["ver"], dq["ver"], cavityq["ver"])
+    eta = etah*etav
+    grad = etav[...,None]*gradh + etah[...,None]*gradv
+    valid = np.isfinite(eta)[...,None] & np.all(np.isfinite(grad), axis=-1, keepdims=True)
+    return np.nan_to_num(eta), np.where(valid, grad, 0)
+
+def _localopt(args):
+    """Bounded local maximisation of the coupling from one start, runs in a worker"""
+    components, freeparams, bounds, qin, cavityq, start = args
+    def objective(x):
+        eta, grad = coupling(components, freeparams, x, qin, cavityq, gradient = True)
+        return -float(eta), -np.asarray(grad, dtype=float)
+    res = minimize(objective, start, jac=True, method="L-BFGS-B", bounds=bounds)
+    return res.x, -res.fun
+
+def optimizeLine(components, freeparams, qin, cavityq,
+                 starts = 8, screen = 4096, keep = 3, workers = None, seed = None):
+    """Tune the free parameters of an optical line to maximise the coupling into a cavity mode.
+       components: list of GUI_matrix parameter dicts of the line
+       freeparams: list of (component index, parameter name, lower bound, upper bound)
+       qin: {"hor": q, "ver": q} of the input beam
+       cavityq: {"hor": q, "ver": q} of the cavity mode at the end of the line
+       starts: number of local optimisations, seeded from the best screened points
+       screen: number of random points scored in one batch to pick the starts
+       keep: number of distinct designs to return
+       workers: processes for the local optimisations, 1 runs inline. Default: inline up
+       to INLINEPARAMS free parameters, else the persistent pool of raycalc.parallel
+       Returns a list of {"params": {(index, name): value}, "coupling": eta}, best first"""
+    names = [(index, name) for index, name, lower, upper in freeparams]
+    bounds = [(lower, upper) for index, name, lower, upper in freeparams]
+    lower, upper = np.array(bounds, dtype=float).T
+    rng = np.random.default_rng(seed)
+
+    # Screen random designs in one vectorised call, the current design included
+    current = np.array([components[index][name] for index, name in names], dtype=float)
+    candidates = lower + (upper-lower)*rng.random((screen, len(names)))
+    candidates = np.vstack((np.clip(current, lower, upper), candidates))
+    scores = coupling(components, names, candidates, qin, cavityq)
+    seeds = candidates[np.argsort(scores)[::-1][:starts]]
+
+    jobs = [(components, names, bounds, qin, cavityq, start) for start in seeds]
+    inline = workers == 1 if workers is not None else len(names) <= INLINEPARAMS
+    if not inline and len(jobs) > 1:
+        # The pool is kept between calls, only the first one pays the process start
+        results = list(getPool(workers).map(_localopt, jobs))
+    else:
+        results = [_localopt(job) for job in jobs]
+
+    # Best first, drop designs that converged onto the same optimum
+    results.sort(key=lambda res: res[1], reverse=True)
+    designs = []
+    scale = np.where(upper > lower, upper-lower, 1)
+    for x, eta in results:
+        if any(np.all(np.abs(x-np.array(list(design["params"].values())))/scale < 1E-4)
+               for design in designs):
+            continue
+        designs.append({"params": dict(zip(names, x)), "coupling": eta})
+        if len(designs) == keep:
+            break
+    return designs
+
+def bestCavityPosition(linetraces, cavityq, zmin, zmax, samples = 2001):
+    """Position on an optical line where a cavity mode couples best, i.e. where to
+       lock the cavity reference plane. linetraces: {"hor": BeamTrace, "ver": BeamTrace},
+       cavityq: {"hor": q, "ver": q} of the cavity mode at its reference plane.
+       Returns (z, coupling)"""
+    zs = np.linspace(zmin, zmax, samples)
+    etas = np.nan_to_num(traceCoupling(linetraces, cavityq, zs))
+    i = int(np.argmax(etas))
+    # Refine between the neighbouring grid points
+    lo, hi = zs[max(i-1, 0)], zs[min(i+1, samples-1)]
+    res = minimize_scalar(lambda z: -np.nan_to_num(traceCoupling(linetraces, cavityq, z)),
+                          bounds=(lo, hi), method="bounded")
+    if -res.fun >= etas[i]:
+        return float(res.x), float(-res.fun)
+    return float(zs[i]), float(etas[i])
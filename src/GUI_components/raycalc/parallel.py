@@ -0,0 +1,148 @@
+"""Parallel computation of the optical lines of a SystemModel on a persistent process pool.
+Lines are independent, so each one is computed in its own worker and the replot takes
+as long as the slowest line instead of the sum of all of them. Workers keep the
+BeamTrace caches of the lines they computed, so repeated replots stay incremental
+whenever a line lands on the same worker again. The workers write the samples and sweep
+grids straight into shared memory, see transport, and the GUI maps them without copies."""
+
+import copy
+import atexit
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from .transport import SharedWriter, attachTree
+from . import profiling
+
+# BeamTrace caches kept per worker process, least recently used are dropped
+CACHEDLINES = 32
+
+_pool = None
+_workers = None
+# Worker side: line key -> traces dict of the last computation of that line
+_traces = OrderedDict()
+# Main side: keys of released lines, sent along with the next tasks so the workers drop
+# their caches (and with them the shared blocks of the samples). Keys are never reused
+_released = deque(maxlen = 256)
+
+def getPool(workers = None):
+    """The persistent process pool, created on first use. Workers are spawned, not
+       forked, so they don't inherit the GUI's threads and tkinter state"""
+    global _pool, _workers # pylint: disable=global-statement
+    if _pool is not None and workers not in (None, _workers):
+        shutdown()
+    if _pool is None:
+        _workers = workers
+        _pool = ProcessPoolExecutor(max_workers = workers,
+                                    mp_context = multiprocessing.get_context("spawn"))
+    return _pool
+
+def shutdown():
+    """Stop the process pool"""
+    global _pool # pylint: disable=global-statement
+    if _pool is not None:
+        _pool.shutdown(cancel_futures = True)
+        _pool = None
+
+atexit.register(shutdown)
+
+def release(key):
+    """Main side: forget the worker caches of a destroyed line (LineModel.key). A worker
+       drops them, unmapping their shared blocks, with its next task"""
+    _released.append(key)
+
+def _computeLine(key, line, n, adaptive, tol, released = (), cache = None, store = False,
+                 profile = (False, False)):
+    """Worker: compute one line model, returns the model (traces without their samples,
+       which travel as the plot data), the plot data described for the transport and the
+       profiling records of the computation. profile: (enabled, trackmemory) of the GUI.
+       The samples are written into shared blocks, the cached trace keeps them mapped for
+       the next incremental run and unmaps the previous ones. Samples mapped from the
+       trace cache are copied into shared blocks by the transport"""
+    for gone in released:
+        _traces.pop(gone, None)
+    cached = _traces.pop(key, None)
+    line.traces = cached if cached is not None else {"hor": None, "ver": None}
+    profiling.enable(*profile)
+    position = profiling.mark()
+    writer = SharedWriter()
+    plotdata = line.compute(n = n, adaptive = adaptive, tol = tol, empty = writer.empty,
+                            cache = cache, store = store)
+    recorded = profiling.since(position)
+    profiling.clear()
+    _traces[key] = line.traces
+    while len(_traces) > CACHEDLINES:
+        _traces.popitem(last = False)
+    result = copy.copy(line)
+    result.traces = {}
+    for horver, trace in line.traces.items():
+        if trace is not None:
+            trace = copy.copy(trace)
+            trace.xs = trace.ws = None
+            trace.sampled = None
+        result.traces[horver] = trace
+    plotdata = writer.describeTree(plotdata)
+    writer.finish()
+    return result, plotdata, recorded
+
+def _sweep(runsweep, values):
+    """Worker: run a cavity sweep with its grids in shared blocks, returns them described.
+       The worker's mappings are gone once the result is sent"""
+    writer = SharedWriter()
+    sweep = writer.describeTree(runsweep(values, empty = writer.empty))
+    writer.finish()
+    return sweep
+
+def runSweep(runsweep, values, workers = None):
+    """Run runsweep(values, empty) (e.g. a cavity class' runsweep) in the process pool,
+       returns the sweep dict with the grids mapped zero-copy from the worker"""
+    return attachTree(getPool(workers).submit(_sweep, runsweep, values).result())
+
+def computeLines(system, cancelled = None, workers = None, store = False):
+    """Compute the lines of a SystemModel snapshot in the process pool.
+       Returns (computed line models, {line index: plot data}), None once cancelled()
+       is True. The plot data are views of shared blocks, which are unmapped with the last
+       view. Blocks of results arriving after a cancellation are mapped and dropped.
+       store: write missing traces to system.cache, see LineModel.compute
+       The workers' profiling records of the accepted results are merged into profiling"""
+    pool = getPool(workers)
+    released = tuple(_released)
+    profile = (profiling.enabled, profiling.trackmemory)
+    futures = {}
+    for i, line in enumerate(system.lines):
+        key = line.key
+        line = copy.copy(line)
+        line.traces = {"hor": None, "ver": None} # The workers keep their own caches
+        futures[pool.submit(_computeLine, key, line, system.samples,
+                            system.adaptive, system.tolerance, released,
+                            system.cache, store, profile)] = i
+    lines = list(system.lines)
+    plotdata = {}
+    pending = set(futures)
+    stopped = False
+    error = None
+    while pending:
+        done, pending = wait(pending, timeout = 0.05, return_when = FIRST_COMPLETED)
+        for future in done:
+            if future.cancelled():
+                continue
+            try:
+                line, exported, recorded = future.result()
+            except Exception as e: #pylint: disable=broad-except
+                # Keep collecting, the other results still hold shared blocks
+                error = error or e
+                continue
+            data = attachTree(exported)
+            if not stopped and error is None:
+                lines[futures[future]] = line
+                plotdata[futures[future]] = data
+                profiling.merge(recorded)
+        if not stopped and cancelled is not None and cancelled():
+            stopped = True
+            for future in pending:
+                future.cancel()
+    if error is not None:
+        raise error
+    if stopped:
+        return None
+    return lines, {i: plotdata[i] for i in range(len(lines))}
@@ -0,0 +1,173 @@
+"""Per-stage timing (and optionally memory) of the replot pipeline.
+Stages are marked with
+
+    with stage("constructRey", line = "Telescope hor"):
+        ...
+
+Disabled (the default) a stage is a shared no-op object, so the marks can stay in the
+hot paths. Enabled, every finished stage appends a record to `records`, which can be
+summarised for the GUI or exported as JSON or as a Chrome trace (chrome://tracing,
+https://ui.perfetto.dev) for offline profiling. Only the latest MAXRECORDS are kept.
+Worker processes (raycalc.parallel) record with the settings sent along with their tasks
+and return their records, which are merged here.
+
+The tracemalloc peak is process wide, so only one stage at a time measures memory.
+Stages starting while another one measures (e.g. the draw on the tkinter thread during
+a replot in the worker thread) get no peak, and the measured peak includes what other
+threads allocated meanwhile."""
+
+import os
+import time
+import threading
+import tracemalloc
+from collections import deque
+
+# Records kept, older ones are dropped
+MAXRECORDS = 100000
+
+# Switched on from the GUI or scripts
+enabled = False
+# Also record the peak traced memory of each stage (tracemalloc, slows python down)
+trackmemory = False
+# Finished stages: {"name", "line", "start" [s], "duration" [s], "pid", "thread",
+# "peak_bytes": peak traced memory above the level at the stage start, None if not tracked}
+records = deque(maxlen = MAXRECORDS)
+# Number of records appended so far, dropped ones included, see mark
+_appended = 0
+_lock = threading.Lock()
+# The stage measuring memory, None if none does
+_measuring = None
+
+class _NullStage:
+    """Stage used while disabled"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULLSTAGE = _NullStage()
+
+class Stage:
+    """Timer (and tracemalloc peak) of one stage, appends its record on exit.
+       memory: record the peak of this stage, off for stages enclosing other stages since
+       the tracemalloc peak is global"""
+    def __init__(self, name, line = None, memory = True):
+        self.name = name
+        self.line = line
+        self.memory = memory and trackmemory
+        self.start = 0
+        self.base = 0
+
+    def __enter__(self):
+        global _measuring # pylint: disable=global-statement
+        if self.memory:
+            with _lock:
+                if _measuring is None:
+                    _measuring = self
+                else:
+                    self.memory = False # Concurrent with a measuring stage
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            self.base = tracemalloc.get_traced_memory()[0]
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        global _measuring, _appended # pylint: disable=global-statement
+        end = time.perf_counter()
+        record = {"name": self.name, "line": self.line, "start": self.start,
+                  "duration": end - self.start, "pid": os.getpid(),
+                  "thread": threading.get_ident(),
+                  "peak_bytes": None}
+        if self.memory and tracemalloc.is_tracing():
+            record["peak_bytes"] = tracemalloc.get_traced_memory()[1] - self.base
+        with _lock:
+            if _measuring is self:
+                _measuring = None
+            records.append(record)
+            _appended += 1
+        return False
+
+def stage(name, line = None, memory = True):
+    """Context manager timing a stage, a no-op unless profiling is enabled"""
+    if not enabled:
+        return _NULLSTAGE
+    return Stage(name, line, memory)
+
+def enable(on = True, memory = False):
+    """Switch the instrumentation on or off, memory enables the tracemalloc peaks"""
+    global enabled, trackmemory # pylint: disable=global-statement
+    enabled = on
+    trackmemory = on and memory
+    if not trackmemory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+def clear():
+    """Forget the recorded stages"""
+    records.clear()
+
+def merge(recorded):
+    """Append records made elsewhere, e.g. returned by a worker process. Their start
+       times share the clock of this process on Linux and Windows (perf_counter is
+       system wide there)"""
+    global _appended # pylint: disable=global-statement
+    with _lock:
+        records.extend(recorded)
+        _appended += len(recorded)
+
+def mark():
+    """Current position in the stream of records, see since"""
+    return _appended
+
+def since(position):
+    """Records appended after mark() returned position, as far as they are still kept"""
+    with _lock:
+        count = min(_appended - position, len(records))
+        return list(records)[len(records)-count:] if count > 0 else []
+
+def summary(recorded = None):
+    """Short text of the total time (and largest peak) per stage, one line per optical
+       line, for the records given (default all)"""
+    recorded = list(records) if recorded is None else recorded
+    totals = {}
+    for record in recorded:
+        stages = totals.setdefault(record["line"], {})
+        duration, peak = stages.get(record["name"], (0, None))
+        if record["peak_bytes"] is not None:
+            peak = max(peak or 0, record["peak_bytes"])
+        stages[record["name"]] = (duration + record["duration"], peak)
+    lines = []
+    for line, stages in totals.items():
+        parts = []
+        for name, (duration, peak) in stages.items():
+            part = f"{name} {duration*1E3:.1f} ms"
+            if peak is not None:
+                part += f" ({peak/1024:.0f} KiB)"
+            parts.append(part)
+        lines.append(f"{line}: " + ", ".join(parts) if line is not None else ", ".join(parts))
+    return "\n".join(lines)
+
+def exportJSON(recorded = None):
+    """Records as a JSON serialisable dict"""
+    recorded = list(records) if recorded is None else recorded
+    return {"records": list(recorded)}
+
+def exportChromeTrace(recorded = None):
+    """Records in the Chrome trace event format, times in microseconds"""
+    recorded = list(records) if recorded is None else recorded
+    pid = os.getpid()
+    events = []
+    for record in recorded:
+        args = {}
+        if record["line"] is not None:
+            args["line"] = record["line"]
+        if record["peak_bytes"] is not None:
+            args["peak_bytes"] = record["peak_bytes"]
+        events.append({"name": record["name"], "cat": "replot", "ph": "X",
+                       "ts": record["start"]*1E6, "dur": record["duration"]*1E6,
+                       "pid": record.get("pid", pid), "tid": record["thread"],
+                       "args": args})
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
@@ -0,0 +1,173 @@
+"""Telescope synthesis from a catalog of stock lenses.
+Enumerates lens pairs and triples from the catalog, solves the spacings that match
+the input beam to a cavity mode and ranks the designs by coupling, total length
+and alignment sensitivity. For the last lens the spacing and the distance to the
+cavity follow in closed form, the spacing between the first lenses of a triple is
+scanned on a grid. Everything is evaluated in vectorised chunks, optionally spread
+over the persistent process pool of raycalc.parallel.
+
+Layout: source -- d1 -- lens a -- d2 -- lens b [-- d3 -- lens c] -- d_last -- cavity plane"""
+
+import os
+import csv
+import json
+import numpy as np
+
+from .coupling import overlap1D
+from .parallel import getPool
+
+def loadCatalog(filepath):
+    """Read a lens catalog, JSON {"lenses": [{"label": str, "f": float}, ...]} or a CSV file
+       with the columns label and f (focal lengths in meters).
+       Returns (focal lengths array, list of labels)"""
+    if filepath.lower().endswith(".csv"):
+        with open(filepath, "r", newline="", encoding="utf-8") as csv_file:
+            lenses = [{"label": row["label"], "f": float(row["f"])}
+                      for row in csv.DictReader(csv_file)]
+    else:
+        with open(filepath, "r", encoding="utf-8") as json_file:
+            lenses = json.load(json_file)["lenses"]
+    focals = np.array([item["f"] for item in lenses], dtype=float)
+    labels = [item.get("label", f"f = {item['f']*1E3:g} mm") for item in lenses]
+    return focals, labels
+
+def lens(q, f):
+    """q after a thin lens of focal length f"""
+    return 1/(1/q - 1/f)
+
+def closeTelescope(q, f, qt):
+    """Closed form spacing to the last lens and distance from it to the target plane.
+       q: beam right after the previous lens, f: focal length of the last lens,
+       qt: target q at the cavity plane (arrays broadcast against each other).
+       The waist size fixes the spacing: with p = q + s, Im(1/(1/p - 1/f)) = Im(qt)
+       gives (Re p - f)^2 = f^2 Im(q)/Im(qt) - Im(q)^2, two roots along the last axis.
+       Returns (spacing, q after the lens, final distance, gain of the spacing), where
+       gain = dq_out/ds = (q_after/p)^2. Roots without a real solution are nan"""
+    q, f, qt = np.broadcast_arrays(np.asarray(q)[...,None], np.asarray(f)[...,None],
+                                   np.asarray(qt)[...,None])
+    b = np.imag(q)
+    zt = np.imag(qt)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        root = np.sqrt(b*(f**2/zt - b))
+        a = f + np.array([-1, 1])*root
+        spacing = a - np.real(q)
+        p = a + 1j*b
+        qafter = lens(p, f)
+        final = np.real(qt) - np.real(qafter)
+        gain = (qafter/p)**2
+    return spacing, qafter, final, gain
+
+def _closechunk(args):
+    """Close a chunk of partial telescopes with every catalog lens, runs in a worker.
+       Returns the candidates passing the limits, as a dict of flat arrays"""
+    states, focals, qt, cavityq, dmin, maxlength, mincoupling, limit = args
+    spacing, qafter, final, gain = closeTelescope(states["q"][:,None], focals[None,:], qt)
+    qout = qafter + final
+    eta = (overlap1D(qout, cavityq["hor"])*overlap1D(qout, cavityq["ver"]))
+    length = states["length"][:,None,None] + spacing + final
+    # Sensitivity: largest |dq_out/d spacing| of all spacings, relative to the target zr
+    sens = np.maximum(np.abs(gain)*np.maximum(states["sens"][:,None,None], 1), 1)/np.imag(qt)
+    ok = ((spacing >= dmin) & (final >= dmin) & (length <= maxlength)
+          & np.isfinite(eta) & (eta >= mincoupling))
+    state, last, branch = np.nonzero(ok) # pylint: disable=unused-variable
+    found = {"state": state, "last": last,
+             "spacing": spacing[ok], "final": final[ok],
+             "coupling": eta[ok], "length": length[ok], "sensitivity": sens[ok]}
+    if len(state) > limit:
+        best = np.argsort(found["coupling"])[::-1][:limit]
+        found = {key: val[best] for key, val in found.items()}
+    return found
+
+def pareto(objectives):
+    """Mask of the non-dominated rows of an (n, k) array of objectives (lower is better)"""
+    objectives = np.asarray(objectives)
+    keep = np.ones(len(objectives), dtype=bool)
+    for i in np.argsort(objectives[:,0]):
+        if not keep[i]:
+            continue
+        dominated = (np.all(objectives >= objectives[i], axis=1)
+                     & np.any(objectives > objectives[i], axis=1))
+        keep &= ~dominated
+    return keep
+
+def synthesize(focals, qin, cavityq, d1 = 50E-3, lenses = (2, 3), labels = None,
+               dmin = 10E-3, maxlength = 2.0, grid = 16, mincoupling = 0.9,
+               keep = 20, chunk = 4096, workers = None):
+    """Search lens pairs and triples from a catalog for a telescope matching a cavity mode.
+       focals: focal lengths of the catalog [m], labels: their names
+       qin: q of the (round) input beam at the source plane
+       cavityq: {"hor": q, "ver": q} of the cavity mode at the cavity plane, the spacings
+       are solved for the mean of the two, the coupling is scored against both
+       d1: distance from the source to the first lens [m]
+       lenses: numbers of lenses to try (2 and/or 3)
+       dmin: minimum spacing between elements [m], maxlength: maximum total length [m]
+       grid: number of first-spacing values scanned for triples
+       mincoupling: candidates below this coupling are dropped
+       keep: number of designs returned
+       chunk: partial telescopes closed per batch
+       workers: processes, 1 runs inline. Default: the persistent pool of raycalc.parallel
+       Returns a list of designs, Pareto optimal in (coupling, length, sensitivity),
+       sorted by coupling then length: {"lenses": labels, "f": focal lengths,
+       "spacings": (d1, ..., d_last), "coupling", "length", "sensitivity"}. The sensitivity
+       is the largest |dq_out/d spacing|/zr of the target over all spacings [1/m]"""
+    focals = np.asarray(focals, dtype=float)
+    if labels is None:
+        labels = [f"f = {f*1E3:g} mm" for f in focals]
+    qt = (cavityq["hor"] + cavityq["ver"])/2
+    # Processes sharing the chunks, each gets about 4 tasks
+    processes = workers if workers is not None else os.cpu_count() or 1
+
+    # Partial telescopes before the last lens: beam q, lenses and spacings so far
+    q1 = lens(qin + d1, focals)
+    gain1 = np.abs((q1/(qin + d1))**2)
+    partials = []
+    if 2 in lenses:
+        partials.append({"q": q1,
+                         "lenses": np.arange(len(focals))[:,None],
+                         "spacings": np.full((len(focals), 1), d1),
+                         "sens": gain1})
+    if 3 in lenses:
+        d2 = np.linspace(dmin, maxlength, grid)
+        q2 = q1[:,None,None] + d2[None,:,None]                # (a, d2, b)
+        q2b = lens(q2, focals[None,None,:])
+        gain2 = np.abs((q2b/q2)**2)
+        shape = q2b.shape
+        a, g, b = np.unravel_index(np.arange(q2b.size), shape)
+        partials.append({"q": q2b.reshape(-1),
+                         "lenses": np.stack((a, b), axis=1),
+                         "spacings": np.stack((np.full(a.shape, d1), d2[g]), axis=1),
+                         "sens": (gain2*np.maximum(gain1[:,None,None], 1)).reshape(-1)})
+
+    designs = []
+    for partial in partials:
+        partial["length"] = np.sum(partial["spacings"], axis=1)
+        valid = partial["length"] + dmin <= maxlength
+        partial = {key: val[valid] for key, val in partial.items()}
+        jobs = [({key: val[start:start+chunk] for key, val in partial.items()},
+                 focals, qt, cavityq, dmin, maxlength, mincoupling, 4*keep)
+                for start in range(0, len(partial["q"]), chunk)]
+        if processes > 1 and len(jobs) > 1:
+            # The pool is kept between calls, only the first one pays the process start
+            results = list(getPool(workers).map(_closechunk, jobs,
+                                                chunksize = max(len(jobs)//(4*processes), 1)))
+        else:
+            results = [_closechunk(job) for job in jobs]
+        for start, found in zip(range(0, len(partial["q"]), chunk), results):
+            for i in range(len(found["state"])):
+                state = start + found["state"][i]
+                used = list(partial["lenses"][state]) + [found["last"][i]]
+                designs.append({"lenses": tuple(labels[j] for j in used),
+                                "f": tuple(float(focals[j]) for j in used),
+                                "spacings": tuple(float(d) for d in partial["spacings"][state])
+                                            + (float(found["spacing"][i]),
+                                               float(found["final"][i])),
+                                "coupling": float(found["coupling"][i]),
+                                "length": float(found["length"][i]),
+                                "sensitivity": float(found["sensitivity"][i])})
+    if not designs:
+        return []
+
+    objectives = np.array([(-d["coupling"], d["length"], d["sensitivity"]) for d in designs])
+    front = [design for design, ok in zip(designs, pareto(objectives)) if ok]
+    front.sort(key=lambda d: (-round(d["coupling"], 6), d["length"]))
+    return front[:keep]
@@ -0,0 +1,124 @@
+"""Content-addressed on-disk cache of computed beam traces.
+An entry is addressed by the hash of everything a trace depends on: the canonical state
+of the line (LineModel.state, the physical content of its savestate), the axis and the
+sampling settings. It is a directory of .npy files: the samples xs/ws and the samples per
+segment, the segment tables are rebuilt by BeamTrace.update anyway. Hits are
+memory-mapped, so reopening a savestate or switching between designs costs a few mmaps
+instead of the recompute:
+
+    cache = TraceCache("./tracecache")
+    plotdata = line.compute(n = 100000, cache = cache, store = True)
+
+Only settled designs are stored (store = True), live replots while editing just read.
+
+The total size is bounded, the least recently used entries are removed first. Small
+traces are recomputed faster than their files are opened and are not stored."""
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+# Bumped when the stored format or the sampling changes, old entries then never match
+VERSION = 2
+# Arrays of an entry
+ARRAYS = ["xs", "ws", "counts"]
+
+class TraceCache:
+    """Directory of cached traces.
+       directory: created on first store
+       maxbytes: size bound of all entries together, older entries are evicted past it
+       minbytes: traces with fewer bytes of samples are not stored"""
+    def __init__(self, directory = "./tracecache", maxbytes = 512*1024**2, minbytes = 1024**2):
+        self.directory = directory
+        self.maxbytes = maxbytes
+        self.minbytes = minbytes
+
+    def key(self, state, horver, n, adaptive = False, tol = 1E-3):
+        """Hex digest addressing the trace of one axis of a line.
+           state: canonical JSON serialisable state of the line, see LineModel.state"""
+        canonical = json.dumps({"version": VERSION, "line": state, "axis": horver,
+                                "samples": n, "adaptive": bool(adaptive),
+                                "tolerance": tol if adaptive else None},
+                               sort_keys = True, separators = (",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        """Directory of an entry"""
+        return os.path.join(self.directory, key)
+
+    def load(self, key):
+        """Memory-mapped (read only) arrays of an entry: {"xs", "ws", "counts"},
+           None on a miss. A hit marks the entry as recently used"""
+        path = self.path(key)
+        if not os.path.isdir(path):
+            return None
+        try:
+            entry = {name: np.load(os.path.join(path, name + ".npy"), mmap_mode = "r")
+                     for name in ARRAYS}
+            os.utime(path)
+        except (OSError, ValueError) as e:
+            log.warning("Dropping unreadable trace cache entry %s: %s", key, e)
+            shutil.rmtree(path, ignore_errors = True)
+            return None
+        return entry
+
+    def store(self, key, trace):
+        """Write the samples of a sampled BeamTrace, then evict down to maxbytes.
+           The entry is written under a temporary name and renamed, so concurrent readers
+           and writers (e.g. worker processes) only ever see complete entries"""
+        path = self.path(key)
+        if trace.xs.nbytes + trace.ws.nbytes < self.minbytes or os.path.isdir(path):
+            return
+        temp = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(temp, exist_ok = True)
+            arrays = {"xs": trace.xs, "ws": trace.ws, "counts": trace.sampled["counts"]}
+            for name, array in arrays.items():
+                np.save(os.path.join(temp, name + ".npy"), np.asarray(array))
+            os.rename(temp, path)
+        except OSError as e:
+            # Written by another process in the meantime, or the disk is unusable
+            log.debug("Trace cache entry %s not stored: %s", key, e)
+            shutil.rmtree(temp, ignore_errors = True)
+            return
+        self.evict()
+
+    def entries(self):
+        """(last use, size in bytes, path) of every entry"""
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for entry in os.scandir(self.directory):
+            if not entry.is_dir() or entry.name.endswith(".tmp"):
+                continue
+            try:
+                size = sum(item.stat().st_size for item in os.scandir(entry.path))
+                entries.append((entry.stat().st_mtime, size, entry.path))
+            except OSError:
+                continue # Evicted by another process
+        return entries
+
+    def size(self):
+        """Total size of the entries [bytes]"""
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """Remove the least recently used entries until the total size fits maxbytes.
+           Entries still mapped by a process stay readable there until unmapped"""
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.maxbytes:
+                break
+            shutil.rmtree(path, ignore_errors = True)
+            total -= size
+
+    def clear(self):
+        """Remove all entries"""
+        for _, _, path in self.entries():
+            shutil.rmtree(path, ignore_errors = True)
@@ -0,0 +1,127 @@
+"""Result transport between processes through named shared memory blocks.
+A worker allocates its large output arrays (BeamTrace xs/ws, sweep grids) directly in
+shared blocks with a SharedWriter and sends small descriptors instead of the arrays:
+
+    writer = SharedWriter()
+    xs = writer.empty(n)                  # written in place by the computation
+    sent = writer.describe(xs)            # ("shm", name, offset, shape, dtype)
+    writer.finish()                       # unlinks the blocks that are not sent
+
+The receiving process maps the block with attach(), a zero-copy NumPy view. Shared
+blocks are used on POSIX systems only: elsewhere (Windows) a named block is deleted with
+its last open handle, which the worker drops before the pool sends the result, so the
+arrays travel pickled there. Ownership on POSIX: the receiver unlinks the name as soon
+as it is mapped, so no block outlives a crash of the GUI in /dev/shm, and every mapping
+belongs to the arrays viewing it. A block is unmapped once the last array on it is gone,
+in the worker when its cached trace is replaced or dropped, in the GUI when the plot data
+of the line is replaced or removed."""
+
+import os
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+# Arrays from this size up are sent through shared memory [bytes]
+SHAREDBYTES = 1 << 16
+# Shared blocks outlive the worker's handles only on POSIX, see the module docstring
+SHARED = os.name == "posix"
+
+def _adopt(shm):
+    """Detach the mapping from its SharedMemory handle and return it. Arrays created on
+       the returned mmap keep it alive, it is unmapped together with the last of them
+       instead of SharedMemory.close() failing while views exist"""
+    # pylint: disable=protected-access
+    mapping = shm._mmap
+    shm._buf.release()
+    shm._buf = None
+    shm._mmap = None
+    shm.close() # Only the file descriptor is left to close
+    return mapping
+
+def _address(array):
+    """Address of the first element of an array"""
+    return array.__array_interface__["data"][0]
+
+class SharedWriter:
+    """Worker side: allocates arrays in new shared blocks and describes them for sending.
+       minbytes: smaller arrays are ordinary arrays and travel pickled"""
+    def __init__(self, minbytes = SHAREDBYTES):
+        self.minbytes = minbytes
+        # (name, array) of the blocks allocated by this writer, the arrays keep the blocks
+        # mapped (and their addresses unique) while the writer describes them
+        self.blocks = []
+        # Names of the blocks referred to by a descriptor
+        self.sent = set()
+
+    def empty(self, shape, dtype = np.float64):
+        """Uninitialised array, in a new shared block if it is large. Same signature as
+           np.empty, so it can be passed where the compute code allocates its outputs"""
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape))*dtype.itemsize
+        if not SHARED or size < self.minbytes:
+            return np.empty(shape, dtype = dtype)
+        shm = shared_memory.SharedMemory(create = True, size = size)
+        # The receiving process owns and unlinks the block
+        resource_tracker.unregister(shm._name, "shared_memory") # pylint: disable=protected-access
+        name = shm.name
+        array = np.ndarray(shape, dtype = dtype, buffer = _adopt(shm))
+        self.blocks.append((name, array))
+        return array
+
+    def describe(self, array):
+        """Descriptor of an array for sending: ("shm", name, offset, shape, dtype) if it
+           lies in a block of this writer (copied into a new block first if it is large and
+           does not), small arrays and other objects are returned as they are"""
+        if not SHARED or not isinstance(array, np.ndarray) or array.nbytes < self.minbytes:
+            return array
+        if array.flags.c_contiguous:
+            start = _address(array)
+            for name, block in self.blocks:
+                address = _address(block)
+                if address <= start and start + array.nbytes <= address + block.nbytes:
+                    self.sent.add(name)
+                    return ("shm", name, start - address, array.shape, array.dtype.str)
+        target = self.empty(array.shape, array.dtype)
+        target[...] = array
+        return self.describe(target)
+
+    def describeTree(self, tree):
+        """describe() every array of nested dicts"""
+        if isinstance(tree, dict):
+            return {key: self.describeTree(value) for key, value in tree.items()}
+        return self.describe(tree)
+
+    def finish(self):
+        """Unlink the blocks no descriptor refers to (e.g. samples only kept for the next
+           run), the receiver never sees them. Their arrays stay usable here"""
+        for name, _ in self.blocks:
+            if name not in self.sent:
+                shm = shared_memory.SharedMemory(name = name)
+                shm.unlink()
+                shm.close()
+        self.blocks = [block for block in self.blocks if block[0] in self.sent]
+
+def isDescriptor(item):
+    """True for the descriptors made by SharedWriter.describe"""
+    return isinstance(item, tuple) and len(item) == 5 and item[0] == "shm"
+
+def attach(item, mapped = None):
+    """Receiving side: zero-copy array view of a descriptor, other items are returned as
+       they are. The name is unlinked at once, the mapping lives as long as the views.
+       mapped: {name: mapping} shared by the descriptors of one result, a block is
+       opened only once even if several arrays lie in it"""
+    if not isDescriptor(item):
+        return item
+    _, name, offset, shape, dtype = item
+    mapped = {} if mapped is None else mapped
+    if name not in mapped:
+        shm = shared_memory.SharedMemory(name = name)
+        shm.unlink()
+        mapped[name] = _adopt(shm)
+    return np.ndarray(shape, dtype = np.dtype(dtype), buffer = mapped[name], offset = offset)
+
+def attachTree(tree, mapped = None):
+    """attach() every descriptor of nested dicts"""
+    mapped = {} if mapped is None else mapped
+    if isinstance(tree, dict):
+        return {key: attachTree(value, mapped) for key, value in tree.items()}
+    return attach(tree, mapped)
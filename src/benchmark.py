@@ -0,0 +1,229 @@
+"""Benchmarks for the raycalc core and the replot pipeline, runs headless (Agg backend).
+Times (best and median of several runs) and peak traced memory of each case are written
+to a JSON file, two result files can be compared to spot regressions between commits:
+
+    python benchmark.py -o before.json
+    python benchmark.py -o after.json
+    python benchmark.py --compare before.json after.json
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import atexit
+import shutil
+import tempfile
+import argparse
+import platform
+import subprocess
+import tracemalloc
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt # pylint: disable=wrong-import-position
+import numpy as np              # pylint: disable=wrong-import-position
+
+import GUI_components.raycalc.matrixcalc as rey   # pylint: disable=wrong-import-position
+import GUI_components.raycalc.matrices as mat     # pylint: disable=wrong-import-position
+from GUI_components.raycalc.model import SystemModel # pylint: disable=wrong-import-position
+from GUI_components.raycalc.tracecache import TraceCache # pylint: disable=wrong-import-position
+from GUI_components.raycalc.decimate import minmaxDecimate # pylint: disable=wrong-import-position
+
+SAMPLEDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "savestates", "samples")
+# Samples per line of the trace cache cases, large enough to be stored (TraceCache.minbytes)
+CACHEDSAMPLES = 200000
+
+def measure(func, repeats = 5, mintime = 0.2):
+    """Time func() (setup excluded, func returns nothing of interest).
+       Runs at least repeats times and mintime seconds, then once more under tracemalloc
+       for the peak memory. Returns {"best", "median" [s], "runs", "peak_bytes"}"""
+    times = []
+    start = time.perf_counter()
+    while len(times) < repeats or time.perf_counter() - start < mintime:
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+        if len(times) >= 1000:
+            break
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"best": min(times), "median": float(np.median(times)),
+            "runs": len(times), "peak_bytes": peak}
+
+def testLine(segments):
+    """Open line of alternating free space and thin lenses with the given number of
+       free space segments"""
+    system = []
+    for i in range(segments):
+        system.append(mat.free(0.1 + 0.01*(i % 7)))
+        system.append(mat.thinlens(0.2 if i % 2 else -0.3))
+    return system
+
+def coreCases(quick = False):
+    """(name, function) of the raycalc core benchmarks"""
+    cases = []
+    cav = mat.ringCavity()
+    cavhor = rey.buildMatrixList(cav["hor"])
+    cavityABCD = rey.compositeABCD(cavhor)
+    for n in ([10, 1000] if quick else [10, 100, 1000, 10000]):
+        system = testLine(n//2)
+        cases.append((f"compositeABCD/{n}", lambda system=system: rey.compositeABCD(system)))
+    for func, params in (("free", {"l": 0.1}), ("thinlens", {"f": 0.1}),
+                         ("curvedmirror", {"R": 0.05, "θ": 0.17}),
+                         ("flatrefraction", {"n1": 1, "n2": 1.5})):
+        params = {"func": func, **params, "hor": 1, "ver": 1}
+        cases.append((f"GUI_matrix/{func}", lambda params=params: mat.GUI_matrix(params)))
+    cases.append(("cavityq/ring", lambda: rey.cavityq(cavityABCD)))
+    sweep = np.broadcast_to(cavityABCD, (10000, 2, 2))
+    cases.append(("cavityq/ring x10000", lambda: rey.cavityq(sweep)))
+
+    q = rey.calcq(W = 1E-3, lam = 972E-9)
+    for segments in ([10, 1000] if quick else [10, 100, 1000]):
+        system = testLine(segments)
+        for samples in ([100, 1000] if quick else [100, 1000, 10000]):
+            if segments*samples > 2E6:
+                continue
+            def construct(system=system, samples=samples):
+                trace = rey.BeamTrace(system, q, n_points = samples)
+                trace.constructRey()
+            cases.append((f"constructRey/{segments} segments/{samples} samples", construct))
+        def adaptive(system=system):
+            trace = rey.BeamTrace(system, q, n_points = 1000)
+            trace.constructRey(adaptive = True)
+        cases.append((f"constructRey/{segments} segments/adaptive", adaptive))
+    return cases
+
+def draw(ax, plotdata):
+    """Plot the computed lines like App.draw does and render the figure"""
+    ax.cla()
+    width = ax.bbox.width
+    for line in plotdata.values():
+        for horver in ("hor", "ver"):
+            if horver in line and len(line[horver]["x"]):
+                x, w = minmaxDecimate(line[horver]["x"], line[horver]["w"],
+                                      np.min(line[horver]["x"]), np.max(line[horver]["x"]),
+                                      width)
+                ax.plot(x, w*1E3)
+    ax.figure.canvas.draw()
+
+def pipelineCases(quick = False):
+    """(name, function) of the replot pipelines of the sample savestates: building the
+       models, computing every line from scratch, an incremental recompute, drawing and
+       at CACHEDSAMPLES samples computing from scratch and reopening with a warm trace
+       cache"""
+    cases = []
+    fig, ax = plt.subplots()
+    cachedir = tempfile.mkdtemp(prefix = "reyrey_tracecache_")
+    atexit.register(shutil.rmtree, cachedir, ignore_errors = True)
+    cache = TraceCache(cachedir)
+    files = sorted(glob.glob(os.path.join(SAMPLEDIR, "*.json")))
+    if quick:
+        files = files[:2]
+    for filepath in files:
+        with open(filepath, "r", encoding="utf-8") as json_file:
+            state = json.load(json_file)["OptLines"]
+        name = os.path.splitext(os.path.basename(filepath))[0]
+        cases.append((f"pipeline/{name}/load", lambda state=state: SystemModel.fromState(state)))
+        cases.append((f"pipeline/{name}/compute",
+                      lambda state=state: SystemModel.fromState(state).compute()))
+        system = SystemModel.fromState(state)
+        system.compute()
+        cases.append((f"pipeline/{name}/recompute", system.compute))
+        parallel = SystemModel.fromState(state)
+        parallel.parallel = True
+        cases.append((f"pipeline/{name}/compute parallel",
+                      lambda parallel=parallel: parallel.snapshot().compute()))
+        plotdata = system.compute()
+        cases.append((f"pipeline/{name}/draw", lambda plotdata=plotdata: draw(ax, plotdata)))
+        large = dict(state, Samples = CACHEDSAMPLES)
+        cases.append((f"pipeline/{name}/compute large",
+                      lambda large=large: SystemModel.fromState(large).compute()))
+        cached = SystemModel.fromState(large)
+        cached.cache = cache
+        cached.compute(store = True)
+        def reopen(large=large):
+            system = SystemModel.fromState(large)
+            system.cache = cache
+            system.compute()
+        cases.append((f"pipeline/{name}/compute large cached", reopen))
+    return cases
+
+def gitCommit():
+    """Current git commit of the working tree, None outside a repository"""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(quick = False, select = None):
+    """Run the benchmarks (names containing select only), returns the result dict"""
+    results = {}
+    for name, func in coreCases(quick) + pipelineCases(quick):
+        if select is not None and select not in name:
+            continue
+        results[name] = measure(func, repeats = 3 if quick else 5,
+                                mintime = 0.05 if quick else 0.2)
+        print(f"{name:55s} {results[name]['best']*1E3:10.3f} ms "
+              f"{results[name]['peak_bytes']/1024:10.1f} KiB")
+    return {"meta": {"commit": gitCommit(),
+                     "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                     "python": platform.python_version(),
+                     "numpy": np.__version__,
+                     "matplotlib": matplotlib.__version__,
+                     "platform": platform.platform(),
+                     "quick": quick},
+            "results": results}
+
+def compare(before, after, threshold = 1.2):
+    """Print the time and memory ratios of two result files, flags cases slower than
+       threshold. Returns the number of flagged cases"""
+    with open(before, "r", encoding="utf-8") as json_file:
+        old = json.load(json_file)
+    with open(after, "r", encoding="utf-8") as json_file:
+        new = json.load(json_file)
+    print(f"{'':55s} {old['meta']['commit'] or before:>12s} {new['meta']['commit'] or after:>12s}")
+    flagged = 0
+    for name in new["results"]:
+        if name not in old["results"]:
+            continue
+        t0, t1 = old["results"][name]["best"], new["results"][name]["best"]
+        m0, m1 = old["results"][name]["peak_bytes"], new["results"][name]["peak_bytes"]
+        ratio = t1/t0 if t0 > 0 else float("inf")
+        mark = ""
+        if ratio > threshold:
+            mark = "  SLOWER"
+            flagged += 1
+        elif ratio < 1/threshold:
+            mark = "  faster"
+        print(f"{name:55s} {t0*1E3:9.3f} ms {t1*1E3:9.3f} ms  x{ratio:5.2f}"
+              f"  mem x{(m1/m0 if m0 else 1):5.2f}{mark}")
+    return flagged
+
+def main():
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-o", "--output", default="benchmark_results.json",
+                        help="JSON file for the results")
+    parser.add_argument("-k", "--select", default=None,
+                        help="only run cases whose name contains this")
+    parser.add_argument("--quick", action="store_true", help="fewer sizes and repeats")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"),
+                        help="compare two result files instead of running")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="time ratio flagged as a regression by --compare")
+    args = parser.parse_args()
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, threshold = args.threshold) else 0)
+    results = run(quick = args.quick, select = args.select)
+    with open(args.output, "w", encoding="utf-8") as json_file:
+        json.dump(results, json_file, indent=4)
+    print(f"Results written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,7 @@
 import GUI_components.raycalc.matrixcalc as rey
 import GUI_components.raycalc.matrices as mat
 import matplotlib.pyplot as plt
-from numpy import argmin
+import numpy as np
 
 samples = 10000
 
@@ -11,40 +11,42 @@ cav = mat.ringCavity()
 cavityhorM = rey.buildMatrixList(cav["hor"])
 cavityverM = rey.buildMatrixList(cav["ver"])
 teleM = rey.buildMatrixList(tele)
-horABCD = rey.compositeABCD(cavityhorM)
-verABCD = rey.compositeABCD(cavityverM)
-teleABCD = rey.compositeABCD(teleM)
+horABCD = rey.composeABCD(rey.stackABCD(cavityhorM))
+verABCD = rey.composeABCD(rey.stackABCD(cavityverM))
+teleABCD = rey.composeABCD(rey.stackABCD(teleM))
 
 print(horABCD)
 
-whor = rey.cavityq(horABCD)
-wver = rey.cavityq(verABCD)
+cavhor = rey.cavityeigenmode(horABCD, lda = 486E-9)
+cavver = rey.cavityeigenmode(verABCD, lda = 486E-9)
+whor = cavhor["q"].imag
+wver = cavver["q"].imag
 print(whor)
+print(f"m_hor: {cavhor['m']:.4}, m_ver: {cavver['m']:.4}, stable: {cavhor['stable'] and cavver['stable']}")
 
 telerey = rey.BeamTrace(teleM, rey.calcq(Z = 0, lam = 486E-9, W = 2E-3, n = 1),n_points = samples, lda = 972E-9)
 telerey.constructRey()
-cavhorey = rey.BeamTrace(cavityhorM, q_in = 1j*whor ,n_points = 2*samples, lda = 486E-9)
+cavhorey = rey.BeamTrace(cavityhorM, q_in = cavhor["q"],n_points = 2*samples, lda = 486E-9)
 cavhorey.constructRey()
-cavverey = rey.BeamTrace(cavityverM, q_in = 1j*wver ,n_points = 2*samples, lda = 486E-9)
+cavverey = rey.BeamTrace(cavityverM, q_in = cavver["q"],n_points = 2*samples, lda = 486E-9)
 cavverey.constructRey()
 
-minw = 10E-3
-mind = 0
-for i in range(len(telerey.xs)):
-    if telerey.xs[i] >= mat.d4:
-        if telerey.ws[i] <= minw:
-            minw = telerey.ws[i]
-            mind = i
-print(mind)
-#print(len(cavhorey.ws)/2)
+# Minimum waist after d4 straight from the segment table, no sampling needed
+waists = telerey.waists()
+after = waists["inside"] & (waists["z"] >= mat.d4)
+candidates = np.concatenate((waists["z"][after], [mat.d4, telerey.seg_end[-1]]))
+mind = np.argmin(telerey.w_at(candidates))
+minz = candidates[mind]
+minw = telerey.w_at(minz)
+print(minz)
 print(mat.d4)
-print(f"minw: {minw:.4} at x: {telerey.xs[mind]-mat.d4:.4}\nhorfoc: {cavhorey.ws[0]*1E6:.6},\
+print(f"minw: {minw:.4} at x: {minz-mat.d4:.4}\nhorfoc: {cavhorey.ws[0]*1E6:.6},\
       \nhormatch: {cavhorey.ws[int(len(cavhorey.ws)/2)]*1E6:.6}\nverfoc: {cavverey.ws[0]*1E6:.4},\
       \nvermatch: {cavverey.ws[int(len(cavverey.ws)/2)]*1E6:.4}\
       \ndiff: {(cavhorey.ws[int(len(cavhorey.ws)/2)]-cavverey.ws[int(len(cavverey.ws)/2)])*1E6:.4}\
       \nZ_rh: {cavhorey.zr}\nZ_rv: {cavverey.zr}")
 
-xoffset = telerey.xs[mind]
+xoffset = minz
 print(xoffset)
 #plt.plot(telerey.xs,telerey.ws, label = "Coupling beam")
 plt.plot(cavverey.xs+xoffset-cavverey.xs[-1]/2,cavverey.ws, label = "cavver")
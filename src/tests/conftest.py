@@ -0,0 +1,6 @@
+"""Tests import the GUI_components package from src, run from src with python -m pytest tests"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
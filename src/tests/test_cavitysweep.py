@@ -0,0 +1,38 @@
+"""Vectorised cavity sweeps of raycalc.cavitysweep against single designs"""
+
+import numpy as np
+import pytest
+
+from GUI_components.raycalc import cavitysweep
+from GUI_components.raycalc.matrices import ringCavity, linCavity
+from GUI_components.raycalc.matrixcalc import composeABCD, cavityeigenmode, transformq
+
+LDA = 972E-9
+
+def test_ribbon_grid_matches_points():
+    """Every grid point of a 2D sweep equals the eigenmode of that single cavity"""
+    l_focus = np.linspace(55E-3, 70E-3, 7)[:,None]
+    l_free = np.linspace(60E-3, 80E-3, 5)[None,:]
+    sweep = cavitysweep.ribbonSweep(l_focus = l_focus, l_free = l_free, lda = LDA, chunk = 8)
+    assert sweep["stable"].shape == (7, 5)
+    for i in range(7):
+        for j in range(5):
+            cavity = ringCavity(l_focus = l_focus[i,0], l_free = l_free[0,j])
+            for horver in ("hor", "ver"):
+                stack = cavity[horver].matrices
+                mode = cavityeigenmode(composeABCD(stack), LDA)
+                assert sweep[horver]["m"][i,j] == pytest.approx(mode["m"])
+                with np.errstate(invalid = "ignore"):
+                    q = transformq(composeABCD(stack[:4]), mode["q"])
+                if mode["stable"]:
+                    assert sweep[horver]["q"]["free"][i,j] == pytest.approx(q)
+                else:
+                    assert np.isnan(sweep[horver]["q"]["free"][i,j])
+
+def test_linear_stability_edge():
+    """A linear cavity with a flat and a curved mirror is stable up to l = R"""
+    sweep = cavitysweep.linSweep(l_cavity = np.array([10E-3, 40E-3, 60E-3]), R = 50E-3)
+    assert sweep["stable"].tolist() == [True, True, False]
+    mode = cavityeigenmode(composeABCD(linCavity(l_cavity = 40E-3)["hor"].matrices), LDA)
+    assert sweep["hor"]["w0"]["waist"][1] == pytest.approx(mode["w0"])
+    assert sweep["astigmatism"]["waist"][1] == pytest.approx(1)
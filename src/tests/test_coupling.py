@@ -0,0 +1,50 @@
+"""Mode overlaps of raycalc.coupling against numerical integration"""
+
+import numpy as np
+import pytest
+
+from GUI_components.raycalc import coupling
+from GUI_components.raycalc.matrixcalc import calcq, transformq, composeABCD, stackABCD
+from GUI_components.raycalc.matrices import free, thinlens
+
+LDA = 972E-9
+
+def field(x, q):
+    """1D Gaussian field of q parameter q"""
+    return np.exp(-1j*np.pi*x**2/(LDA*q))
+
+def integrated(q1, q2):
+    """|<u1|u2>|^2 of the normalised fields, by summation on a fine grid"""
+    x = np.linspace(-20E-3, 20E-3, 400001)
+    u1 = field(x, q1)
+    u2 = field(x, q2)
+    return (np.abs(np.sum(np.conj(u1)*u2))**2
+            /(np.sum(np.abs(u1)**2)*np.sum(np.abs(u2)**2)))
+
+@pytest.mark.parametrize("q1, q2", [
+    (calcq(W = 0.5E-3, lam = LDA), calcq(W = 0.5E-3, lam = LDA)),
+    (calcq(W = 0.5E-3, lam = LDA), calcq(W = 0.8E-3, lam = LDA)),
+    (calcq(Z = 0.3, W = 0.4E-3, lam = LDA), calcq(Z = -0.1, W = 0.6E-3, lam = LDA)),
+    ])
+def test_overlap_matches_integral(q1, q2):
+    assert coupling.overlap1D(q1, q2) == pytest.approx(integrated(q1, q2), rel = 1E-6)
+
+def test_overlap_broadcasts():
+    """Arrays of beams give the elementwise overlaps, astigmatic ones the product"""
+    q = calcq(W = 0.5E-3, lam = LDA)
+    others = np.array([q, calcq(W = 0.8E-3, lam = LDA)])
+    result = coupling.overlap1D(q, others)
+    assert result.shape == (2,) and result[0] == pytest.approx(1)
+    assert coupling.modeoverlap(q, q, others, others) == pytest.approx(result**2)
+
+def test_system_coupling_batch():
+    """A swept system scores like its configurations one by one"""
+    q = calcq(W = 0.5E-3, lam = LDA)
+    target = {"hor": calcq(W = 0.3E-3, lam = LDA), "ver": calcq(W = 0.3E-3, lam = LDA)}
+    lengths = np.linspace(50E-3, 150E-3, 5)
+    system = [free(lengths), thinlens(100E-3), free(100E-3)]
+    result = coupling.systemCoupling(system, system, {"hor": q, "ver": q}, target)
+    for length, value in zip(lengths, result):
+        qout = transformq(composeABCD(stackABCD([free(length), thinlens(100E-3),
+                                                 free(100E-3)])), q)
+        assert value == pytest.approx(coupling.overlap1D(qout, target["hor"])**2)
@@ -0,0 +1,35 @@
+"""Min/max decimation of raycalc.decimate"""
+
+import numpy as np
+
+from GUI_components.raycalc.decimate import minmaxDecimate
+
+def test_keeps_extrema():
+    """Every interval keeps its minimum and maximum, the view ends are kept"""
+    rng = np.random.default_rng(2)
+    x = np.sort(rng.uniform(0, 10, 100000))
+    y = np.cumsum(rng.normal(size = x.size))
+    buckets = 100
+    xd, yd = minmaxDecimate(x, y, 2, 8, buckets)
+    assert len(xd) <= 2*buckets + 2
+    assert np.all(np.diff(xd) >= 0)
+    assert xd[0] < 2 and xd[-1] > 8 # points just outside the view
+    edges = np.linspace(2, 8, buckets + 1)
+    for lo, hi in zip(edges[:-1], edges[1:]):
+        inside = (x >= lo) & (x < hi)
+        kept = (xd >= lo) & (xd < hi)
+        assert np.min(y[inside]) in yd[kept]
+        assert np.max(y[inside]) in yd[kept]
+
+def test_narrow_waist_survives():
+    """A single low sample, e.g. a tight focus, is kept"""
+    x = np.linspace(0, 1, 1000001)
+    y = np.ones_like(x)
+    y[123457] = 1E-3
+    xd, yd = minmaxDecimate(x, y, 0, 1, 500)
+    assert len(xd) < 2000 and 1E-3 in yd and x[123457] in xd
+
+def test_small_inputs_unchanged():
+    x = np.arange(10.0)
+    xd, yd = minmaxDecimate(x, x, 0, 9, 100)
+    assert xd is x and yd is x
@@ -0,0 +1,25 @@
+"""Component factories and the memoised matrices of raycalc.matrices"""
+
+import numpy as np
+
+from GUI_components.raycalc import matrices as mat
+
+def test_factories_broadcast():
+    """Array parameters give a stack of the scalar matrices"""
+    f = np.array([50E-3, 100E-3, 200E-3])
+    stack = mat.thinlens(f)
+    assert stack.shape == (3, 2, 2)
+    for i, value in enumerate(f):
+        assert np.array_equal(stack[i], mat.thinlens(value))
+    assert mat.curvedmirrorhor(R = f[:,None], theta = np.zeros(2)).shape == (3, 2, 2, 2)
+
+def test_cached_matrix_is_a_copy():
+    """Hits are read only and assigning to the returned dict leaves the cache alone"""
+    params = {"func": "thinlens", "f": 0.1, "hor": 1, "ver": 0}
+    first = mat.cachedMatrix(params)
+    assert np.array_equal(first["hor"], mat.GUI_matrix(params)["hor"])
+    assert np.array_equal(first["ver"], np.eye(2))
+    assert not first["hor"].flags.writeable
+    first["hor"] = None
+    assert mat.cachedMatrix(params)["hor"] is not None
+    assert mat.cachedMatrix(dict(params, f = np.array([0.1, 0.2])))["hor"].shape == (2, 2, 2)
@@ -0,0 +1,161 @@
+"""Numerics of raycalc.matrixcalc: composition, eigenmodes and the sampled BeamTrace"""
+
+import numpy as np
+import pytest
+
+from GUI_components.raycalc import matrixcalc as rey
+from GUI_components.raycalc.matrices import (free, thinlens, flatrefraction, linCavity,
+                                             ringCavity)
+
+LDA = 972E-9
+
+def telescope(f2 = 50E-3):
+    """Free space and two lenses, the second focal length as given"""
+    return rey.OpticalSystem([free(50E-3), thinlens(150E-3), free(201.8E-3),
+                              thinlens(f2), free(500E-3)],
+                             [None, "f1", None, "f2", None])
+
+def qin():
+    return rey.calcq(W = 0.5E-3, lam = LDA)
+
+def test_compose_matches_loop():
+    """Composite and prefix products of a batch equal the matrix products in beam order"""
+    rng = np.random.default_rng(1)
+    matrices = rng.normal(size = (3, 7, 2, 2))
+    composite, prefixes = rey.composeABCD(matrices, prefix = True)
+    assert np.allclose(rey.composeABCD(matrices), composite)
+    for b in range(3):
+        product = np.eye(2)
+        assert np.allclose(prefixes[b, 0], product)
+        for k in range(7):
+            product = matrices[b, k] @ product
+            assert np.allclose(prefixes[b, k+1], product)
+        assert np.allclose(composite[b], product)
+
+def test_compose_empty():
+    assert np.array_equal(rey.composeABCD(np.empty((0, 2, 2))), np.eye(2))
+
+@pytest.mark.parametrize("l_cavity", [20E-3, 30E-3, 45E-3])
+def test_eigenmode_self_consistent(l_cavity):
+    """The eigenmode q reproduces itself after a round trip"""
+    roundtrip = rey.composeABCD(linCavity(l_cavity = l_cavity)["hor"].matrices)
+    mode = rey.cavityeigenmode(roundtrip, LDA)
+    assert mode["stable"]
+    assert np.isclose(rey.transformq(roundtrip, mode["q"]), mode["q"])
+    assert np.isclose(mode["w0"], np.sqrt(LDA*np.imag(mode["q"])/np.pi))
+
+def test_eigenmode_batch_and_unstable():
+    """A batch gives the same modes as single matrices, unstable ones are flagged nan"""
+    roundtrips = rey.composeABCD(linCavity(l_cavity = np.array([30E-3, 60E-3]))["hor"].matrices)
+    modes = rey.cavityeigenmode(roundtrips, LDA)
+    assert modes["stable"].tolist() == [True, False]
+    assert np.isclose(modes["q"][0], rey.cavityeigenmode(roundtrips[0], LDA)["q"])
+    assert np.isnan(modes["q"][1]) and abs(modes["m"][1]) > 1
+    ring = rey.composeABCD(ringCavity()["hor"].matrices)
+    mode = rey.cavityeigenmode(ring, LDA)
+    assert np.isclose(rey.transformq(ring, mode["q"]), mode["q"])
+
+def test_adaptive_within_tolerance():
+    """Linear interpolation of the adaptive samples stays within tol*w0 of every segment"""
+    tol = 1E-3
+    trace = rey.BeamTrace(telescope(), qin(), n_points = 2000, lda = LDA)
+    counts = trace.samplePlan(adaptive = True, tol = tol)
+    assert np.sum(counts) < trace.n_points*len(counts) # budget is not binding
+    trace.constructRey(adaptive = True, tol = tol)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    for k in range(len(counts)):
+        xs = trace.xs[offsets[k]:offsets[k+1]]
+        ws = trace.ws[offsets[k]:offsets[k+1]]
+        dense = np.linspace(xs[0], xs[-1], 200001)
+        exact = rey.w_z(dense - trace.waist_z[k], LDA, zr = trace.waist_zr[k])
+        error = np.max(np.abs(np.interp(dense, xs, ws) - exact))
+        assert error <= tol*trace.waist_w[k]
+
+def test_uniform_matches_analytic():
+    """Uniform samples are the beam radius of the analytic segment table"""
+    trace = rey.BeamTrace(telescope(), qin(), n_points = 500, lda = LDA)
+    trace.constructRey()
+    assert len(trace.xs) == 500*3
+    assert np.all(np.diff(trace.xs) >= 0)
+    assert np.allclose(trace.ws[1:-1], trace.w_at(trace.xs[1:-1]), rtol = 1E-9)
+    assert trace.xs[-1] == pytest.approx(50E-3 + 201.8E-3 + 500E-3)
+
+def test_preallocated_outputs():
+    """Samples go into the arrays of the given allocator, float32 agrees with float64"""
+    allocated = []
+    def empty(shape, dtype = np.float64):
+        allocated.append(np.empty(shape, dtype = dtype))
+        return allocated[-1]
+    trace = rey.BeamTrace(telescope(), qin(), n_points = 300, lda = LDA)
+    trace.constructRey(empty = empty)
+    assert trace.xs is allocated[0] and trace.ws is allocated[1]
+    assert trace.nbytes["output"] == trace.xs.nbytes + trace.ws.nbytes
+    single = rey.BeamTrace(telescope(), qin(), n_points = 300, lda = LDA)
+    single.constructRey(dtype = np.float32)
+    assert single.ws.dtype == np.float32
+    assert np.allclose(single.ws, trace.ws, rtol = 1E-5)
+
+@pytest.mark.parametrize("adaptive", [False, True])
+def test_update_matches_fresh(adaptive):
+    """An updated (incrementally resampled) trace equals a trace built from scratch"""
+    trace = rey.BeamTrace(telescope(), qin(), n_points = 400, lda = LDA)
+    trace.constructRey(adaptive = adaptive)
+    k = trace.update(telescope(f2 = 40E-3))
+    assert k == 3
+    trace.constructRey(adaptive = adaptive)
+    fresh = rey.BeamTrace(telescope(f2 = 40E-3), qin(), n_points = 400, lda = LDA)
+    fresh.constructRey(adaptive = adaptive)
+    assert np.allclose(trace.prefixes, fresh.prefixes)
+    assert np.allclose(trace.seg_q, fresh.seg_q)
+    assert np.allclose(trace.waist_z, fresh.waist_z)
+    # Prefixes are multiplied in a different order, equal up to rounding
+    assert np.allclose(trace.xs, fresh.xs, rtol = 1E-12, atol = 0)
+    assert np.allclose(trace.ws, fresh.ws, rtol = 1E-12, atol = 0)
+    assert [label for label, _, _ in trace.qs_to_print] == ["f1", "f2"]
+
+def test_flat_refraction_scales_q():
+    """Entering a medium of index n multiplies q by n and the Rayleigh range grows n
+       times. The radius, evaluated with the vacuum wavelength, jumps by sqrt(n)"""
+    n = 1.5
+    system = rey.OpticalSystem([free(0.1), flatrefraction(1, n), free(0.2)])
+    trace = rey.BeamTrace(system, qin(), n_points = 100, lda = LDA)
+    assert trace.seg_q[1] == pytest.approx((qin() + 0.1)*n)
+    assert trace.waist_zr[1] == pytest.approx(n*trace.waist_zr[0])
+    trace.constructRey()
+    assert trace.ws[100] == pytest.approx(trace.ws[99]*np.sqrt(n))
+    mirror = rey.BeamTrace(rey.OpticalSystem([free(0.1), flatrefraction(), free(0.2)]),
+                           qin(), lda = LDA)
+    assert mirror.seg_q[1] == pytest.approx(qin() + 0.1)
+
+def test_update_input_beam():
+    """A new input q retraces every segment"""
+    trace = rey.BeamTrace(telescope(), qin(), n_points = 100, lda = LDA)
+    trace.constructRey()
+    trace.update(telescope(), q_in = rey.calcq(W = 1E-3, lam = LDA))
+    trace.constructRey()
+    fresh = rey.BeamTrace(telescope(), rey.calcq(W = 1E-3, lam = LDA), n_points = 100, lda = LDA)
+    fresh.constructRey()
+    assert np.array_equal(trace.ws, fresh.ws)
+
+@pytest.mark.parametrize("adaptive", [False, True])
+def test_cancelled_sampling(monkeypatch, adaptive):
+    """Sampling stops within a chunk once cancelled, keeps the previous samples and
+       gives the same samples in chunks as in one go"""
+    whole = rey.BeamTrace(telescope(f2 = 40E-3), qin(), n_points = 1000, lda = LDA)
+    whole.constructRey(adaptive = adaptive)
+    monkeypatch.setattr(rey, "CANCELCHUNK", 64)
+    trace = rey.BeamTrace(telescope(), qin(), n_points = 1000, lda = LDA)
+    trace.constructRey(adaptive = adaptive)
+    previous = trace.ws
+    trace.update(telescope(f2 = 40E-3))
+    # Only the last segment is resampled, adaptive sampling spends few points on it
+    stop = 0 if adaptive else 3
+    checks = []
+    def cancelled():
+        checks.append(1)
+        return len(checks) > stop
+    assert trace.constructRey(adaptive = adaptive, cancelled = cancelled) is False
+    assert len(checks) == stop + 1 and trace.ws is previous
+    assert trace.constructRey(adaptive = adaptive, cancelled = lambda: False) is True
+    assert np.allclose(trace.ws, whole.ws, rtol = 1E-12, atol = 0)
+    assert np.allclose(trace.xs, whole.xs, rtol = 1E-12, atol = 0)
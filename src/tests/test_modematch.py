@@ -0,0 +1,39 @@
+"""Mode matching of raycalc.modematch and the headless helpers of the GUI window"""
+
+import numpy as np
+import pytest
+
+from GUI_components.GUI_ModeMatch import cavitymode, linetraces
+from GUI_components.raycalc.model import LineModel, ComponentModel, LinCavityModel
+from GUI_components.raycalc.modematch import optimizeLine, bestCavityPosition, coupling
+from GUI_components.raycalc.coupling import traceCoupling
+
+def line():
+    return LineModel(components = [ComponentModel("free", {"l": 0.1}),
+                                   ComponentModel("thinlens", {"f": 0.1}),
+                                   ComponentModel("free", {"l": 0.2})])
+
+def test_optimize_reaches_the_mode():
+    """A lens and a distance are enough to match a round beam into a cavity mode"""
+    cavityq = cavitymode(LinCavityModel(inputs = {"l_cavity": 0.05, "R": 0.1}))
+    description = line().description()
+    freeparams = [(1, "f", 0.02, 0.5), (2, "l", 0, 0.5)]
+    designs = optimizeLine(description["components"], freeparams, description["qin"],
+                           cavityq, seed = 1)
+    best = designs[0]
+    assert best["coupling"] == pytest.approx(1, abs = 1E-6)
+    values = [best["params"][(index, name)] for index, name, _, _ in freeparams]
+    assert coupling(description["components"], [(1, "f"), (2, "l")], values,
+                    description["qin"], cavityq) == pytest.approx(best["coupling"])
+    for index, name, lower, upper in freeparams:
+        assert lower <= best["params"][(index, name)] <= upper
+
+def test_best_position_matches_scan():
+    """The cavity lock position is the maximum of a dense scan along the line"""
+    cavityq = cavitymode(LinCavityModel(inputs = {"l_cavity": 0.05, "R": 0.1}))
+    traces = linetraces(line())
+    z, eta = bestCavityPosition(traces, cavityq, 0, 0.3)
+    zs = np.linspace(0, 0.3, 300001)
+    scan = np.nan_to_num(traceCoupling(traces, cavityq, zs))
+    assert eta >= np.max(scan) - 1E-9
+    assert z == pytest.approx(zs[np.argmax(scan)], abs = 1E-5)
@@ -0,0 +1,46 @@
+"""Stage records of raycalc.profiling, also from the process pool"""
+
+import os
+import pytest
+
+from GUI_components.raycalc import profiling
+from GUI_components.raycalc.model import SystemModel, LineModel, ComponentModel
+
+def system(parallel):
+    lines = [LineModel(components = [ComponentModel("free", {"l": 0.1}),
+                                     ComponentModel("thinlens", {"f": f}),
+                                     ComponentModel("free", {"l": 0.2})],
+                       name = f"line {i}")
+             for i, f in enumerate((0.1, 0.2, 0.3))]
+    return SystemModel(lines, samples = 2000, parallel = parallel)
+
+@pytest.fixture
+def profiled():
+    profiling.clear()
+    profiling.enable(True)
+    yield
+    profiling.enable(False)
+    profiling.clear()
+
+@pytest.mark.parametrize("parallel", [False, True])
+def test_line_stages_recorded(profiled, parallel): # pylint: disable=redefined-outer-name,unused-argument
+    """Every line reports its stages, computed inline or in worker processes"""
+    position = profiling.mark()
+    assert system(parallel).snapshot().compute() is not None
+    recorded = profiling.since(position)
+    stages = {(record["line"], record["name"]) for record in recorded}
+    for i in range(3):
+        for name in ("buildMatrixList", "calcqs", "constructRey"):
+            assert (f"line {i}", name) in stages
+    pids = {record["pid"] for record in recorded}
+    assert (os.getpid() not in pids) == parallel
+    assert "line 2: buildMatrixList" in profiling.summary(recorded)
+    events = profiling.exportChromeTrace(recorded)["traceEvents"]
+    assert {event["pid"] for event in events} == pids
+
+def test_disabled_records_nothing():
+    """Without profiling neither the workers nor this process record anything"""
+    profiling.clear()
+    position = profiling.mark()
+    system(True).snapshot().compute()
+    assert profiling.since(position) == []
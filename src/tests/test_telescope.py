@@ -0,0 +1,33 @@
+"""Telescope synthesis of raycalc.telescope"""
+
+import numpy as np
+import pytest
+
+from GUI_components.raycalc import telescope
+from GUI_components.raycalc.matrixcalc import calcq
+
+LDA = 972E-9
+
+def search(workers):
+    focals = np.array([25, 30, 40, 50, 75, 100, 125, 150, 200, 250, 300, 400, 500])*1E-3
+    target = calcq(W = 0.2E-3, lam = LDA)
+    return telescope.synthesize(focals, calcq(W = 1E-3, lam = LDA),
+                                {"hor": target, "ver": target}, chunk = 64,
+                                workers = workers)
+
+def test_designs_match_the_mode():
+    """Returned designs reach the target mode when traced lens by lens"""
+    designs = search(workers = 1)
+    assert designs and designs[0]["coupling"] > 0.999
+    target = calcq(W = 0.2E-3, lam = LDA)
+    for design in designs[:3]:
+        q = calcq(W = 1E-3, lam = LDA)
+        for f, spacing in zip(design["f"], design["spacings"]):
+            q = telescope.lens(q + spacing, f)
+        q += design["spacings"][-1]
+        assert q == pytest.approx(target, abs = 1E-9)
+        assert design["length"] == pytest.approx(sum(design["spacings"]))
+
+def test_pool_matches_inline():
+    """The chunks give the same designs on the process pool"""
+    assert search(workers = 2) == search(workers = 1)
@@ -0,0 +1,94 @@
+"""Round trips through raycalc.tracecache"""
+
+import numpy as np
+
+from GUI_components.raycalc.tracecache import TraceCache
+from GUI_components.raycalc.matrixcalc import BeamTrace, OpticalSystem, calcq
+from GUI_components.raycalc.matrices import free, thinlens
+from GUI_components.raycalc.model import LineModel, ComponentModel
+
+def sampled(n = 1000, f = 100E-3):
+    trace = BeamTrace(OpticalSystem([free(0.1), thinlens(f), free(0.2)]),
+                      calcq(W = 0.5E-3, lam = 972E-9), n_points = n)
+    trace.constructRey()
+    return trace
+
+def components():
+    return [ComponentModel("free", {"l": 0.1}), ComponentModel("thinlens", {"f": 0.1}),
+            ComponentModel("free", {"l": 0.2})]
+
+def test_store_load(tmp_path):
+    """Stored samples load back equal, read only and memory-mapped"""
+    cache = TraceCache(str(tmp_path), minbytes = 0)
+    trace = sampled()
+    key = cache.key({"line": 1}, "hor", 1000)
+    assert cache.load(key) is None
+    cache.store(key, trace)
+    entry = cache.load(key)
+    assert np.array_equal(entry["xs"], trace.xs)
+    assert np.array_equal(entry["ws"], trace.ws)
+    assert np.array_equal(entry["counts"], trace.sampled["counts"])
+    assert isinstance(entry["xs"], np.memmap) and not entry["xs"].flags.writeable
+    restored = sampled(f = 200E-3) # the segment table comes from update, not the cache
+    restored.restoreSamples(entry["xs"], entry["ws"], entry["counts"])
+    assert np.array_equal(restored.ws, trace.ws) and restored.clean == 2
+
+def test_keys():
+    """Keys depend on the state and every sampling setting, not on the dict order"""
+    cache = TraceCache()
+    key = cache.key({"a": 1, "b": 2}, "hor", 1000)
+    assert key == cache.key({"b": 2, "a": 1}, "hor", 1000)
+    assert len({key, cache.key({"a": 1, "b": 3}, "hor", 1000),
+                cache.key({"a": 1, "b": 2}, "ver", 1000),
+                cache.key({"a": 1, "b": 2}, "hor", 2000),
+                cache.key({"a": 1, "b": 2}, "hor", 1000, adaptive = True)}) == 5
+
+def test_minbytes_and_eviction(tmp_path):
+    """Small traces are not stored, the least recently used entries go first"""
+    cache = TraceCache(str(tmp_path))
+    cache.store(cache.key({}, "hor", 1000), sampled())
+    assert cache.entries() == []
+    cache.minbytes = 0
+    trace = sampled()
+    cache.maxbytes = 2.5*(trace.xs.nbytes + trace.ws.nbytes)
+    keys = [cache.key({"n": i}, "hor", 1000) for i in range(3)]
+    cache.store(keys[0], trace)
+    cache.store(keys[1], trace)
+    cache.load(keys[0]) # keys[1] is now the oldest
+    times = {entry[2]: entry[0] for entry in cache.entries()}
+    assert times[cache.path(keys[0])] >= times[cache.path(keys[1])]
+    cache.store(keys[2], trace)
+    assert cache.load(keys[1]) is None
+    assert cache.load(keys[0]) is not None and cache.load(keys[2]) is not None
+    assert cache.size() <= cache.maxbytes
+    cache.clear()
+    assert cache.entries() == []
+
+def test_model_store_flag(tmp_path):
+    """Line models only read the cache unless asked to store"""
+    cache = TraceCache(str(tmp_path), minbytes = 0)
+    line = LineModel(components = components())
+    line.compute(n = 500, cache = cache)
+    assert cache.entries() == []
+    plotdata = line.compute(n = 500, cache = cache, store = True)
+    assert len(cache.entries()) == 2
+    again = LineModel(components = components(), name = "renamed")
+    cached = again.compute(n = 500, cache = cache)
+    assert isinstance(cached["hor"]["w"], np.memmap)
+    assert np.array_equal(cached["hor"]["w"], plotdata["hor"]["w"])
+
+def test_cancelled_compute_not_stored(tmp_path, monkeypatch):
+    """A cancelled computation returns None and leaves nothing in the cache"""
+    from GUI_components.raycalc import matrixcalc
+    from GUI_components.raycalc.model import SystemModel
+    monkeypatch.setattr(matrixcalc, "CANCELCHUNK", 100)
+    cache = TraceCache(str(tmp_path), minbytes = 0)
+    system = SystemModel([LineModel(components = components())], samples = 1000, cache = cache)
+    calls = []
+    assert system.compute(cancelled = lambda: calls.append(1) or len(calls) > 2,
+                          store = True) is None
+    assert cache.entries() == []
+    plotdata = system.compute(store = True)
+    fresh = LineModel(components = components()).compute(n = 1000)
+    assert np.array_equal(plotdata[0]["hor"]["w"], fresh["hor"]["w"])
+    assert len(cache.entries()) == 2
@@ -0,0 +1,78 @@
+"""Round trips through raycalc.transport, run from src with python -m pytest tests"""
+
+import numpy as np
+import pytest
+from multiprocessing import shared_memory
+
+from GUI_components.raycalc import transport
+
+N = 100000 # Samples of a large array, well above SHAREDBYTES
+
+def exists(name):
+    """True if a shared block of that name can still be opened"""
+    try:
+        shm = shared_memory.SharedMemory(name = name)
+    except FileNotFoundError:
+        return False
+    shm.close()
+    shm.unlink()
+    return True
+
+@pytest.mark.skipif(not transport.SHARED, reason = "shared blocks are POSIX only")
+def test_roundtrip():
+    """Written arrays, views into them and copied arrays come back equal and zero-copy,
+       every name is unlinked once attached"""
+    writer = transport.SharedWriter()
+    xs = writer.empty(N)
+    xs[:] = np.arange(N)
+    tree = {"x": xs, "tail": xs[10:], "nested": {"w": np.arange(N)*2.0,
+                                                 "q": np.arange(N)*1j},
+            "small": np.ones(3), "label": "hor"}
+    described = writer.describeTree(tree)
+    writer.finish()
+    names = {item[1] for item in (described["x"], described["tail"],
+                                  described["nested"]["w"], described["nested"]["q"])}
+    assert len(names) == 3 # x and its tail share a block
+    del writer, xs, tree
+    result = transport.attachTree(described)
+    assert np.array_equal(result["x"], np.arange(N))
+    assert np.array_equal(result["tail"], np.arange(10, N))
+    assert np.array_equal(result["nested"]["w"], np.arange(N)*2.0)
+    assert np.array_equal(result["nested"]["q"], np.arange(N)*1j)
+    assert np.array_equal(result["small"], np.ones(3)) and result["label"] == "hor"
+    assert not any(exists(name) for name in names)
+
+@pytest.mark.skipif(not transport.SHARED, reason = "shared blocks are POSIX only")
+def test_copies_get_distinct_blocks():
+    """Arrays copied in by describe must not alias, their temporaries are dropped in
+       between and the next block may be mapped at the same address"""
+    writer = transport.SharedWriter()
+    arrays = [np.full(N, float(i)) for i in range(4)]
+    described = [writer.describe(array) for array in arrays]
+    writer.finish()
+    assert len({item[1] for item in described}) == len(arrays)
+    for i, item in enumerate(described):
+        assert np.all(transport.attach(item) == i)
+
+@pytest.mark.skipif(not transport.SHARED, reason = "shared blocks are POSIX only")
+def test_finish_unlinks_unsent():
+    """Blocks nobody describes are unlinked by finish and stay usable in the writer"""
+    writer = transport.SharedWriter()
+    kept = writer.empty(N)
+    kept[:] = 1
+    name = writer.blocks[0][0]
+    writer.finish()
+    assert not exists(name)
+    assert np.all(kept == 1)
+
+def test_pickled_without_shared_memory(monkeypatch):
+    """Without shared blocks (non-POSIX) arrays are ordinary and travel as they are"""
+    monkeypatch.setattr(transport, "SHARED", False)
+    writer = transport.SharedWriter()
+    xs = writer.empty(N)
+    xs[:] = 2
+    assert not writer.blocks
+    described = writer.describeTree({"x": xs})
+    writer.finish()
+    assert described["x"] is xs
+    assert transport.attachTree(described)["x"] is xs
@@ -1,10 +1,11 @@
 import os
 import json
+import logging
 import tkinter as tk
 from tkinter import filedialog
 import numpy as np
 
-debug = True
+log = logging.getLogger(__name__)
 
 def ChooseFolder(initdir = ".."):
     # Initialise tkinter window
@@ -26,7 +27,7 @@ def SaveFileAs(filepath = ".."):
     
     # Prompt to choose the files to process.
     file = filedialog.asksaveasfilename(defaultextension=".json", initialdir = filepath)
-    if debug: print(file)
+    log.debug("Chosen file: %s", file)
     root.destroy()
     
     return file
@@ -50,7 +51,7 @@ def ChooseSingleFile(initdir = ".."):
     
     # Prompt to choose the files to process.
     file = filedialog.askopenfilename(initialdir = initdir)
-    if debug: print(file)
+    log.debug("Chosen file: %s", file)
     
     root.destroy()
     # Return filenames as simple list
@@ -60,7 +61,7 @@ def CheckFolder(folderpath):
     # Check whether folder exists, create it if not
     if not os.path.exists(folderpath):
         os.makedirs(folderpath)
-        print("Folder created: " + folderpath)
+        log.info("Folder created: %s", folderpath)
 
 def WriteJson(filepath, dict):
     # Writes a dictionary to a json file
@@ -163,17 +164,19 @@ def ReadDat_dict(filepath = None):
     for i in range(len(keys)):
         keys[i] = keys[i].strip()
         data[keys[i]] = []
+    verbose = log.isEnabledFor(logging.DEBUG)
     for line in lines:
         if line[0] == "#":
             continue
         else:
-            print("Line: "+line)
+            if verbose:
+                log.debug("Line: %s", line)
             line = line.split("\t")
             for i in range(len(line)):
                 try:
                     data[keys[i]].append(float(line[i]))
                 except KeyError:
-                    print("Key fucked")
+                    log.warning("No key for column %d in %s", i, filepath)
                 except ValueError:
                     data[keys[i]].append(eval(line[i]))
     
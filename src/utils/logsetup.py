@@ -0,0 +1,34 @@
+"""Logging setup of the application.
+Every module logs through its own logger, log = logging.getLogger(__name__), with lazy
+%-style arguments (log.debug("q: %s", q)), so a disabled level does no string formatting.
+Loops guard their messages with log.isEnabledFor once before the loop.
+
+Levels are set per module or package (logger name prefix), from the code or from the
+REYREY_LOG environment variable, e.g.
+
+    REYREY_LOG="INFO,GUI_components.raycalc.matrixcalc=DEBUG" python GUI.py
+
+sets INFO for everything (e.g. the beam size at labels) and DEBUG for matrixcalc only."""
+
+import os
+import logging
+
+FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+def setupLogging(level = "WARNING", levels = None, env = "REYREY_LOG"):
+    """Configure the root handler and the per module levels.
+       level: default level, levels: {logger name: level}, both overridden by
+       the environment variable env: comma separated "LEVEL" and "name=LEVEL" items"""
+    levels = dict(levels) if levels is not None else {}
+    for item in os.environ.get(env, "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        if "=" in item:
+            name, value = item.split("=", 1)
+            levels[name.strip()] = value.strip().upper()
+        else:
+            level = item.upper()
+    logging.basicConfig(level = level, format = FORMAT)
+    for name, value in levels.items():
+        logging.getLogger(name).setLevel(value)